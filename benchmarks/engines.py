@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Compares the lfclib C extension with the NumPy implementation of the
+# lattice sums (muesr.engines.nplfc) and with the Ewald summation
+# (muesr.engines.ewald), which does not depend on the supercell size.
+#
+# Usage: python benchmarks/engines.py
+#
+
+import timeit
+import numpy as np
+
+from muesr.engines import nplfc, ewald
+
+try:
+    import lfclib
+except ImportError:
+    lfclib = None
+
+
+def setup(natoms, nsites, seed=0):
+    rng = np.random.RandomState(seed)
+    p = rng.rand(natoms, 3)
+    fc = rng.randn(natoms, 3) + 1.j * rng.randn(natoms, 3)
+    k = np.array([0.1, 0.2, 0.3])
+    phi = rng.rand(natoms)
+    mus = rng.rand(nsites, 3)
+    latpar = np.array([[4., 0., 0.], [0.5, 5., 0.], [0.3, 0.2, 6.]])
+    return p, fc, k, phi, mus, latpar
+
+
+def best_of(f, repeat=3):
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def run(natoms, nsites, scsize, radius):
+    p, fc, k, phi, mus, latpar = setup(natoms, nsites)
+    sc = np.array([scsize] * 3, dtype=np.int32)
+
+    def c_loop():
+        for mu in mus:
+            lfclib.Fields('s', p, fc, k, phi, mu, sc, latpar, radius, 2, 5.)
+
+    def np_loop():
+        for mu in mus:
+            nplfc.Fields('s', p, fc, k, phi, mu, sc, latpar, radius, 2, 5.)
+
+    def np_batch():
+        nplfc.Fields('s', p, fc, k, phi, mus, sc, latpar, radius, 2, 5.)
+
+    def ew_batch():
+        ewald.Fields('s', p, fc, k, phi, mus, latpar, 2, 5.)
+
+    tc = best_of(c_loop) if lfclib else float('nan')
+    tl = best_of(np_loop)
+    tb = best_of(np_batch)
+    te = best_of(ew_batch)
+    print("{:6d} {:6d} {:4d} {:7.1f} | {:10.4f} {:10.4f} {:10.4f} {:10.4f}".format(
+          natoms, nsites, scsize, radius, tc, tl, tb, te))
+
+
+if __name__ == '__main__':
+    print("natoms  sites   sc  radius |  lfclib (s)  nplfc (s) batched (s)  ewald (s)")
+    for natoms, nsites, scsize, radius in [(1, 1, 10, 15.),
+                                           (1, 1, 40, 60.),
+                                           (4, 1, 20, 30.),
+                                           (4, 100, 10, 15.),
+                                           (4, 1000, 10, 15.),
+                                           (4, 100, 20, 30.),
+                                           (16, 100, 10, 15.)]:
+        run(natoms, nsites, scsize, radius)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Measures the cold start time of muesr and of its subpackages. Each
+# module is imported in a new Python process with -X importtime, and the
+# optional dependencies loaded by the import are reported.
+#
+# Usage: python benchmarks/import_time.py [repeat]
+#
+
+import os
+import sys
+import subprocess
+import numpy as np
+
+MODULES = ['numpy',
+           'muesr',
+           'muesr.core',
+           'muesr.engines',
+           'muesr.i_o',
+           'muesr.utilities',
+           'muesr.core.magmodel',
+           'muesr.i_o.sampleIO',
+           'muesr.utilities.symsearch']
+
+# heavy dependencies that should only be loaded on first use
+OPTIONAL = ['sympy', 'yaml', 'spglib', 'lfclib', 'multiprocessing',
+            'concurrent.futures']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cold_import(module):
+    """
+    Imports `module` in a new process and returns the cumulative import
+    time in ms and the optional dependencies that were imported.
+    """
+    code = "import sys, {0}; print(','.join(m for m in {1!r} if m in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          code.format(module, OPTIONAL)],
+                         env=env, capture_output=True, text=True, check=True)
+    us = None
+    for line in res.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            us = int(fields[1])
+    return us / 1000., res.stdout.strip()
+
+
+def run(module, repeat):
+    times = []
+    for i in range(repeat):
+        t, loaded = cold_import(module)
+        times.append(t)
+    print("{:28s} {:10.1f} {:10.1f}   {}".format(module, np.min(times),
+                                                np.median(times), loaded))
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("module                         best (ms) median (ms)   optional deps loaded")
+    for module in MODULES:
+        run(module, repeat)
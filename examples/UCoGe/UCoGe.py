@@ -85,11 +85,12 @@ r=locfield(s, 's', [n, n, n] ,radius)
 
 
 cont_coup=-0.00892  #-0.0092
-B_dip=np.zeros([len(s.muons),3])
-B_Lor=np.zeros([len(s.muons),3])
-B_Cont=np.zeros([len(s.muons),3])
-B_Tot=np.zeros([len(s.muons),3])
-for i in range(len(s.muons)):
+nmu=len(s.snapshot().muons)
+B_dip=np.zeros([nmu,3])
+B_Lor=np.zeros([nmu,3])
+B_Cont=np.zeros([nmu,3])
+B_Tot=np.zeros([nmu,3])
+for i in range(nmu):
     B_dip[i]=r[i].D
     B_Lor[i]=r[i].L
     r[i].ACont= cont_coup
@@ -97,7 +98,7 @@ for i in range(len(s.muons)):
     B_Tot[i]=r[i].T
     print('net field for site', i+1,':=', np.linalg.norm(B_Tot[i]))
 print('')
-print('The dipolar field components for all ' +str(len(s.muons))+ ' equivalent sites')
+print('The dipolar field components for all ' +str(nmu)+ ' equivalent sites')
 print(B_dip)
 print('')
 print('Compare the norm of calculate dipolar field = {:.5f} T with the experimental value = 0.015 T\n'.format(np.linalg.norm(B_dip[0])))
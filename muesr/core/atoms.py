@@ -34,19 +34,30 @@
 
 import numpy as np
 
-class Atoms:
+class Atoms(object):
     """
     Atoms class compatible with the ASE Atoms class
     Only stuff needed by muesr is implemented.
     
+    The atoms are stored as a structure of arrays (atomic numbers,
+    masses, scaled positions and optionally magnetic moments) with
+    spare capacity, so that :py:meth:`extend` does not reallocate the
+    arrays at every call. Cartesian positions, the volume and the
+    reciprocal cell are computed once and cached until the atoms or 
+    the cell are changed.
+    
     >>> a = 4.05  # Gold lattice constant
     >>> b = a / 2
-    >>> fcc = Atoms('Au',
+    >>> fcc = Atoms(['Au'],
+    ...             scaled_positions=[(0, 0, 0)],
     ...             cell=[(0, b, b), (b, 0, b), (b, b, 0)],
     ...             pbc=True)
     
     """
     
+    __slots__ = ('_cell', '_scaled', '_numbers', '_masses', '_magmoms',
+                 '_size', '_cache')
+    
     def __init__(self,
                  symbols=None,
                  positions=None,
@@ -60,46 +71,75 @@ class Atoms:
         # cell
         if cell is None:
             raise ValueError('Only periodic system allowed. Please specify unit cell.')
-        else:
-            self.cell = np.array(cell, dtype=float)
+        self._cell = np.array(cell, dtype=float)
+        self._cache = {}
 
         # position
-        self.scaled_positions = None
-
-        if (not self.cell is None) and  (not positions is None):
-            self.set_positions(positions)
-
-        if (not scaled_positions is None):
-            self.set_scaled_positions(scaled_positions)
-
-        # Atom symbols
-        self.symbols = symbols
-
-        # Atomic numbers
-        if numbers is None:
-            self.numbers = None
+        if not scaled_positions is None:
+            scaled = np.array(scaled_positions, dtype=float).reshape(-1, 3)
+        elif not positions is None:
+            scaled = np.dot(np.reshape(positions, (-1, 3)),
+                            self._inverse_cell())
+        else:
+            scaled = np.zeros([0, 3])
+        self._size = len(scaled)
+        self._scaled = scaled
+
+        # Atomic numbers, from symbols if not given
+        if not numbers is None:
+            self._numbers = np.array(numbers, dtype=np.int16).reshape(-1)
+        elif not symbols is None:
+            self._numbers = _symbols_to_numbers(symbols)
         else:
-            self.numbers = np.array(numbers, dtype=int)
+            self._numbers = None
+
+        if not self._numbers is None and len(self._numbers) != self._size:
+            raise ValueError('Number of atomic species and positions differ.')
 
         # masses
+        self._masses = None
         self.set_masses(masses)
-
+        if self._masses is None and not self._numbers is None:
+            self._masses = _mass_table[self._numbers]
 
         # (initial) magnetic moments
+        self._magmoms = None
         self.set_magnetic_moments(magmoms)
 
+    def _changed(self):
+        """
+        Invalidates the cached quantities.
+        """
+        self._cache.clear()
 
-        # number --> symbol
-        if not self.numbers is None:
-            self.numbers_to_symbols()
+    def _cached(self, key, func):
+        if not key in self._cache:
+            value = func()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self._cache[key] = value
+        return self._cache[key]
 
-        # symbol --> number
-        elif not self.symbols is None:
-            self.symbols_to_numbers()
+    def _inverse_cell(self):
+        return self._cached('inverse', lambda: np.linalg.inv(self._cell))
 
-        # symbol --> mass
-        if self.symbols and (self.masses is None):
-            self.symbols_to_masses()
+    def _reserve(self, capacity):
+        """
+        Grows the arrays to hold at least `capacity` atoms. Arrays
+        without spare capacity, e.g. those replaced by the setters,
+        are grown to the capacity of the positions.
+        """
+        if capacity > len(self._scaled):
+            capacity = max(capacity, 2 * len(self._scaled), 8)
+        else:
+            capacity = len(self._scaled)
+        for name in ('_scaled', '_numbers', '_masses', '_magmoms'):
+            old = getattr(self, name)
+            if old is None or len(old) >= capacity:
+                continue
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
 
     # Add an atom
     # return atom index
@@ -112,100 +152,139 @@ class Atoms:
                  scaled_position=None):
         """
         Extends the current atomic structure by one atom.
+        The storage grows geometrically, so that adding N atoms one
+        at a time takes O(N) operations.
         """
-
-        # position
-
-        if (not self.cell is None) and  (not position is None):
-            # append scaled position to positions
-            self.scaled_positions = np.concatenate(self.scaled_positions, np.dot(position,
-                                        np.linalg.inv(self.cell)))
-        if (not scaled_position is None):
-            #print ((self.scaled_positions, np.array([scaled_position])))
-            self.scaled_positions = np.concatenate((self.scaled_positions, np.array([scaled_position])))
-
         if symbol is None and number is None:
             raise ValueError
 
-        # Atom symbols
-        if symbol is None:
-            symbol = atom_data[number][1]
-        
-        self.symbols.append(symbol)
-
         # Atomic numbers
         if number is None:
-            number = symbol_map[symbol]
-        
-        self.numbers = np.append(self.numbers, number)
-
-        
-        # (initial) magnetic moments
-        if not (self.magmoms is None):
-            if magmom is None:
-                magmom = np.array([0,0,0])
-            self.magmoms = np.concatenate((self.magmoms, [magmom]))
-
+            number = _symbols_to_numbers([symbol])[0]
 
         # symbol --> mass
         if mass is None:
             mass = atom_data[number][3]
-        
-        self.masses = np.append(self.masses,mass)
-        
+
+        if not position is None:
+            scaled_position = np.dot(position, self._inverse_cell())
+        if scaled_position is None:
+            scaled_position = np.zeros(3)
+
+        if self._numbers is None:
+            self._numbers = np.zeros(self._size, dtype=np.int16)
+            self._masses = np.zeros(self._size)
+
+        self._reserve(self._size + 1)
+        i = self._size
+        self._scaled[i] = scaled_position
+        self._numbers[i] = number
+        self._masses[i] = mass
+
+        # (initial) magnetic moments
+        if not self._magmoms is None:
+            self._magmoms[i] = 0. if magmom is None else magmom
+
+        self._size += 1
+        self._changed()
         return -1 # stands for last item!
 
+    def _check_index(self, i):
+        if i < -self._size or i >= self._size:
+            raise IndexError('Index out of range.')
+        return i % self._size
+
     def del_atom(self, i):
         """
         Removes one atom
         """
         if isinstance(i, int):
-            natoms = len(self)
-            if i < -natoms or i >= natoms:
-                raise IndexError('Index out of range.')
-            if not self.magmoms is None:
-                self.magmoms      = np.delete(self.magmoms, i, 0)         
-
-            self.symbols.pop(i)  #        = np.delete(self.symbols, i)
-            self.numbers          = np.delete(self.numbers, i)
-            self.scaled_positions = np.delete(self.scaled_positions, i,0) # axis is needed for scaled pos
-            self.masses           = np.delete(self.masses, i)
+            i = self._check_index(i)
+            for name in ('_scaled', '_numbers', '_masses', '_magmoms'):
+                a = getattr(self, name)
+                if a is None:
+                    continue
+                a[i:self._size - 1] = a[i + 1:self._size]
+            self._size -= 1
+            self._changed()
 
     def edit_atom(self, i, symbol = None, number = None, magmom = None, mass = None):
         if isinstance(i, int):
-            natoms = len(self)
-            if i < -natoms or i >= natoms:
-                raise IndexError('Index out of range.')
+            i = self._check_index(i)
             
             if symbol is None and number  is None:
                 raise ValueError
 
-            # Atom symbols
-            if symbol is None:
-                symbol = atom_data[number][1]
-            
-            self.symbols[i] = symbol
-    
             # Atomic numbers
             if number is None:
-                number = symbol_map[symbol]
+                number = _symbols_to_numbers([symbol])[0]
             
-            self.numbers[i] = number
+            self._numbers[i] = number
     
-            
             # (initial) magnetic moments
-            if not (self.magmoms is  None):
-                if magmom is None:
-                    magmom = np.array([0,0,0])
-                self.magmoms[i] = magmom
+            if not (self._magmoms is  None):
+                self._magmoms[i] = 0. if magmom is None else magmom
     
             # symbol --> mass
             if mass is None:
                 mass = atom_data[number][3]
             
-            self.masses[i] = mass
-            
-            
+            self._masses[i] = mass
+            self._changed()
+
+    @property
+    def cell(self):
+        """
+        Lattice vectors (rows), read-only array.
+        """
+        return self._cached('cell', lambda: self._cell.copy())
+
+    @cell.setter
+    def cell(self, cell):
+        self.set_cell(cell)
+
+    @property
+    def scaled_positions(self):
+        """
+        Positions in fractional coordinates, read-only array.
+        """
+        return self._cached('scaled', lambda: self._scaled[:self._size].copy())
+
+    @property
+    def numbers(self):
+        """
+        Atomic numbers, read-only array.
+        """
+        if self._numbers is None:
+            return None
+        return self._cached('numbers', lambda: self._numbers[:self._size].copy())
+
+    @property
+    def symbols(self):
+        """
+        Chemical symbols, list of str.
+        """
+        if self._numbers is None:
+            return None
+        return self.get_chemical_symbols()
+
+    @property
+    def masses(self):
+        """
+        Atomic masses, read-only array.
+        """
+        if self._masses is None:
+            return None
+        return self._cached('masses', lambda: self._masses[:self._size].copy())
+
+    @property
+    def magmoms(self):
+        """
+        Magnetic moments, read-only array or None.
+        """
+        if self._magmoms is None:
+            return None
+        return self._cached('magmoms', lambda: self._magmoms[:self._size].copy())
 
     def set_cell(self, cell):
         """
@@ -220,95 +299,121 @@ class Atoms:
                      where v1, v2, v3 are the lattice vectors.  
         """
 
-        self.cell = np.array(cell, dtype=float)
+        self._cell = np.array(cell, dtype=float)
+        self._changed()
 
     def get_cell(self):
-        return self.cell.copy()
+        return self._cell.copy()
+
+    def get_reciprocal_cell(self):
+        """
+        Reciprocal lattice vectors (rows), without the factor 2 pi.
+        """
+        return self._cached('reciprocal',
+                            lambda: self._inverse_cell().T.copy()).copy()
 
     def set_positions(self, cart_positions):
-        self.scaled_positions = np.dot(cart_positions,
-                                        np.linalg.inv(self.cell))
+        self.set_scaled_positions(np.dot(cart_positions,
+                                         self._inverse_cell()))
 
     def get_positions(self):
-        return np.dot(self.scaled_positions, self.cell)
+        return self._cached('positions',
+                            lambda: np.dot(self._scaled[:self._size],
+                                           self._cell)).copy()
 
     def set_scaled_positions(self, scaled_positions):
-        self.scaled_positions = np.array(scaled_positions, dtype=float)
+        scaled = np.array(scaled_positions, dtype=float).reshape(-1, 3)
+        if len(scaled) != self._size:
+            raise ValueError('Number of positions and atoms differ.')
+        self._scaled[:self._size] = scaled
+        self._changed()
 
     def get_scaled_positions(self):
-        return self.scaled_positions.copy()
+        return self._scaled[:self._size].copy()
 
     def set_masses(self, masses):
         if masses is None:
-            self.masses = None
+            if not self._numbers is None:
+                self._masses = _mass_table[self._numbers]
+            else:
+                self._masses = None
         else:
-            self.masses = np.array(masses, dtype=float)
+            masses = np.array(masses, dtype=float).reshape(-1)
+            if len(masses) != self._size:
+                raise ValueError('Number of masses and atoms differ.')
+            self._masses = masses
+        self._changed()
 
     def get_masses(self):
-        return self.masses.copy()
+        return self._masses[:self._size].copy()
 
     def set_magnetic_moments(self, magmoms=None):
         if magmoms is None:
-            self.magmoms = None
+            self._magmoms = None
         else:
-            self.magmoms = np.array(magmoms, dtype=float)
-
-
+            magmoms = np.array(magmoms, dtype=float)
+            if len(magmoms) != self._size:
+                raise ValueError('Number of magnetic moments and atoms differ.')
+            self._magmoms = magmoms
+        self._changed()
 
     def get_magnetic_moments(self):
         """
         Get magnetic moments if set. None if nothing set.
         """
-        if self.magmoms is None:
+        if self._magmoms is None:
             return None
         else:
-            return self.magmoms.copy()
-
-    
+            return self._magmoms[:self._size].copy()
 
     def set_chemical_symbols(self, symbols):
-        self.symbols = symbols
+        """
+        Sets the chemical symbols, and the atomic numbers and masses
+        accordingly.
+        """
+        numbers = _symbols_to_numbers(symbols)
+        if len(numbers) != self._size:
+            raise ValueError('Number of symbols and atoms differ.')
+        self._numbers = numbers
+        self._masses = _mass_table[numbers]
+        self._changed()
 
     def get_chemical_symbols(self):
-        return self.symbols[:]
+        return _symbol_table[self._numbers[:self._size]].tolist()
 
     def get_number_of_atoms(self):
-        return len(self.scaled_positions)
+        return self._size
 
     def get_atomic_numbers(self):
-        return self.numbers.copy()
-
-    def numbers_to_symbols(self):
-        self.symbols = [atom_data[n][1] for n in self.numbers]
-        
-    def symbols_to_numbers(self):
-        self.numbers = np.array([symbol_map[s.title()]
-                                 for s in self.symbols])
-        
-    def symbols_to_masses(self):
-        self.masses = np.array([atom_data[symbol_map[s.title()]][3]
-                                for s in self.symbols])
+        return self._numbers[:self._size].astype(int)
 
     def get_volume(self):
-        return np.linalg.det(self.cell)
+        return self._cached('volume', lambda: np.linalg.det(self._cell))
 
     def __len__(self):
-        return len(self.scaled_positions)
+        return self._size
 
     def __getitem__(self, i):
         """
         Return an atom
         """
         if isinstance(i, int):
-            natoms = len(self)
-            if i < -natoms or i >= natoms:
-                raise IndexError('Index out of range.')
+            i = self._check_index(i)
             mom = np.array([0,0,0])
-            if not self.magmoms is None:
-                mom = self.magmoms[i]
-            return (self.symbols[i], self.numbers[i], self.scaled_positions[i], mom)
+            if not self._magmoms is None:
+                mom = self._magmoms[i].copy()
+            return (_symbol_table[self._numbers[i]], int(self._numbers[i]),
+                    self._scaled[i].copy(), mom)
+
+
+def _symbols_to_numbers(symbols):
+    """
+    Atomic numbers of a list of chemical symbols.
+    """
+    return np.array([symbol_map[s] if s in symbol_map else symbol_map[s.title()]
+                     for s in symbols], dtype=np.int16).reshape(-1)
+
 
-        
 
 atom_data = [ 
     [  0, "mu", "mu", 0.2], # 0
@@ -554,3 +659,6 @@ symbol_map = {
     "mu":0,
     }
 
+# lookup tables indexed by the atomic number
+_symbol_table = np.array([d[1] for d in atom_data], dtype=object)
+_mass_table = np.array([d[3] for d in atom_data], dtype=float)
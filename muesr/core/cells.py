@@ -47,7 +47,9 @@ def get_simple_supercell(sample,  multi):
     # Scaled positions within the frame, i.e., create a supercell that
     # is made simply to multiply the input cell.
     
-    unitcell = sample.cell
+    # the cell is only read, no copy is needed
+    sample._check_lattice()
+    unitcell = sample._cell
     
     if type(multi) is np.ndarray:
         multi = multi.tolist()
@@ -76,7 +78,7 @@ def get_simple_supercell(sample,  multi):
     PHI=None
     
     try:
-        FC = sample.mm.fc
+        FC = sample.mm.fc_view()
         K = sample.mm.k 
         PHI  = sample.mm.phi
     except MagDefError:
@@ -88,46 +90,27 @@ def get_simple_supercell(sample,  multi):
     masses = unitcell.get_masses()
     lattice = unitcell.get_cell()
     
-    # these lists are used to strore new values
-    positions_multi = []
-    numbers_multi = []
-    masses_multi = []
+    if np.any(numbers == 0):    #  Check again if muon in there!
+        raise RuntimeError      #  This shuld never happen!
     
-    if not have_mag_structure:
-        magmoms_multi = None
-    else:
-        magmoms_multi = []
-
-    for l, pos in enumerate(positions):
-        if numbers[l] == 0:    #  Check again if muon in there!
-            raise RuntimeError #  This shuld never happen!
-            continue
-        for k in range(multi[2]):
-            for j in range(multi[1]):
-                for i in range(multi[0]):
-                    positions_multi.append([ (pos[0] + i) / multi[0],
-                                             (pos[1] + j) / multi[1],
-                                             (pos[2] + k) / multi[2] ])
-                    numbers_multi.append(numbers[l])
-                    masses_multi.append(masses[l])
-                    
-                    
-                    if have_mag_structure:
-
-                        
-                        c = np.cos ( 2.0*np.pi * (np.dot(K,[float(i),float(j),float(k)]) + PHI[l]))
-                        s = np.sin ( 2.0*np.pi * (np.dot(K,[float(i),float(j),float(k)]) + PHI[l]));
-                        
-                        sk = np.real(FC[l])
-                        isk = np.imag(FC[l])
-                        
-                        m = np.zeros(3)
-                        m = c*sk + s*isk
-                        
-                        #print "Norma: " , np.linalg.norm(m)
-                        magmoms_multi.append(m)                               
-
-
+    # translations of the unit cell, with the first index running fastest
+    k, j, i = np.meshgrid(np.arange(multi[2]), np.arange(multi[1]),
+                          np.arange(multi[0]), indexing='ij')
+    T = np.stack([i.ravel(), j.ravel(), k.ravel()], axis=1).astype(float)
+    nT = len(T)
+    
+    # all the copies of each atom are consecutive
+    positions_multi = ((positions[:, None, :] + T[None, :, :]) /
+                       np.array(multi, dtype=float)).reshape(-1, 3)
+    numbers_multi = np.repeat(numbers, nT)
+    masses_multi = np.repeat(masses, nT)
+    
+    magmoms_multi = None
+    if have_mag_structure:
+        phase = 2.0*np.pi * (np.dot(T, K)[None, :] + np.asarray(PHI)[:, None])
+        magmoms_multi = (np.cos(phase)[:, :, None] * np.real(FC)[:, None, :] +
+                         np.sin(phase)[:, :, None] * np.imag(FC)[:, None, :])
+        magmoms_multi = magmoms_multi.reshape(-1, 3)
 
     return Atoms(numbers = numbers_multi,
                  masses = masses_multi,
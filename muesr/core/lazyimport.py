@@ -0,0 +1,53 @@
+"""
+Lazy import of the optional dependencies.
+
+Packages like sympy, PyYAML and spglib take most of the time needed to
+import muesr, but only a few functions use them. Their availability is
+checked without importing them and the modules are imported the first
+time one of their attributes is accessed.
+"""
+
+import importlib
+import importlib.util
+
+
+def available(name):
+    """
+    Checks if a module can be imported, without importing it.
+
+    :param str name: the (dotted) name of the module.
+    :rtype: bool
+    """
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        # the parent package is missing
+        return False
+
+
+class LazyModule(object):
+    """
+    Placeholder for a module that is imported at the first access to
+    one of its attributes.
+
+    >>> sy = LazyModule('sympy')  # sympy is not imported yet
+    >>> x = sy.symbols('x')       # now it is
+
+    :param str name: the (dotted) name of the module.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '{}' ({})>".format(self._name, state)
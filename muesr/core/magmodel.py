@@ -3,12 +3,11 @@
 import numpy as np
 from muesr.core.cells import get_cell_parameters
 from muesr.core.isstr import isstr
+from muesr.core.lazyimport import available, LazyModule
 
-have_sympy = True
-try:
-    import sympy as sy
-except:
-    have_sympy = False
+# sympy is only imported when a symbolic model is used
+have_sympy = available('sympy')
+sy = LazyModule('sympy')
 
 
 class MM(object):
@@ -48,11 +47,16 @@ class MM(object):
         self._description = "No title"
                 
         self._validFormats = [0]
+        # matrices converting from each coordinate system to Cartesian
+        # coordinates and back, computed once
+        self._transforms = {}
         if isinstance(latt_vects, np.ndarray):
             if latt_vects.shape == (3,3):
-                self._latt = latt_vects
+                self._latt = np.array(latt_vects, dtype=np.float64)
                 self._rlatt = np.dot(np.diag(np.divide([1.,1.,1.],
                             get_cell_parameters(self._latt))),self._latt)
+                for i, m in ((1, self._latt), (2, self._rlatt)):
+                    self._transforms[i] = (m, np.linalg.inv(m))
                 self._validFormats += [1,2]
             else:
                 raise TypeError("Cannot parse lattice vectors.")
@@ -64,6 +68,7 @@ class MM(object):
         
         
         self._fc = np.zeros([cell_size,3],dtype=np.complex128)
+        self._fc_views = {}  # read-only Fourier components, by coord. system
         self._k = np.array([0,0,0])
         self._phi = np.zeros(cell_size,dtype=np.float64)
         
@@ -192,20 +197,38 @@ class MM(object):
         :raises: ValueError
         """
         
+        return self.fc_view(coord_system).copy()
+    
+    def fc_view(self, coord_system=0):
+        """
+        Read-only Fourier components. 
+        
+        Same as :py:meth:`~fc_get`, but the array is not copied: the
+        conversion to each coordinate system is done once and kept 
+        until the Fourier components are changed with 
+        :py:meth:`~fc_set`. The arrays obtained before the change are 
+        not modified.
+        
+        :params int coord_system: requested coordinate system, as in
+                                  :py:meth:`~fc_get`.
+        :raises: ValueError
+        """
+        
         # check if the lattice is defined, otherwise no conversion :/
         coord_system = int(coord_system)
         if not (coord_system in self._validFormats):
             raise ValueError("Invalid/unsupported input type. Have you provided lattice cell at instantiation?")
         
-        if coord_system == 0:
-            return np.copy(self._fc)
-        elif coord_system == 1:
-            return np.copy(np.dot(self._fc,np.linalg.inv(self._latt)))
-        elif coord_system == 2:
-            return np.copy(np.dot(self._fc, np.linalg.inv(self._rlatt)))
-        
-
-        
+        view = self._fc_views.get(coord_system)
+        if view is None:
+            if coord_system == 0:
+                view = self._fc.view()
+            else:
+                view = np.dot(self._fc, self._transforms[coord_system][1])
+            view.flags.writeable = False
+            self._fc_views[coord_system] = view
+        return view
+    
     
     def fc_set(self, value, coord_system=0):
         """
@@ -247,15 +270,13 @@ class MM(object):
             raise ValueError("Invalid/unsupported input type. Have you provided lattice cell at instantiation?")
         
         if coord_system==0:
-            # no conversion needed
-            self._fc = value
-            
-        elif coord_system==1:
-            self._fc = np.dot(value, self._latt)
-            
-        elif coord_system==2:                           
+            # no conversion needed, but the values of the user must not
+            # change the model (and its views) later on
+            self._fc = value.copy()
+        else:
             # we get cartesian coordinates as for atoms.
-            self._fc = np.dot(value, self._rlatt)
+            self._fc = np.dot(value, self._transforms[coord_system][0])
+        self._fc_views = {}
 
 
     @property
@@ -438,6 +459,50 @@ if have_sympy:
             else:
                 raise RuntimeError("Symbolic FC not defined!")
 
+        def fc_batch(self, values):
+            """
+            Evaluates the Fourier components for many sets of parameters
+            at once, without changing the Fourier components of the model.
+            The symbolic expression is evaluated with a single call for
+            all the sets and the results are converted to Cartesian
+            coordinates.
+            
+            :param values: array of shape (n_batch, n_params) containing the values for the sympy symbols, in the order given in the class instantiation.
+            :return: the Fourier components in Cartesian coordinates.
+            :rtype: numpy ndarray of shape (n_batch, :py:attr:`~size`, 3)
+            :raises: RuntimeError, TypeError, ValueError
+            """
+            
+            if self._symFClambda is None:
+                raise RuntimeError("Symbolic FC not defined!")
+            if not (self._inputType in self._validFormats):
+                raise ValueError("Invalid/unsupported input type. Have you provided lattice cell at instantiation?")
+            
+            try:
+                values = np.array(values)
+                values = values.astype(np.complex128 if np.iscomplexobj(values)
+                                       else np.float64)
+            except:
+                raise TypeError("Cannot convert values to NumPy array.")
+            if values.ndim == 1:
+                values = values.reshape(-1, 1)
+            nsym = len(np.atleast_1d(self._symbols))
+            if values.ndim != 2 or values.shape[1] != nsym:
+                raise ValueError("values must have shape (n_batch, {}).".format(nsym))
+            
+            n = values.shape[0]
+            res = self._symFClambda(*values.T)
+            # constant entries are returned as scalars
+            fc = np.empty([self._size, 3, n], dtype=np.complex128)
+            for i, row in enumerate(res):
+                for j, e in enumerate(row):
+                    fc[i, j] = e
+            fc = fc.transpose(2, 0, 1)
+            
+            if self._inputType != 0:
+                fc = np.dot(fc, self._transforms[self._inputType][0])
+            return fc
+
         @property
         def isSymbolic(self):
             """
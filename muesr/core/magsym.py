@@ -0,0 +1,184 @@
+"""
+Magnetic symmetry.
+
+The operations of the space group of the sample which leave the
+magnetic structure unchanged, possibly combined with time reversal,
+relate the local fields at symmetry equivalent muon sites. They are
+found by applying the operations of :py:attr:`Sample.sym` to the
+magnetic atoms and to their Fourier components.
+"""
+
+import numpy as np
+
+
+def cartesian_rotations(rotations, latpar):
+    """
+    Rotation matrices acting on Cartesian coordinates.
+
+    :param rotations: (n,3,3) array of rotations acting on fractional
+                      coordinates.
+    :param latpar: lattice vectors (rows).
+    :return: (n,3,3) array of rotations.
+    :rtype: numpy.ndarray
+    """
+    A = np.asarray(latpar, dtype=np.float64).T
+    return np.einsum('ij,njk,kl->nil', A, np.asarray(rotations),
+                     np.linalg.inv(A))
+
+
+def _match(positions, targets, symprec):
+    """
+    Index of the position equal to each target, modulo a lattice
+    translation, and the translation itself. The index is -1 if no
+    position matches.
+    """
+    d = targets[:, None, :] - positions[None, :, :]
+    match = np.all(np.abs(d - np.round(d)) < symprec, axis=2)
+    j = np.where(match.any(axis=1), match.argmax(axis=1), -1)
+    return j, np.rint(targets - positions[j]).astype(np.int64)
+
+
+def _integer(v, prec=1e-6):
+    return np.all(np.abs(v - np.round(v)) < prec)
+
+
+def sublattice_operations(sample, atoms, symprec=1e-3):
+    """
+    Operations of the space group of the sample which map the atoms
+    `atoms` onto themselves.
+
+    :param sample: the sample object.
+    :param atoms: indexes of the atoms of the cell.
+    :param float symprec: precision, in fractional coordinates, used to
+                          compare positions.
+    :return: the rotations (n,3,3) and translations (n,3), in fractional
+             coordinates, of the operations.
+    :rtype: tuple
+    :raises: CellError, SymmetryError
+    """
+    sample._check_lattice()
+    sample._check_sym()
+
+    positions = sample._cell.get_scaled_positions()[list(atoms)]
+    rot, trans = sample._sym.get_op()
+
+    keep = []
+    for n in range(len(rot)):
+        j, _ = _match(positions, np.dot(positions, rot[n].T) + trans[n],
+                      symprec)
+        keep.append(np.all(j >= 0))
+    return rot[keep], trans[keep]
+
+
+def magnetic_operations(sample, symprec=1e-3, momprec=1e-5):
+    """
+    Operations of the space group of the sample which leave the
+    magnetic structure of the current magnetic model unchanged, either
+    alone or combined with time reversal.
+
+    An operation {R|t} maps the moment of the atom at x on the atom at
+    Rx+t and transforms it as an axial vector. Only propagation
+    vectors k with R^T k equivalent to k or -k are considered.
+
+    :param sample: the sample object.
+    :param float symprec: precision, in fractional coordinates, used to
+                          compare positions.
+    :param float momprec: precision, relative to the largest Fourier
+                          component, used to compare moments.
+    :return: the rotations (n,3,3) and translations (n,3), in fractional
+             coordinates, and the time reversal (n,), either 1 or -1,
+             of the operations.
+    :rtype: tuple
+    :raises: CellError, MagDefError, SymmetryError
+    """
+    sample._check_magdefs()
+
+    fc = sample.mm.fc_view()
+    atoms = np.nonzero(np.any(np.abs(fc) > 1e-8, axis=1))[0]
+    positions = sample._cell.get_scaled_positions()[atoms]
+    k = np.asarray(sample.mm.k, dtype=np.float64)
+    # moments of the unit cell at the origin
+    fc = fc[atoms] * np.exp(-2.j * np.pi * sample.mm.phi[atoms])[:, None]
+    atol = momprec * (np.abs(fc).max() if len(atoms) > 0 else 1.)
+
+    rot, trans = sublattice_operations(sample, atoms, symprec)
+    Rc = cartesian_rotations(rot, sample._cell.get_cell())
+
+    keep, tr = [], []
+    for n in range(len(rot)):
+        j, L = _match(positions, np.dot(positions, rot[n].T) + trans[n],
+                      symprec)
+        kR = np.dot(rot[n].T, k)
+
+        # transformed moments and moments at the new positions, as
+        # amplitudes of the phases exp(-2 pi i R^T k . T)
+        a = np.linalg.det(rot[n]) * np.dot(fc, Rc[n].T)
+        b = fc[j] * np.exp(-2.j * np.pi * np.dot(L, k))[:, None]
+        if _integer(kR - k):
+            pass
+        elif _integer(kR + k):
+            b = np.conj(b)
+        else:
+            keep.append(False)
+            continue
+        if _integer(2. * k):
+            # the phases are real
+            a, b = a.real, b.real
+
+        for theta in (1, -1):
+            if np.allclose(theta * a, b, rtol=0., atol=atol):
+                keep.append(True)
+                tr.append(theta)
+                break
+        else:
+            keep.append(False)
+
+    return rot[keep], trans[keep], np.array(tr, dtype=np.int64)
+
+
+def site_orbits(points, rotations, translations, k=None, symprec=1e-3):
+    """
+    Groups the points in orbits of the given operations.
+
+    The first point of each orbit is its representative. A point
+    y = Ry'+t+T, with y' the representative and T a lattice
+    translation, is assigned to the orbit only if k.T is an integer,
+    i.e. if the translation does not change the phase of a magnetic
+    structure with propagation vector `k`. Otherwise it is the
+    representative of a new orbit.
+
+    :param points: (N,3) array of points in fractional coordinates.
+    :param rotations: (n,3,3) array of rotations.
+    :param translations: (n,3) array of translations.
+    :param k: propagation vector. Default None, i.e. any lattice
+              translation is allowed.
+    :param float symprec: precision, in fractional coordinates, used to
+                          compare positions.
+    :return: the index of the representative of the orbit of each
+             point (N,) and the index of the operation mapping the
+             representative on the point (N,), -1 for representatives.
+    :rtype: tuple
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    N = points.shape[0]
+    rep = np.full(N, -1, dtype=np.int64)
+    op = np.full(N, -1, dtype=np.int64)
+
+    for s in range(N):
+        if rep[s] >= 0:
+            continue
+        rep[s] = s
+
+        images = np.dot(rotations, points[s]) + translations
+        d = points[None, :, :] - images[:, None, :]
+        T = np.round(d)
+        match = np.all(np.abs(d - T) < symprec, axis=2)
+        if k is not None:
+            match &= np.abs(np.dot(T, k) - np.round(np.dot(T, k))) < 1e-6
+        match[:, rep >= 0] = False
+
+        found = match.any(axis=0)
+        rep[found] = s
+        op[found] = match.argmax(axis=0)[found]
+
+    return rep, op
@@ -0,0 +1,282 @@
+"""
+Periodic neighbour search.
+
+The replicas of the atoms closer than a cutoff radius to the unit cell
+are sorted in a regular grid of bins (a cell list) once. The nearest
+replicas to many points are then found by only considering the bins
+around each point.
+"""
+
+import numpy as np
+
+# maximum number of (point, replica) pairs considered at once
+BLOCK_SIZE = 2**20
+
+# arrays defining an index, see PeriodicNeighbours.to_arrays
+_ARRAYS = ('latpar', 'positions', 'b', 'origin', 'nbins', 'width', 'images',
+           'T', 'atoms', 'keys', 'starts', 'counts')
+
+class PeriodicNeighbours(object):
+    """
+    Index of the replicas of the atoms of a periodic lattice.
+
+    Finds the `k` atoms nearest to many points with a cost that grows
+    linearly with the number of points. The search around each point
+    starts from a small sphere, which is enlarged only when less than
+    `k` atoms are found.
+
+    :param latpar: lattice vectors (rows).
+    :param positions: (na,3) array of atomic positions in fractional
+                      coordinates.
+    :param float cutoff: largest distance of the neighbours searched
+                         with :py:meth:`query`, in Angstrom.
+    :raises: ValueError
+    """
+
+    def __init__(self, latpar, positions, cutoff):
+        latpar = np.array(latpar, dtype=np.float64)
+        positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+        cutoff = float(cutoff)
+        if cutoff <= 0:
+            raise ValueError("cutoff must be strictly positive.")
+
+        self._latpar = latpar
+        self._positions = positions
+        self._cutoff = cutoff
+        self._subsets = {}
+
+        na = positions.shape[0]
+        # half width of a sphere of radius cutoff along each lattice
+        # direction, in fractional coordinates.
+        h = cutoff * np.linalg.norm(np.linalg.inv(latpar).T, axis=1)
+
+        # replicas of the atoms, wrapped in the cell at the origin, that
+        # can be closer than cutoff to a point of the cell at the origin
+        wrap = np.floor(positions)
+        n = np.ceil(h).astype(np.int64) + 1
+        T = np.mgrid[-n[0]:n[0] + 1, -n[1]:n[1] + 1, -n[2]:n[2] + 1]
+        T = T.reshape(3, -1).T
+        images = (positions - wrap)[None, :, :] + T[:, None, :]
+        keep = np.all((images >= -h) & (images < 1. + h), axis=2)
+        t, a = np.nonzero(keep)
+        images = images[t, a]
+        # lattice translations of the replicas of the given positions
+        T = T[t] - wrap[a].astype(np.int64)
+
+        # bins of about the size of the volume per atom
+        r0 = (abs(np.linalg.det(latpar)) / max(1, na))**(1. / 3.)
+        self._b = np.linalg.norm(np.linalg.inv(latpar).T, axis=1)
+        self._r0 = r0
+        self._origin = -h
+        self._nbins = np.maximum(np.ceil((1. + 2. * h) / (r0 * self._b)),
+                                 1).astype(np.int64)
+        self._width = (1. + 2. * h) / self._nbins
+
+        bins = self._bin_ids(self._bins(images))
+        order = np.argsort(bins, kind='stable')
+        self._images = images[order]
+        self._T = T[order]
+        self._atoms = a[order]
+        # order of enumeration of the replicas, used to resolve ties
+        self._keys = np.zeros(0, dtype=np.int64)
+        if T.shape[0] > 0:
+            Tmin = self._T.min(axis=0)
+            span = self._T.max(axis=0) - Tmin + 1
+            self._keys = np.ravel_multi_index((self._T - Tmin).T, span) * na + \
+                         self._atoms
+
+        counts = np.bincount(bins, minlength=np.prod(self._nbins))
+        self._starts = np.cumsum(counts) - counts
+        self._counts = counts
+
+    @property
+    def cutoff(self):
+        """
+        Largest distance of the neighbours, in Angstrom.
+        """
+        return self._cutoff
+
+    def _bins(self, frac):
+        return np.floor((frac - self._origin) / self._width).astype(np.int64)
+
+    def _bin_ids(self, bins):
+        return np.ravel_multi_index(bins.T, self._nbins)
+
+    def subset(self, atoms):
+        """
+        Index of a subset of the atoms, e.g. the magnetic ones.
+        The indexes of the atoms returned by the queries of the new
+        index refer to the positions of `atoms`.
+        Indexes of subsets are cached.
+
+        :param atoms: indexes of the atoms.
+        :rtype: :py:class:`PeriodicNeighbours`
+        """
+        key = tuple(int(a) for a in atoms)
+        if key not in self._subsets:
+            self._subsets[key] = PeriodicNeighbours(self._latpar,
+                                                    self._positions[list(key)],
+                                                    self._cutoff)
+        return self._subsets[key]
+
+    def to_arrays(self, prefix=''):
+        """
+        The arrays defining the index, e.g. to share them with other
+        processes. The index is rebuilt, without repeating the binning,
+        with :py:meth:`from_arrays`.
+
+        :param str prefix: prefix of the names of the arrays.
+        :rtype: dict
+        """
+        arrays = dict((prefix + name, getattr(self, '_' + name))
+                      for name in _ARRAYS)
+        arrays[prefix + 'scalars'] = np.array([self._cutoff, self._r0])
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        """
+        Index defined by the arrays returned by :py:meth:`to_arrays`.
+        The arrays are not copied.
+
+        :param dict arrays: the arrays of the index.
+        :param str prefix: prefix of the names of the arrays.
+        :rtype: :py:class:`PeriodicNeighbours`
+        """
+        index = cls.__new__(cls)
+        for name in _ARRAYS:
+            setattr(index, '_' + name, arrays[prefix + name])
+        index._cutoff, index._r0 = [float(x) for x in arrays[prefix + 'scalars']]
+        index._subsets = {}
+        return index
+
+    def query(self, points, k, rmax=None, block_size=BLOCK_SIZE):
+        """
+        Finds the `k` replicas nearest to each point, among those not
+        farther than `rmax`. Equidistant replicas are sorted by lattice
+        translation (last index fastest) and by atom.
+
+        :param points: (N,3) array of points in fractional coordinates.
+        :param int k: number of neighbours.
+        :param float rmax: largest distance of the neighbours. Default
+                           None, i.e. the cutoff of the index.
+        :param int block_size: maximum number of (point, replica) pairs
+                               evaluated at once.
+        :return: the distances (N,k), the atom indexes (N,k) and the
+                 lattice translations (N,k,3) of the neighbours. If less
+                 than k neighbours are found, the missing ones have
+                 infinite distance and atom index -1.
+        :rtype: tuple
+        :raises: ValueError
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        k = int(k)
+        rmax = self._cutoff if rmax is None else float(rmax)
+        if rmax > self._cutoff * (1. + 1e-12):
+            raise ValueError("rmax larger than the cutoff of the index.")
+
+        N = points.shape[0]
+        dist = np.full([N, k], np.inf)
+        atoms = np.full([N, k], -1, dtype=np.int64)
+        T = np.zeros([N, k, 3], dtype=np.int64)
+        if N == 0 or k <= 0 or self._images.shape[0] == 0:
+            return dist, atoms, T
+
+        shift = np.floor(points)
+        u = points - shift
+        bins = np.minimum(np.maximum(self._bins(u), 0), self._nbins - 1)
+
+        # The search starts from a sphere containing a few more than k
+        # atoms on average, and is repeated with a larger radius only
+        # for the points with less than k neighbours.
+        radius = min(rmax, self._r0 * (2. * (k + 1))**(1. / 3.))
+        todo = np.arange(N)
+        while todo.size > 0:
+            found = self._search(u, bins, shift, todo, k, radius,
+                                 block_size, dist, atoms, T)
+            if radius >= rmax:
+                break
+            todo = todo[found < k]
+            radius = min(rmax, 2. * radius)
+
+        return dist, atoms, T
+
+    def _search(self, u, bins, shift, todo, k, radius, block_size,
+                dist, atoms, T):
+        """
+        Stores the k nearest replicas closer than `radius` to the points
+        `todo`. Returns the number of replicas found for each point.
+        """
+        # bins intersecting the sphere around each point
+        m = np.ceil(radius * self._b / self._width).astype(np.int64)
+        offsets = np.mgrid[-m[0]:m[0] + 1, -m[1]:m[1] + 1, -m[2]:m[2] + 1]
+        offsets = offsets.reshape(3, -1).T
+
+        found = np.zeros(todo.size, dtype=np.int64)
+        per_point = offsets.shape[0] * self._images.shape[0] / \
+                    float(np.prod(self._nbins))
+        step = max(1, int(block_size // max(1., per_point)))
+        for start in range(0, todo.size, step):
+            idx = todo[start:start + step]
+            p, j, d = self._candidates(u[idx], bins[idx], offsets)
+
+            select = d <= radius
+            p, j, d = p[select], j[select], d[select]
+
+            # equal distances are compared up to rounding errors
+            order = np.lexsort((self._keys[j], np.round(d, 8), p))
+            p, j, d = p[order], j[order], d[order]
+            rank = np.arange(p.size) - np.searchsorted(p, p, side='left')
+            found[start:start + idx.size] = np.bincount(p, minlength=idx.size)
+
+            select = rank < k
+            p, j, d, rank = p[select], j[select], d[select], rank[select]
+
+            i = idx[p]
+            dist[i, rank] = d
+            atoms[i, rank] = self._atoms[j]
+            T[i, rank] = self._T[j] + shift[i].astype(np.int64)
+
+        return found
+
+    def _candidates(self, u, bins, offsets):
+        """
+        Pairs (point, replica) of the replicas in the bins around each
+        point, and their distance.
+        """
+        nbins = bins[:, None, :] + offsets[None, :, :]
+        valid = np.all((nbins >= 0) & (nbins < self._nbins), axis=2)
+        ids = np.ravel_multi_index(np.clip(nbins, 0, self._nbins - 1)
+                                   .reshape(-1, 3).T, self._nbins)
+        counts = np.where(valid.ravel(), self._counts[ids], 0)
+        starts = self._starts[ids]
+
+        p = np.repeat(np.arange(u.shape[0]), offsets.shape[0])
+        p = np.repeat(p, counts)
+        # indexes of the replicas of each (point, bin) pair
+        j = np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts - starts, counts)
+
+        rvec = np.dot(self._images[j] - u[p], self._latpar)
+        d = np.sqrt(np.einsum('jk,jk->j', rvec, rvec))
+        return p, j, d
+
+
+def neighbour_index(sample, cutoff):
+    """
+    Neighbour index of the atoms of the cell of `sample`.
+    The index is stored in the sample and reused until the cell
+    changes or a larger cutoff is needed.
+
+    :param sample: the sample object
+    :param float cutoff: largest distance of the neighbours, in Angstrom.
+    :rtype: :py:class:`PeriodicNeighbours`
+    """
+    sample._check_lattice()
+    index = sample._neighbours
+    if index is None or index.cutoff < cutoff:
+        index = PeriodicNeighbours(sample._cell.get_cell(),
+                                   sample._cell.get_scaled_positions(),
+                                   cutoff)
+        sample._neighbours = index
+    return index
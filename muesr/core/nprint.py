@@ -1,5 +1,3 @@
-from muesr.core.prettytable import PrettyTable
-
 HEADER = '\033[95m'
 OKBLUE = '\033[94m'
 OKGREEN = '\033[92m'
@@ -38,6 +36,8 @@ def nprint(arg, color = None):
             print ("\t %s" % arg)
 
 def nprinttab(arg, header):
+    # prettytable is slow to import and rarely used
+    from muesr.core.prettytable import PrettyTable
     x = PrettyTable(header, border=True)
     for line in arg:
         x.add_row(line)
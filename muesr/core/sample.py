@@ -17,6 +17,200 @@ if have_sympy:
     from muesr.core.magmodel  import SMM
 
 
+def _readonly(a):
+    """
+    Returns `a` as a NumPy array that cannot be modified.
+    """
+    a = np.array(a)
+    a.flags.writeable = False
+    return a
+
+
+class _MuonSites(object):
+    """
+    Growable storage of the muon sites: a (N,3) array of fractional
+    coordinates with a label, an orbit index and a weight for each site.
+    
+    Sites are appended in place, with the capacity of the arrays doubled
+    when needed, so that the first N rows are never modified and can be
+    shared by the snapshots of the sample. Removing sites allocates new
+    arrays.
+    """
+    
+    __slots__ = ('_positions', '_labels', '_orbits', '_weights', '_size')
+    
+    def __init__(self, capacity=16):
+        self._positions = np.empty([capacity, 3], dtype=np.float64)
+        self._labels = np.empty(capacity, dtype=object)
+        self._orbits = np.empty(capacity, dtype=np.int64)
+        self._weights = np.empty(capacity, dtype=np.float64)
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    @property
+    def positions(self):
+        return self._positions[:self._size]
+    
+    @property
+    def labels(self):
+        return self._labels[:self._size]
+    
+    @property
+    def orbits(self):
+        return self._orbits[:self._size]
+    
+    @property
+    def weights(self):
+        return self._weights[:self._size]
+    
+    def _resize(self, capacity):
+        for name in self.__slots__[:-1]:
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+    
+    def append(self, positions, labels, orbits, weights):
+        """
+        Appends the validated (n,3) array `positions` and the arrays
+        of shape (n,) `labels`, `orbits` and `weights`.
+        """
+        n = len(positions)
+        end = self._size + n
+        if end > len(self._positions):
+            self._resize(max(end, 2 * len(self._positions)))
+        self._positions[self._size:end] = positions
+        self._labels[self._size:end] = labels
+        self._orbits[self._size:end] = orbits
+        self._weights[self._size:end] = weights
+        self._size = end
+    
+    def remove(self, index):
+        """
+        Removes the sites selected by `index`, which can be anything
+        used to index a NumPy array: an integer, a slice, an array of
+        integers or a boolean mask.
+        """
+        keep = np.ones(self._size, dtype=bool)
+        keep[index] = False
+        sites = _MuonSites(max(16, int(keep.sum())))
+        sites.append(self.positions[keep], self.labels[keep],
+                     self.orbits[keep], self.weights[keep])
+        return sites
+
+
+class SampleSnapshot(object):
+    """
+    Read-only view of the arrays describing a sample, obtained with
+    :py:meth:`Sample.snapshot`.
+    
+    The arrays cannot be modified and are shared by all the snapshots
+    taken while the sample is unchanged, so that no data is copied when
+    a snapshot is obtained. The Fourier components, the propagation 
+    vector and the phases are those of the magnetic model selected when
+    the snapshot is taken, or None if no model is defined.
+    """
+    
+    __slots__ = ('_version', '_lattice', '_positions', '_symbols',
+                 '_muons', '_muon_labels', '_muon_orbits', '_muon_weights',
+                 '_fc', '_k', '_phi')
+    
+    def __init__(self, version, lattice, positions, symbols, muons,
+                 muon_labels, muon_orbits, muon_weights,
+                 fc=None, k=None, phi=None):
+        self._version = version
+        self._lattice = lattice
+        self._positions = positions
+        self._symbols = symbols
+        self._muons = muons
+        self._muon_labels = muon_labels
+        self._muon_orbits = muon_orbits
+        self._muon_weights = muon_weights
+        self._fc = fc
+        self._k = k
+        self._phi = phi
+    
+    @property
+    def version(self):
+        """
+        Value of :py:attr:`Sample.version` when the snapshot was taken.
+        """
+        return self._version
+    
+    @property
+    def lattice(self):
+        """
+        Lattice vectors (rows), (3,3) array in Angstrom.
+        """
+        return self._lattice
+    
+    @property
+    def positions(self):
+        """
+        Atomic positions in fractional coordinates, (natoms,3) array.
+        """
+        return self._positions
+    
+    @property
+    def symbols(self):
+        """
+        Chemical symbols of the atoms, tuple of str.
+        """
+        return self._symbols
+    
+    @property
+    def muons(self):
+        """
+        Muon positions in fractional coordinates, (N,3) array. 
+        N is zero if no muon site is defined.
+        """
+        return self._muons
+    
+    @property
+    def muon_labels(self):
+        """
+        Labels of the muon sites, (N,) array of str.
+        """
+        return self._muon_labels
+    
+    @property
+    def muon_orbits(self):
+        """
+        Orbit index of the muon sites, (N,) int array. Sites with the
+        same index are equivalent by symmetry, -1 means not known.
+        """
+        return self._muon_orbits
+    
+    @property
+    def muon_weights(self):
+        """
+        Weights of the muon sites, (N,) array.
+        """
+        return self._muon_weights
+    
+    @property
+    def fc(self):
+        """
+        Fourier components of the selected magnetic model in Cartesian
+        coordinates, (natoms,3) complex array.
+        """
+        return self._fc
+    
+    @property
+    def k(self):
+        """
+        Propagation vector of the selected magnetic model in r.l.u.
+        """
+        return self._k
+    
+    @property
+    def phi(self):
+        """
+        Phases of the selected magnetic model, (natoms,) array.
+        """
+        return self._phi
 
 
 class Sample(object):
@@ -46,11 +240,14 @@ class Sample(object):
 
     def __init__(self):
         self._name    = "No name"     # description of the sample
-        self._muon    = []            # list containing the muon pos (frac. coord)
+        self._muon    = _MuonSites()  # muon sites (frac. coord)
         self._magdefs = []            # list containing MM objects
         self._sym     = None          # contains symmetry object
         self._cell    = None          # contains an Atoms object
         self._selected_mm = -1        # the selected magnetic structure.        
+        self._neighbours = None       # neighbour index of the cell
+        self._version = 0             # incremented at each change
+        self._arrays  = None          # read-only arrays of the snapshots
         self._freeze()
     
     def __setattr__(self, key, value):
@@ -73,6 +270,61 @@ class Sample(object):
     def _freeze(self):
         self.__isfrozen = True    
     
+    def _changed(self):
+        """
+        Records a change of the sample.
+        """
+        self._version += 1
+        self._arrays = None
+    
+    @property
+    def version(self):
+        """
+        Counter incremented at each change of the cell, of the symmetry,
+        of the muon sites or of the set of magnetic models of the sample 
+        (including the selection of the current model). Changes made
+        directly to a magnetic model object are not counted.
+        
+        :getter: Returns the version of the sample
+        :type: int
+        """
+        return self._version
+    
+    def snapshot(self):
+        """
+        Returns a read-only view of the cell, of the muon sites and of
+        the current magnetic model.
+        
+        Contrary to :py:attr:`~cell` and :py:attr:`~muons`, no copy is 
+        made as long as the sample is not changed, so this is the 
+        preferred access in loops and in the engines.
+        
+        :returns: a :py:class:`SampleSnapshot` object
+        :rtype: :py:class:`SampleSnapshot`
+        :raises: CellError
+        """
+        self._check_lattice()
+        
+        if self._arrays is None:
+            # the first rows of the muon arrays are never modified in
+            # place, so read-only views are enough
+            muons = [a.view() for a in (self._muon.positions,
+                                        self._muon.labels,
+                                        self._muon.orbits,
+                                        self._muon.weights)]
+            for a in muons:
+                a.flags.writeable = False
+            self._arrays = (_readonly(self._cell.get_cell()),
+                            _readonly(self._cell.get_scaled_positions()),
+                            tuple(self._cell.get_chemical_symbols())) + \
+                           tuple(muons)
+        
+        model = ()
+        if self._magdefs:
+            mm = self._magdefs[self._selected_mm]
+            model = (mm.fc_view(), _readonly(mm.k), _readonly(mm.phi))
+        return SampleSnapshot(self._version, *(self._arrays + model))
+    
     @property
     def name(self):
         """
@@ -99,9 +351,9 @@ class Sample(object):
         :getter: Returns a list of numpy array of shape (3,).
         """
         self._check_muon()
-        return deepcopy(self._muon)
+        return list(self._muon.positions.copy())
         
-    def add_muon(self, position, cartesian=False):
+    def add_muon(self, position, cartesian=False, label='', weight=1.):
         """
         Adds a muon position.
         
@@ -112,6 +364,8 @@ class Sample(object):
                                Cartesian coordinates. If False (default)
                                the position is assumed to be in fractional
                                coordinates.
+        :param str label: label of the site. Default empty.
+        :param float weight: weight of the site. Default 1.
         :returns: None
         :rtype: None
         :raises: MuonError                       
@@ -129,12 +383,83 @@ class Sample(object):
             raise TypeError('Invalid input for muon position. Must be list of numpy array.')
         
         
+        self.add_muons(position.reshape(1, 3), cartesian=cartesian,
+                       labels=[label], weights=weight)
+    
+    def add_muons(self, positions, cartesian=False, labels=None,
+                  orbits=None, weights=None):
+        """
+        Adds many muon positions at once.
+        
+        :param positions: array of shape (N,3) with the positions of
+                          the muons.
+        :param bool cartesian: if True, the positions are assumed to be in 
+                               Cartesian coordinates. If False (default)
+                               the positions are assumed to be in 
+                               fractional coordinates.
+        :param labels: list of N str with the labels of the sites.
+                       Default None, i.e. empty labels.
+        :param orbits: N integers grouping the sites equivalent by 
+                       symmetry. Default None, i.e. -1 (not known).
+        :param weights: N non negative weights of the sites (or a single
+                        weight for all of them). Default None, i.e. 1.
+        :returns: None
+        :rtype: None
+        :raises: CellError, TypeError, ValueError
+        """
+        self._check_lattice()
+        
+        try:
+            positions = np.array(positions, dtype=np.float64)
+        except (TypeError, ValueError):
+            raise TypeError('Invalid input for muon positions. Must be array of float.')
+        if positions.ndim != 2 or positions.shape[1] != 3:
+            raise ValueError('Invalid shape for muon positions. Must be (N,3).')
+        n = len(positions)
+        
+        if labels is None:
+            labels = [''] * n
+        elif isstr(labels) or len(labels) != n:
+            raise ValueError('labels must be a list of one str per site.')
+        elif not all(isstr(l) for l in labels):
+            raise TypeError('Invalid type for labels. Must be str.')
+        
+        try:
+            orbits = np.broadcast_to(np.array(-1 if orbits is None else orbits,
+                                              dtype=np.int64), (n,))
+        except (TypeError, ValueError):
+            raise ValueError('orbits must be a list of one int per site.')
+        
+        try:
+            weights = np.broadcast_to(np.array(1. if weights is None else weights,
+                                               dtype=np.float64), (n,))
+        except (TypeError, ValueError):
+            raise ValueError('weights must be a list of one float per site.')
+        if np.any(weights < 0) or not np.all(np.isfinite(weights)):
+            raise ValueError('weights must be finite and non negative.')
+        
         if cartesian:
             #go to reduced lattice coordinates...check this
-            self._muon.append(np.dot(position,
-                                        np.linalg.inv(self._cell.cell)))
-        else:
-            self._muon.append(1.0*position) # make floats from ints
+            positions = np.dot(positions, np.linalg.inv(self._cell.cell))
+        
+        self._muon.append(positions, labels, orbits, weights)
+        self._changed()
+    
+    def remove_muons(self, index):
+        """
+        Removes muon positions.
+        
+        :param index: the sites to remove: an integer, a slice, a list 
+                      of integers or a boolean mask of the sites, as 
+                      used to index the array of the positions returned
+                      by :py:meth:`snapshot`.
+        :returns: None
+        :rtype: None
+        :raises: MuonError, IndexError
+        """
+        self._check_muon()
+        self._muon = self._muon.remove(index)
+        self._changed()
     
     
     @property
@@ -172,6 +497,7 @@ class Sample(object):
             if self._cell.get_number_of_atoms() == len(value.fc):
                 self._magdefs.append(value)
                 self._selected_mm = len(self._magdefs) - 1
+                self._changed()
             else:
                 raise MagDefError('Number of fourier components does not match number of atoms')
         else:
@@ -191,6 +517,7 @@ class Sample(object):
 
                                 
         self._selected_mm = len(self._magdefs) - 1        
+        self._changed()
     
     def new_smm(self, symbolic_parameters):
         """
@@ -211,6 +538,7 @@ class Sample(object):
         
         # select last model
         self._selected_mm = len(self._magdefs) - 1 
+        self._changed()
             
     @property
     def current_mm_idx(self):
@@ -232,6 +560,7 @@ class Sample(object):
         
         if i < len(self._magdefs) and i >= 0:
             self._selected_mm = i
+            self._changed()
         else:
             raise IndexError('Only %d magnetic structures defined' % len(self._magdefs))
         
@@ -254,6 +583,7 @@ class Sample(object):
             raise TypeError('Symmetry is invalid.')	
         
         self._sym = value
+        self._changed()
         
     @property
     def cell(self): 
@@ -262,6 +592,8 @@ class Sample(object):
 
         :getter: returns a Atoms Object.
         :setter: Sets the atomic structure definition from a Atoms object.
+                 The object is copied: later changes to it do not
+                 affect the sample.
         :type: int
         :raises: TypeError, CellError        
         """
@@ -273,7 +605,11 @@ class Sample(object):
         if not (isinstance(value,Atoms)):
             raise TypeError('Cell is invalid.')
                 
-        self._cell = value
+        # the snapshot and the neighbour index are only invalidated by
+        # the setters of the sample
+        self._cell = deepcopy(value)
+        self._neighbours = None
+        self._changed()
     
         
     def __repr__(self):
@@ -303,7 +639,7 @@ class Sample(object):
 
         # Check muon position
         status += " Muon position(s):".ljust(30)
-        if not self._muon:
+        if len(self._muon) == 0:
             status += cstring('No','warn')
         else:
             status += cstring(str(len(self._muon))+' site(s)','ok')
@@ -366,6 +702,7 @@ class Sample(object):
         """
         if cell:
             self._cell = None
+            self._neighbours = None
             if not muon:
                 warnings.warn("Resetting cell but preserving muon " +
                               "position! Are you sure?", RuntimeWarning)
@@ -380,9 +717,10 @@ class Sample(object):
             self._magdefs = []
             self._selected_mm = -1
         if muon:
-            self._muon = []
+            self._muon = _MuonSites()
         if sym:
             self._sym = None
+        self._changed()
 
     def _check_sym(self):
         if self._sym is None:
@@ -410,14 +748,10 @@ class Sample(object):
             raise MagDefError('Magnetic structure type is wrong!')
         
     def _check_muon(self):
-        if type(self._muon) is list:
+        if type(self._muon) is _MuonSites:
             if len(self._muon) > 0:
-                for e in self._muon:
-                    if not(type(e) is np.ndarray):
-                        raise MuonError('Muon position not defined or wrong type')
                 return True
             else:
                 raise MuonError('Muon position not defined')
-
-
-        
+        else:
+            raise MuonError('Muon position not defined or wrong type')
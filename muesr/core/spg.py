@@ -18,16 +18,15 @@ from muesr.core.isstr import isstr
 
 # check if we have access to get_spacegroup from spglib
 # https://atztogo.github.io/spglib/
-has_spglib = False
-try:
-    import spglib                   # For version 1.9 or later
-    has_spglib = True
-except ImportError:
-    try:
-        from pyspglib import spglib  # For versions 1.8.x or before
-        has_spglib = True
-    except ImportError:
-        pass
+# (imported on first use)
+from muesr.core.lazyimport import available, LazyModule
+has_spglib = True
+if available('spglib'):
+    spglib = LazyModule('spglib')               # For version 1.9 or later
+elif available('pyspglib'):
+    spglib = LazyModule('pyspglib.spglib')      # For versions 1.8.x or before
+else:
+    has_spglib = False
 
 try:
     from StringIO import StringIO
@@ -1 +1,5 @@
-from .clfc import (locfield, find_largest_sphere)
+from .clfc import (locfield, locfield_batch, locfield_adaptive,
+                   locfield_histogram, locfield_gradient, locfield_zpm,
+                   locfield_models, locfield_kscan,
+                   find_largest_sphere)
+from .lfcache import LocalFieldsCache
@@ -1,11 +1,30 @@
 import os
+import warnings
 import numpy as np
 from copy import deepcopy
 
 from muesr.core.sample import Sample
 from muesr.core.isstr import isstr
+from muesr.core.magmodel import MM
+from muesr.core.neighbours import PeriodicNeighbours, neighbour_index
+from muesr.core.magsym import magnetic_operations, sublattice_operations, \
+                              site_orbits, cartesian_rotations
 
-import lfclib as lfcext
+from muesr.engines import nplfc
+from muesr.engines.parallel import map_sites, parse_workers
+from muesr.engines.histogram import FieldHistogram, ellipse_bmax
+
+# Contrary to the other optional dependencies, lfclib is imported
+# eagerly: the backend must be chosen here, since a failed import selects
+# the NumPy implementation, and the C extension loads in well under a
+# millisecond.
+have_lfclib = True
+try:
+    import lfclib as lfcext
+except ImportError:
+    # fall back to the (slower) NumPy implementation of the lattice sums
+    have_lfclib = False
+    lfcext = nplfc
 
 
 class LocalFields(object):
@@ -36,6 +55,11 @@ class LocalFields(object):
     using the property :py:attr:`~ACont`.
     
     The object is initialized as LocalFields(BCont, BDip, BLor, ACont=0.).
+    Results of :py:func:`~locfield_adaptive` also store the radius of
+    the Lorentz sphere and the estimated error of the sums, which are
+    otherwise None.
+    Results of :py:func:`~locfield_zpm` store the variances of the 
+    fields over the displacements of the muon, see :py:attr:`~variance`.
     
     """
 
@@ -48,7 +72,8 @@ class LocalFields(object):
     def _freeze(self):
         self.__isfrozen = True
 
-    def __init__(self, BCont, BDip, BLor, ACont=0.):
+    def __init__(self, BCont, BDip, BLor, ACont=0., radius=None, error=None,
+                 moments=None):
         
         try:
             assert(type(BLor) is np.ndarray)
@@ -72,6 +97,12 @@ class LocalFields(object):
         except:
             raise TypeError( "Cannot set value for ACont. Must be float." )
         
+        self._radius = radius
+        self._error = error
+        # variance of the contact field (for unit ACont), its covariance
+        # with the other fields and the variance of the other fields
+        self._moments = moments
+        
         self._freeze() # no new attributes after this point. 
         
     def __repr__(self):
@@ -158,19 +189,99 @@ class LocalFields(object):
         except:
             raise TypeError( "Cannot set value for ACont" )
 
+    @property
+    def radius(self):
+        """
+        Radius of the Lorentz sphere in Angstrom reached by
+        :py:func:`~locfield_adaptive`, None for other calculations.
+        
+        :getter: Returns the radius
+        :type: float
+        """
+        return self._radius
 
+    @property
+    def error(self):
+        """
+        Estimated error in Tesla of the dipolar and Lorentz fields
+        obtained by :py:func:`~locfield_adaptive`, i.e. the largest 
+        change of the fields in the last two spherical shells.
+        None for other calculations.
+        
+        :getter: Returns the error estimate
+        :type: float
+        """
+        return self._error
 
+    @property
+    def variance(self):
+        """
+        Variance of each component of the total field over the 
+        displacements of the muon, in Tesla^2, for the averages of 
+        :py:func:`~locfield_zpm`. The variance follows the current value 
+        of :py:attr:`~ACont`. None for other calculations.
+        
+        :getter: Returns a numpy ndarray with the same shape of the fields
+        """
+        if self._moments is None:
+            return None
+        VC, CC, VO = self._moments
+        return VO + 2. * self._ACont * CC + self._ACont**2 * VC
+
+
+
+
+
+def _sphere_site(a, i, supercell):
+    """
+    Shortest distance between the i-th muon site and the faces of the
+    supercell.
+    """
+    # http://mathworld.wolfram.com/Point-PlaneDistance.html
+    # https://en.wikipedia.org/wiki/Plane_%28geometry%29
+    
+    scell = a['scell']
+    mu = a['muons'][i]
+    
+    distances = []
+    
+    # muon position in Cartesian coordnates
+    mup = np.dot((mu + np.floor(np.array(supercell,dtype=np.float64)/2.))/np.array(supercell,dtype=np.float64), scell)
+    # define planes using point and normal vector
+    
+    for i,j,k in [[1,1,0],[1,0,1],[0,1,1]]:
+        
+        p1 = float(i)*scell[0,:]
+        p2 = float(j)*scell[1,:]
+        p3 = float(k)*scell[2,:]
+        # parallel plane shifted by one lattice vector
+        sp = float(1-i)*scell[0,:] + float(1-j)*scell[1,:] + float(1-k)*scell[2,:]
+        
+        
+        n = np.cross((p2-p1),(p3-p1))
+        n /= np.linalg.norm(n)
+        # r = p1 , is included in the formula below.
+        
+        D = np.dot(n,mup-p1)
+        distances.append(np.abs(D))
+        
+        # plane shifted by one lattice vector
+        D = np.dot(n,mup-p1-sp)
+        distances.append(np.abs(D))
+    
+    return np.min(distances)
 
 
-def find_largest_sphere(sample, supercell):
+def find_largest_sphere(sample, supercell, workers = None):
     """
     Simple function to evaluate the shortest distance between the
-    muon position in the supercell and one of the lattice planes 
+    muon positions in the supercell and one of the lattice planes 
     defined by the lattice coordinates.
     
     :param sample: the sample object
     :param list supercell: the size of the supercell along the lattice coordinates.
-    :return: the radius of the biggest sphere that can be inscribed or None.
+    :param int workers: number of processes used to evaluate the muon sites. Without shared memory (Python < 3.8) the evaluation is serial and a warning is issued. Default None, i.e. serial execution.
+    :return: the radius of the biggest sphere that can be inscribed around all the muon sites or None.
     :rtype: float
     :raises: ValueError, TypeError
     """
@@ -187,7 +298,7 @@ def find_largest_sphere(sample, supercell):
             raise ValueError("Wrong supercell definition")
             
     elif (type(supercell) is np.ndarray):
-        if supercell.spahe != (3,):
+        if supercell.shape != (3,):
             raise ValueError("Wrong supercell definition")
     else:
         raise TypeError("Argument supercell must be list of numpy array")
@@ -199,39 +310,265 @@ def find_largest_sphere(sample, supercell):
     cell = sample._cell.get_cell()
     scell = np.dot(cell,np.diag(supercell))
     
+    arrays = {'scell': scell, 'muons': sample.snapshot().muons}
+    distances = map_sites(_sphere_site, arrays, len(arrays['muons']),
+                          (supercell,), workers)
+    
+    #nprint("WARNING: this is and experimental function!",'warn')
+    return np.min(distances)
+    
+def _parse_ctype_args(ctype, nangles, axis, angles=None):
+    """
+    Validates the calculation type and the options of 'rotate' and
+    'incommensurate' calculations.
+    Returns the one letter calculation type, the number of angles (or
+    the array of angles in radians when `angles`, in degrees, is 
+    given for 'rotate' calculations) and the normalized rotation 
+    axis (or axes).
+    """
+    if not isstr(ctype):
+        raise TypeError("ctype must be a of type str")
+        
+    # validate input
+    if ctype != 's' and ctype != 'sum' and \
+        ctype != 'r' and ctype != 'rotate' and  \
+        ctype != 'i' and ctype != 'incommensurate':
+        raise ValueError("Invalid calculation type.")
+    ctype = ctype[0]
+    
+    # if 'i', nangles must be defined
+    if ctype == 'r' and angles is not None:
+        try:
+            nangles = np.radians(np.array(angles, dtype=np.float64)).reshape(-1)
+        except:
+            raise ValueError("Cannot convert angles to np.ndarray.")
+    elif ctype == 'i' or ctype == 'r':
+        if nangles is None:
+            raise ValueError("Number of angles must be specified.")
+        try:
+            nangles  = int(nangles)
+        except:
+            raise ValueError("Cannot convert number of angles to int.")
+    if ctype == 'r':
+        if axis is None:
+            raise ValueError("Axis for rotation must be specified.")
+        try:
+            axis = np.array(axis, dtype=np.float64)
+            axis = axis/np.linalg.norm(axis, axis=-1, keepdims=True)
+        except:
+            raise ValueError("Cannot convert axis for rotation to np.ndarray.")
+        if axis.shape[-1] != 3 or axis.ndim > 2:
+            raise ValueError("Axis for rotation must have shape (3,) or (natoms,3).")
     
-    for mu in sample.muons:
+    return ctype, nangles, axis
+
+
+def _parse_contact_args(nnn, rcont):
+    """
+    Validates the options of the contact field estimation.
+    """
+    try:
+        nnn = int(nnn)
+    except:
+        raise TypeError("Cannot convert nnn to int.")
+        
+    if nnn<0:
+        raise ValueError("nnn must be positive.")
     
-        distances = []
+    rc=0
+    try:
+        rc = float(rcont)
+    except:
+        raise TypeError("Cannot convert rcont to float.")
         
-        # muon position in Cartesian coordnates
-        mup = np.dot((mu + np.floor(np.array(supercell,dtype=np.float64)/2.))/np.array(supercell,dtype=np.float64), scell)
-        # define planes using point and normal vector
+    if rc<0:
+        raise ValueError("rcont must be positive.")
+    
+    return nnn, rc
+
+
+def _parse_supercell(supercellsize):
+    """
+    Validates the supercell size. None, i.e. automatic selection of
+    the supercell, is returned unchanged.
+    """
+    if supercellsize is None:
+        return None
+    
+    try:
+        sc = np.array(supercellsize, dtype=np.int32)
+    except:
+        raise TypeError("Cannot convert supercellsize to NumPy array.")
+
+    if (np.min(sc) <= 0):
+        raise ValueError("Supercellsize must be strictly positive.")
+
         
-        for i,j,k in [[1,1,0],[1,0,1],[0,1,1]]:
-            
-            p1 = float(i)*scell[0,:]
-            p2 = float(j)*scell[1,:]
-            p3 = float(k)*scell[2,:]
-            # parallel plane shifted by one lattice vector
-            sp = float(1-i)*scell[0,:] + float(1-j)*scell[1,:] + float(1-k)*scell[2,:]
-            
-            
-            n = np.cross((p2-p1),(p3-p1))
-            n /= np.linalg.norm(n)
-            # r = p1 , is included in the formula below.
-            
-            D = np.dot(n,mup-p1)
-            distances.append(np.abs(D))
-            
-            # plane shifted by one lattice vector
-            D = np.dot(n,mup-p1-sp)
-            distances.append(np.abs(D))
+    if sc.shape != (3,):
+        raise ValueError("Propagation vector has the wrong shape.")
+    
+    return sc
 
-    #nprint("WARNING: this is and experimental function!",'warn')
-    return np.min(distances)
+
+def _sphere_frame(p, mus, phi, k, ctype, radius, latpar):
+    """
+    Selects the smallest supercell containing the sphere of radius 
+    `radius` around all the muon sites `mus`.
+    Returns the supercell size together with the muon positions and the
+    phases to be used with it. The phases are shifted so that the 
+    magnetic structure is always referred to the unit cell at the 
+    origin, independently of the supercell.
+    """
+    origin, sc = nplfc.sphere_supercell(p, mus, radius, latpar)
+    F = np.floor(sc / 2.)
+    mus = mus - origin - F
+    # in 'i' simulations lfclib also measures the angles from a phase 
+    # which depends on the position of the muon in the supercell.
+    phi = phi + np.dot(k, F if ctype == 'i' else origin)
+    return sc, mus, phi
+
+
+def _parse_locfield_args(ctype, supercellsize, radius, nnn, rcont,
+                         nangles, axis, angles=None):
+    """
+    Validates the options of the local field calculations.
+    Returns the one letter calculation type followed by the converted
+    values of the other arguments.
+    """
+    ctype, nangles, axis = _parse_ctype_args(ctype, nangles, axis, angles)
     
-def locfield(sample, ctype, supercellsize, radius, nnn = 2, rcont = 10.0, nangles = None, axis = None):
+    sc = _parse_supercell(supercellsize)
+    
+    try:
+        r= float(radius) # Lorentz radius (in A)
+    except:
+        raise TypeError("Cannot convert radius to float.")
+    
+    nnn, rc = _parse_contact_args(nnn, rcont)
+    
+    return ctype, sc, r, nnn, rc, nangles, axis
+
+
+def _magnetic_atoms(ufc):
+    """
+    Returns the indexes of the atoms with non null Fourier components.
+    """
+    magnetic_atoms=[]
+    for i, e in enumerate(ufc):
+        if not np.allclose(e,np.zeros(3,dtype=np.complex128)):
+            magnetic_atoms.append(i)
+    return magnetic_atoms
+
+
+def _magnetic_sublattice(sample):
+    """
+    Returns the fractional positions, the Fourier components and the 
+    phases of the magnetic atoms of the current magnetic model, 
+    together with its propagation vector.
+    Non magnetic atoms, i.e. atoms with null Fourier components, are
+    removed.
+    """
+    positions = sample.snapshot().positions
+    
+    ufc = sample.mm.fc_view()
+    
+    magnetic_atoms = _magnetic_atoms(ufc)
+
+    p = positions[magnetic_atoms,:]
+    fc = ufc[magnetic_atoms,:]
+    phi = sample.mm.phi[magnetic_atoms] # phase in magnetic order definition
+    k = sample.mm.k
+    
+    return p, fc, phi, k
+
+
+def _rotation_axes(sample, axis, ufc=None):
+    """
+    Returns the rotation axis of 'rotate' calculations. When an axis
+    is given for each atom of the cell, only those of the magnetic 
+    atoms are returned.
+    """
+    if axis is None or axis.ndim == 1:
+        return axis
+    
+    if ufc is None:
+        ufc = sample.mm.fc_view()
+    if axis.shape[0] != len(ufc):
+        raise ValueError("One rotation axis for each atom must be specified.")
+    return axis[_magnetic_atoms(ufc)]
+
+
+def _muon_positions(sample, positions, cartesian):
+    """
+    Returns an (N,3) array of muon positions in fractional coordinates.
+    If `positions` is None, the muon sites defined in the sample are used.
+    """
+    if positions is None:
+        sample._check_muon()
+        return sample.snapshot().muons
+    
+    try:
+        positions = np.array(positions, dtype=np.float64)
+    except:
+        raise TypeError("Cannot convert positions to NumPy array.")
+    
+    if positions.ndim == 1:
+        positions = positions.reshape(1, -1)
+    if positions.ndim != 2 or positions.shape[1] != 3:
+        raise ValueError("Muon positions must have shape (N,3).")
+    
+    if cartesian:
+        positions = np.dot(positions, np.linalg.inv(sample._cell.get_cell()))
+    
+    return positions
+
+
+def _site_orbits(sample, points, k=None, magnetic=True):
+    """
+    Groups the muon sites `points` in orbits of the magnetic symmetry
+    of the sample (or of the symmetry of the magnetic sublattice if
+    `magnetic` is False).
+    Returns the index of the representative of each site and the
+    Cartesian rotations (with the sign of the transformation of axial
+    vectors) mapping the representative on the site.
+    """
+    if magnetic:
+        rot, trans, tr = magnetic_operations(sample)
+    else:
+        rot, trans = sublattice_operations(sample,
+                                           _magnetic_atoms(sample.mm.fc_view()))
+        tr = np.ones(len(rot))
+    rep, op = site_orbits(points, rot, trans, k)
+
+    Rc = cartesian_rotations(rot, sample._cell.get_cell())
+    sign = tr * np.round(np.linalg.det(rot))
+    # representatives are not transformed
+    Rc = np.concatenate([Rc, np.eye(3)[None, :, :]])
+    sign = np.append(sign, 1.)
+    return rep, Rc[op], sign[op]
+
+
+def _locfield_site(a, i, ctype, sc, r, nnn, rc, nangles, axis):
+    """
+    Local fields at the i-th muon site of a['muons'].
+    """
+    mu = a['muons'][i]
+    phi = a['phi']
+    if sc is None:
+        radius = max(r, rc) if nnn > 0 else r
+        sc, mu, phi = _sphere_frame(a['p'], mu, phi, a['k'], ctype, radius,
+                                    a['latpar'])
+    args = (a['p'], a['fc'], a['k'], phi, mu, sc, a['latpar'], r, nnn, rc)
+    if ctype == 's':
+        return lfcext.Fields(ctype, *args)
+    elif ctype == 'i':
+        return lfcext.Fields(ctype, *args, nangles)
+    # rotated moments are a linear combination of three sets of
+    # Fourier components: a single lattice sum is needed.
+    return nplfc.Fields(ctype, *args, nangles, axis)
+
+
+def locfield(sample, ctype, supercellsize, radius, nnn = 2, rcont = 10.0, nangles = None, axis = None, angles = None, workers = None, symmetry = False):
     """
     Evaluates local fields at the muon site.
     
@@ -240,18 +577,23 @@ def locfield(sample, ctype, supercellsize, radius, nnn = 2, rcont = 10.0, nangle
     
         * 'sum': magnetic moments are just summed up to the Lorentz sphere
         * 'rotate': magnetic moments are rotate `nangles` times around the `axis` axis.
+          The fields are obtained from a single lattice sum, since they
+          depend linearly on the rotated moments.
         * 'incommensurate': this function is particulary useful for 
           incommensurate structures. It performs the sum with the method discussed in PRB XX XXXXXX
                             
     
     :param sample: the sample object
     :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
-    :param list supercellsize: the size of the supercell along the lattice coordinates.
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) is chosen for each muon site and the magnetic structure is referred to the unit cell at the origin.
     :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
     :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
     :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
     :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
-    :param list axis: for 'rotate' simulations, axis used to perform the rotation. In 'incommensurate' simulations the axis is defined as the perpendicular vector to the real and the imaginary parts of the fourier componts (warnings will be printed if this vector is not well defined).
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell. In 'incommensurate' simulations the axis is defined as the perpendicular vector to the real and the imaginary parts of the fourier componts (warnings will be printed if this vector is not well defined).
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :param int workers: number of processes used to evaluate the muon sites. Results are identical to the serial execution. Without shared memory (Python < 3.8) the evaluation is serial and a warning is issued. Default None, i.e. serial execution.
+    :param bool symmetry: for 'sum' simulations, evaluate only one muon site for each set of sites equivalent under the magnetic symmetry of the sample (see :py:func:`~muesr.core.magsym.magnetic_operations`) and obtain the fields at the other sites by symmetry. Ignored if the symmetry of the sample is not defined. Default False.
     :return: a list of :py:class:`~LocalFields` containing the local field components for each muon site defined in the sample.
     :rtype: list
     :raises: TypeError, ValueError
@@ -262,107 +604,790 @@ def locfield(sample, ctype, supercellsize, radius, nnn = 2, rcont = 10.0, nangle
     if not isinstance(sample, Sample):
         raise TypeError("sample must be a Sample instance.")
     
+    ctype, sc, r, nnn, rc, nangles, axis = _parse_locfield_args(ctype, 
+                                                supercellsize, radius,
+                                                nnn, rcont, nangles, axis,
+                                                angles)
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    # Remove non magnetic atoms from list
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    
+    axis = _rotation_axes(sample, axis)
+    
+    sample._check_muon()
+    muons = sample.snapshot().muons
+    rep = np.arange(len(muons))
+    if symmetry and ctype == 's' and sample._sym is not None:
+        # fields are evaluated at mu + floor(sc/2) in the supercell
+        center = np.zeros(3) if sc is None else np.floor(sc / 2.)
+        rep, R, sign = _site_orbits(sample, muons + center, k)
+    reps, inverse = np.unique(rep, return_inverse=True)
+    
+    arrays = {'p': p, 'fc': fc, 'k': k, 'phi': phi, 'latpar': latpar,
+              'muons': muons[reps]}
+    res = map_sites(_locfield_site, arrays, len(reps),
+                    (ctype, sc, r, nnn, rc, nangles, axis), workers)
+    
+    if len(reps) == len(muons):
+        return [LocalFields(*f) for f in res]
+    
+    # fields are axial vectors
+    return [LocalFields(*[s * np.dot(m, B) for B in res[j]])
+            for j, m, s in zip(inverse, R, sign)]
 
-    if not isstr(ctype):
-        raise TypeError("ctype must be a of type str")
-        
-    # validate input
-    if ctype != 's' and ctype != 'sum' and \
-        ctype != 'r' and ctype != 'rotate' and  \
-        ctype != 'i' and ctype != 'incommmensurate':
-        raise ValueError("Invalid calculation type.")
+
+def _locfield_adaptive_site(a, i, ctype, r, step, rmax, tol, nnn, rc,
+                            nangles, axis):
+    """
+    Converged local fields at the i-th muon site of a['muons'].
+    """
+    return nplfc.AdaptiveFields(ctype, a['p'], a['fc'], a['k'], a['phi'],
+                                a['muons'][i], a['latpar'], r, step, rmax,
+                                tol, nnn, rc, nangles, axis)
+
+
+def locfield_adaptive(sample, ctype, tolerance, radius = 10.0, step = None, max_radius = 200.0, nnn = 2, rcont = 10.0, nangles = None, axis = None, angles = None, workers = None):
+    """
+    Evaluates local fields at the muon sites increasing the radius of
+    the Lorentz sphere until convergence.
     
-    # if 'i', nangles must be defined
-    if ctype == 'i' or ctype == 'incommmensurate' or \
-        ctype == 'r' or ctype == 'rotate':
-        if nangles is None:
-            raise ValueError("Number of angles must be specified.")
+    For each muon site the sums are first performed in a sphere of 
+    radius `radius`, which is then grown in spherical shells of 
+    thickness `step`. The sums of the inner sphere are reused and
+    only the moments in the new shell are evaluated. The iterations
+    stop when the dipolar and the Lorentz fields change by less than
+    `tolerance` in two consecutive shells.
+    The radius reached and the error estimate are available from the 
+    :py:attr:`~LocalFields.radius` and :py:attr:`~LocalFields.error`
+    properties of the results.
+    
+    The smallest supercell containing the spheres is used, and the 
+    magnetic structure is referred to the unit cell at the origin
+    (see :py:func:`~locfield` with supercellsize None).
+    
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param float tolerance: convergence threshold for the dipolar and the Lorentz fields in Tesla.
+    :param float radius: initial radius of the Lorentz sphere in Angstrom. Default 10 Angstrom.
+    :param float step: increment of the radius in Angstrom. Default None, i.e. the length of the longest lattice vector.
+    :param float max_radius: maximum radius of the Lorentz sphere in Angstrom. Default 200 Angstrom.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :param int workers: number of processes used to evaluate the muon sites. Without shared memory (Python < 3.8) the evaluation is serial and a warning is issued. Default None, i.e. serial execution.
+    :return: a list of :py:class:`~LocalFields` containing the local field components for each muon site defined in the sample.
+    :rtype: list
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    ctype, _, r, nnn, rc, nangles, axis = _parse_locfield_args(ctype, 
+                                                None, radius, nnn, rcont,
+                                                nangles, axis, angles)
+    
+    try:
+        tol = float(tolerance)
+        rmax = float(max_radius)
+    except:
+        raise TypeError("Cannot convert tolerance or max_radius to float.")
+    
+    if tol <= 0:
+        raise ValueError("tolerance must be strictly positive.")
+    if r <= 0:
+        raise ValueError("Lorentz radius must be strictly positive.")
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    latpar = sample._cell.get_cell()
+    
+    if step is None:
+        step = np.max(np.linalg.norm(latpar, axis=1))
+    try:
+        step = float(step)
+    except:
+        raise TypeError("Cannot convert step to float.")
+    if step <= 0:
+        raise ValueError("step must be strictly positive.")
+    
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    axis = _rotation_axes(sample, axis)
+    
+    arrays = {'p': p, 'fc': fc, 'k': k, 'phi': phi, 'latpar': latpar,
+              'muons': _muon_positions(sample, None, False)}
+    res = map_sites(_locfield_adaptive_site, arrays, len(arrays['muons']),
+                    (ctype, r, step, rmax, tol, nnn, rc, nangles, axis),
+                    workers)
+    
+    if any(f[4] >= tol for f in res):
+        warnings.warn("Local fields not converged within max_radius.",
+                      RuntimeWarning)
+    
+    return [LocalFields(c, d, l, radius=rad, error=err)
+            for c, d, l, rad, err in res]
+
+
+def locfield_batch(sample, ctype, supercellsize, radius, nnn = 2, rcont = 10.0, nangles = None, axis = None, positions = None, cartesian = False, angles = None, block_size = nplfc.BLOCK_SIZE):
+    """
+    Evaluates local fields at many muon sites at once.
+    
+    Same as :py:func:`~locfield`, but the lattice is enumerated a 
+    single time and the sums for all the sites are evaluated together
+    using the vectorized routines of :py:mod:`muesr.engines.nplfc`.
+    This is much faster than :py:func:`~locfield` when thousands of 
+    sites are considered.
+    
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) around all the sites is chosen and the magnetic structure is referred to the unit cell at the origin.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once, which bounds the memory used by the sums (about 250 bytes per pair). Results do not depend on it. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: a :py:class:`~LocalFields` object containing arrays of shape (N,3) for 'sum' simulations or (N,nangles,3) for 'rotate' and 'incommensurate' simulations.
+    :rtype: :py:class:`~LocalFields`
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    ctype, sc, r, nnn, rc, nangles, axis = _parse_locfield_args(ctype, 
+                                                supercellsize, radius,
+                                                nnn, rcont, nangles, axis,
+                                                angles)
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    mus = _muon_positions(sample, positions, cartesian)
+    
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    axis = _rotation_axes(sample, axis)
+    
+    if sc is None:
+        radius = max(r, rc) if nnn > 0 else r
+        sc, mus, phi = _sphere_frame(p, mus, phi, k, ctype, radius, latpar)
+    
+    # the neighbour index is stored in the sample and reused
+    neighbours = None
+    if nnn > 0 and rc > 0:
+        neighbours = neighbour_index(sample, rc).subset(
+                                        _magnetic_atoms(sample.mm.fc_view()))
+    
+    return LocalFields(*nplfc.Fields(ctype, p, fc, k, phi, mus, sc, latpar,
+                                     r, nnn, rc, nangles, axis, block_size,
+                                     neighbours))
+
+
+def _parse_models(sample, models):
+    """
+    Returns the list of magnetic models given by indexes of the models of
+    the sample or by model objects. If `models` is None, all the models
+    of the sample are returned.
+    """
+    if models is None:
+        sample._check_magdefs()
+        return list(sample._magdefs)
+    
+    mms = []
+    for m in models:
+        if isinstance(m, MM):
+            mms.append(m)
+            continue
         try:
-            nangles  = int(nangles)
+            m = int(m)
         except:
-            raise ValueError("Cannot convert number of angles to int.")
-    if ctype == 'r' or ctype == 'rotate':
-        if axis is None:
-            raise ValueError("Axis for rotation must be specified.")
+            raise TypeError("Models must be indexes or magnetic models.")
+        if m < 0 or m >= len(sample._magdefs):
+            raise IndexError('Only %d magnetic structures defined' % len(sample._magdefs))
+        mms.append(sample._magdefs[m])
+    if len(mms) == 0:
+        raise ValueError("No magnetic models given.")
+    return mms
+
+
+def locfield_models(sample, ctype, supercellsize, radius, models = None, weights = None, nnn = 2, rcont = 10.0, nangles = None, axis = None, angles = None, positions = None, cartesian = False, block_size = nplfc.BLOCK_SIZE):
+    """
+    Evaluates the local fields of many magnetic models in a single pass 
+    over the supercell.
+    
+    This is useful for multi-domain magnets, where a model is defined for
+    each domain or arm of the star of the propagation vector. The models 
+    can have different propagation vectors and magnetic atoms. The 
+    replicas of the atoms and their distances from the muons are 
+    computed once and shared by all the models.
+    Each model gives the same results of :py:func:`~locfield_batch`.
+    
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) around all the sites is chosen and the magnetic structures are referred to the unit cell at the origin.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param list models: the magnetic models, as indexes of the models of the sample or as :py:class:`~muesr.core.magmodel.MM` objects. Default None, i.e. all the models of the sample.
+    :param list weights: populations of the models. If given, the fields are averaged over the models with these weights, normalized to one. Default None.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once. Results do not depend on it. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: a :py:class:`~LocalFields` object containing arrays of shape (nmodels,N,3) for 'sum' simulations or (nmodels,N,nangles,3) for 'rotate' and 'incommensurate' simulations. If `weights` is given, the first dimension is removed by the average.
+    :rtype: :py:class:`~LocalFields`
+    :raises: TypeError, ValueError, IndexError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    ctype, sc, r, nnn, rc, nangles, axis = _parse_locfield_args(ctype, 
+                                                supercellsize, radius,
+                                                nnn, rcont, nangles, axis,
+                                                angles)
+    
+    # check current status is ok
+    sample._check_lattice()
+    mms = _parse_models(sample, models)
+    
+    if weights is not None:
         try:
-            axis = np.array(axis)
-            axis = axis/np.linalg.norm(axis)
+            weights = np.array(weights, dtype=np.float64).reshape(-1)
         except:
-            raise ValueError("Cannot convert axis for rotation to np.ndarray.")
+            raise TypeError("Cannot convert weights to NumPy array.")
+        if len(weights) != len(mms):
+            raise ValueError("One weight for each model must be given.")
+        if np.any(weights < 0) or not np.sum(weights) > 0:
+            raise ValueError("Weights must be positive.")
+        weights = weights / np.sum(weights)
+    
+    mus = _muon_positions(sample, positions, cartesian)
+    
+    latpar = sample._cell.get_cell()
+    natoms = sample._cell.get_number_of_atoms()
+    
+    # the atoms magnetic in any of the models
+    magnetic = [_magnetic_atoms(mm.fc_view()) for mm in mms]
+    if any(mm.size != natoms for mm in mms):
+        raise ValueError("Magnetic models and cell have different number of atoms.")
+    union = sorted(set().union(*magnetic))
+    
+    p = sample._cell.get_scaled_positions()[union]
+    fc = np.zeros([len(mms), len(union), 3], dtype=np.complex128)
+    for m, (mm, atoms) in enumerate(zip(mms, magnetic)):
+        fc[m, np.searchsorted(union, atoms)] = mm.fc_view()[atoms]
+    phi = np.array([mm.phi[union] for mm in mms])
+    k = np.array([mm.k for mm in mms])
+    
+    if axis is not None and axis.ndim == 2:
+        if axis.shape[0] != natoms:
+            raise ValueError("One rotation axis for each atom must be specified.")
+        axis = axis[union]
+    
+    if sc is None:
+        radius = max(r, rc) if nnn > 0 else r
+        for m in range(len(mms)):
+            sc, mus_m, phi[m] = _sphere_frame(p, mus, phi[m], k[m], ctype,
+                                              radius, latpar)
+        mus = mus_m
+    
+    neighbours = None
+    if nnn > 0 and rc > 0:
+        index = neighbour_index(sample, rc)
+        neighbours = [index.subset(atoms) for atoms in magnetic]
+    
+    res = nplfc.ModelFields(ctype, p, fc, k, phi, mus, sc, latpar, r, nnn,
+                            rc, nangles, axis, block_size, neighbours)
+    if weights is not None:
+        res = [np.tensordot(weights, B, axes=1) for B in res]
+    return LocalFields(*res)
+
+
+def locfield_kscan(sample, ctype, supercellsize, radius, kvectors, nnn = 2, rcont = 10.0, nangles = None, axis = None, angles = None, positions = None, cartesian = False, block_size = nplfc.BLOCK_SIZE):
+    """
+    Evaluates the local fields of the current magnetic model for many
+    propagation vectors.
+    
+    Only the phases of the moments depend on the propagation vector: the
+    replicas of the atoms, their distances from the muons and the 
+    dipolar kernels are computed once, in a single pass over the 
+    supercell, and the sums over the lattice translations are evaluated
+    for all the propagation vectors with a matrix product (see
+    :py:func:`~muesr.engines.nplfc.KScanFields`). The Fourier components
+    and the phases of the current model are used, and the model is not
+    changed. Each propagation vector gives the same results of 
+    :py:func:`~locfield_batch`.
+    
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) around all the sites is chosen and the magnetic structure is referred to the unit cell at the origin.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param kvectors: (nk,3) array of propagation vectors in reciprocal lattice units.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once, for all the propagation vectors. Results do not depend on it. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: a :py:class:`~LocalFields` object containing arrays of shape (nk,N,3) for 'sum' simulations or (nk,N,nangles,3) for 'rotate' and 'incommensurate' simulations.
+    :rtype: :py:class:`~LocalFields`
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    ctype, sc, r, nnn, rc, nangles, axis = _parse_locfield_args(ctype, 
+                                                supercellsize, radius,
+                                                nnn, rcont, nangles, axis,
+                                                angles)
     
     try:
-        sc = np.array(supercellsize, dtype=np.int32)
+        kvectors = np.array(kvectors, dtype=np.float64)
     except:
-        raise TypeError("Cannot convert supercellsize to NumPy array.")
+        raise TypeError("Cannot convert kvectors to NumPy array.")
+    if kvectors.ndim == 1:
+        kvectors = kvectors.reshape(1, -1)
+    if kvectors.ndim != 2 or kvectors.shape[1] != 3 or len(kvectors) == 0:
+        raise ValueError("kvectors must have shape (nk,3).")
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    mus = _muon_positions(sample, positions, cartesian)
+    
+    latpar = sample._cell.get_cell()
+    p, fc, phi, _ = _magnetic_sublattice(sample)
+    axis = _rotation_axes(sample, axis)
+    
+    offset = None
+    if sc is None:
+        # same frame of _sphere_frame, the shift of the phases depends 
+        # on k and is applied to the lattice translations
+        radius = max(r, rc) if nnn > 0 else r
+        origin, sc = nplfc.sphere_supercell(p, mus, radius, latpar)
+        F = np.floor(sc / 2.)
+        mus = mus - origin - F
+        offset = F if ctype == 'i' else origin
+    
+    neighbours = None
+    if nnn > 0 and rc > 0:
+        neighbours = neighbour_index(sample, rc).subset(
+                                        _magnetic_atoms(sample.mm.fc_view()))
+    
+    return LocalFields(*nplfc.KScanFields(ctype, p, fc, kvectors, phi, mus,
+                                          sc, latpar, r, nnn, rc, nangles,
+                                          axis, block_size, neighbours,
+                                          offset))
 
-    if (np.min(sc) <= 0):
-        raise ValueError("Supercellsize must be strictly positive.")
 
-        
-    if sc.shape != (3,):
-        raise ValueError("Propagation vector has the wrong shape.")
+def locfield_gradient(sample, supercellsize, radius, nnn = 2, rcont = 10.0, positions = None, cartesian = False, block_size = nplfc.BLOCK_SIZE):
+    """
+    Evaluates the local fields at the muon sites and their derivatives
+    with respect to the muon position.
+    
+    The fields are those of 'sum' simulations (see :py:func:`~locfield_batch`).
+    The Jacobians :math:`J_{ij} = \\partial B_i / \\partial x_j`, with 
+    :math:`x` the Cartesian position of the muon, are obtained in the 
+    same pass over the supercell from the analytic derivatives of the 
+    dipolar interaction and of the weights of the contact field.
+    The Lorentz field does not depend on the muon position, as long as
+    no moment crosses the surface of the Lorentz sphere.
+    
+    :param sample: the sample object
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) around all the sites is chosen.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once. Results do not depend on it. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: two :py:class:`~LocalFields` objects: the fields, with arrays of shape (N,3) in Tesla, and their Jacobians, with arrays of shape (N,3,3) in Tesla/Angstrom. The contact coupling ACont must be set on both.
+    :rtype: tuple
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    _, sc, r, nnn, rc, _, _ = _parse_locfield_args('s', supercellsize,
+                                                   radius, nnn, rcont,
+                                                   None, None)
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    mus = _muon_positions(sample, positions, cartesian)
+    
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    
+    if sc is None:
+        radius = max(r, rc) if nnn > 0 else r
+        sc, mus, phi = _sphere_frame(p, mus, phi, k, 's', radius, latpar)
+    
+    neighbours = None
+    if nnn > 0 and rc > 0:
+        neighbours = neighbour_index(sample, rc).subset(
+                                        _magnetic_atoms(sample.mm.fc_view()))
+    
+    BC, BD, BL, GC, GD = nplfc.FieldGradients(p, fc, k, phi, mus, sc, latpar,
+                                              r, nnn, rc, block_size,
+                                              neighbours)
+    return LocalFields(BC, BD, BL), LocalFields(GC, GD, np.zeros_like(GD))
+
+
+def _zpm_displacements(nmu, covariance, displacements, nsamples, seed):
+    """
+    Cartesian displacements, of shape (nmu, S, 3), used to average the
+    fields. Gaussian displacements are drawn in pairs of opposite
+    vectors, so that their mean is null.
+    """
+    if (covariance is None) == (displacements is None):
+        raise ValueError("One of covariance and displacements must be given.")
+    
+    if displacements is not None:
+        try:
+            disp = np.array(displacements, dtype=np.float64)
+        except:
+            raise TypeError("Cannot convert displacements to NumPy array.")
+        if disp.ndim == 2:
+            disp = np.broadcast_to(disp, (nmu,) + disp.shape)
+        if disp.ndim != 3 or disp.shape[0] != nmu or disp.shape[2] != 3 \
+                or disp.shape[1] == 0:
+            raise ValueError("displacements must have shape (S,3) or (N,S,3).")
+        return disp
     
     try:
-        r= float(radius) # Lorentz radius (in A)
+        cov = np.array(covariance, dtype=np.float64)
     except:
-        raise TypeError("Cannot convert radius to float.")
+        raise TypeError("Cannot convert covariance to NumPy array.")
+    if cov.ndim == 2:
+        cov = np.broadcast_to(cov, (nmu, 3, 3))
+    if cov.shape != (nmu, 3, 3):
+        raise ValueError("covariance must have shape (3,3) or (N,3,3).")
+    if not np.allclose(cov, cov.transpose(0, 2, 1)):
+        raise ValueError("covariance must be symmetric.")
+    w, v = np.linalg.eigh(cov)
+    if np.any(w < -1e-10 * max(1., np.abs(w).max())):
+        raise ValueError("covariance must be positive semi-definite.")
     
     try:
-        nnn = int(nnn)
+        nsamples = int(nsamples)
     except:
-        raise TypeError("Cannot convert nnn to int.")
-        
-    if nnn<0:
-        raise ValueError("nnn must be positive.")
+        raise TypeError("Cannot convert nsamples to int.")
+    if nsamples <= 0:
+        raise ValueError("nsamples must be strictly positive.")
     
-    rc=0
+    rng = np.random.RandomState(seed)
+    x = rng.standard_normal([nmu, (nsamples + 1) // 2, 3])
+    x = np.einsum('mij,mj,msj->msi', v, np.sqrt(np.maximum(w, 0.)), x)
+    return np.concatenate([x, -x], axis=1)
+
+
+def locfield_zpm(sample, ctype, supercellsize, radius, covariance = None, displacements = None, nsamples = 200, seed = None, rnear = 6.0, nnn = 2, rcont = 10.0, nangles = None, axis = None, angles = None, positions = None, cartesian = False, block_size = nplfc.BLOCK_SIZE):
+    """
+    Evaluates the local fields averaged over the zero point motion of 
+    the muon.
+    
+    The fields are evaluated at many points displaced from each muon 
+    site, either drawn from a Gaussian distribution with the given 
+    covariance or given explicitly, and averaged. All the displaced 
+    points are evaluated in a single pass over the supercell: the 
+    Lorentz sphere stays centred at the muon site, the moments closer 
+    than `rnear` to the site are summed exactly at each point, and the 
+    smooth field of the farther moments is evaluated once, together with 
+    its gradient, and expanded to first order in the displacement.
+    
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) around all the displaced points is chosen.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param covariance: (3,3) or (N,3,3) covariance of the Gaussian displacements in Cartesian coordinates, in Angstrom^2, for all the sites or for each site. Pairs of opposite displacements are drawn.
+    :param displacements: (S,3) or (N,S,3) array of Cartesian displacements in Angstrom, used instead of the Gaussian ones. Exactly one of `covariance` and `displacements` must be given.
+    :param int nsamples: number of Gaussian displacements for each site, rounded up to an even number. Default 200.
+    :param int seed: seed of the Gaussian displacements. Default None.
+    :param float rnear: radius, in Angstrom, of the sphere of moments whose field is summed exactly at each displaced point. It should be much larger than the displacements. Default 6 Angstrom.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once, counting each displaced point. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: a :py:class:`~LocalFields` object containing the average fields, with arrays of shape (N,3) for 'sum' simulations or (N,nangles,3) for 'rotate' and 'incommensurate' simulations, and their variances (see :py:attr:`~LocalFields.variance`).
+    :rtype: :py:class:`~LocalFields`
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    ctype, sc, r, nnn, rc, nangles, axis = _parse_locfield_args(ctype, 
+                                                supercellsize, radius,
+                                                nnn, rcont, nangles, axis,
+                                                angles)
     try:
-        rc = float(rcont)
+        rnear = float(rnear)
     except:
-        raise TypeError("Cannot convert rcont to float.")
-        
-    if rc<0:
-        raise ValueError("rcont must be positive.")
+        raise TypeError("Cannot convert rnear to float.")
+    if rnear < 0:
+        raise ValueError("rnear must be positive.")
     
     # check current status is ok
     sample._check_lattice()
     sample._check_magdefs()
     
-    # Remove non magnetic atoms from list
-
-    unitcell = sample._cell
-    positions = unitcell.get_scaled_positions()
-    latpar = unitcell.get_cell()
+    mus = _muon_positions(sample, positions, cartesian)
+    disp = _zpm_displacements(len(mus), covariance, displacements,
+                              nsamples, seed)
     
-    ufc = sample.mm.fc
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    axis = _rotation_axes(sample, axis)
     
+    if sc is None:
+        # the contact field is evaluated at the displaced points
+        umax = np.max(np.linalg.norm(disp, axis=2))
+        radius = max(r, rc + umax) if nnn > 0 else r
+        sc, mus, phi = _sphere_frame(p, mus, phi, k, ctype, radius, latpar)
     
-    magnetic_atoms=[]
-    for i, e in enumerate(ufc):
-        if not np.allclose(e,np.zeros(3,dtype=np.complex128)):
-            magnetic_atoms.append(i)
+    neighbours = None
+    if nnn > 0 and rc > 0:
+        neighbours = neighbour_index(sample, rc).subset(
+                                        _magnetic_atoms(sample.mm.fc_view()))
+    
+    BC, BD, BL = nplfc.DisplacedFields(ctype, p, fc, k, phi, mus, sc, latpar,
+                                       r, nnn, rc, disp, rnear, nangles,
+                                       axis, block_size, neighbours)
+    
+    # the Lorentz field is the same for all the displacements
+    BO = BD + BL
+    dC = BC - BC.mean(axis=1)[:, None]
+    dO = BO - BO.mean(axis=1)[:, None]
+    moments = (np.mean(dC * dC, axis=1), np.mean(dC * dO, axis=1),
+               np.mean(dO * dO, axis=1))
+    return LocalFields(BC.mean(axis=1), BD.mean(axis=1), BL[:, 0].copy(),
+                       moments=moments)
 
-    p = positions[magnetic_atoms,:]
-    fc = ufc[magnetic_atoms,:]
-    phi = sample.mm.phi[magnetic_atoms] # phase in magnetic order definition
-    k = sample.mm.k  
+
+def _histogram_amplitudes(a, i, sc, r, nnn, rc, acont, block_size):
+    """
+    Complex amplitudes of the total field, and the phases from which
+    the angles are measured, at the i-th chunk of muon sites.
+    The neighbour index of the contact field, if any, is rebuilt from
+    the shared arrays.
+    """
+    mus = a['muons'][a['bounds'][i]:a['bounds'][i + 1]]
+    neighbours = None
+    if 'nb_scalars' in a:
+        neighbours = PeriodicNeighbours.from_arrays(a, 'nb_')
+    phi = a['phi']
+    if sc is None:
+        radius = max(r, rc) if nnn > 0 else r
+        sc, mus, phi = _sphere_frame(a['p'], mus, phi, a['k'], 'i', radius,
+                                     a['latpar'])
+    BC, BD, BL, alpha = nplfc.ComplexFields(a['p'], a['fc'], a['k'], phi,
+                                            mus, sc, a['latpar'], r, nnn, rc,
+                                            block_size, neighbours)
+    return acont * BC + BD + BL, alpha
+
+
+def _histogram_chunk(a, i, bins, bmax, nangles, block_size):
+    """
+    Histogram of the fields at all the angles of the i-th chunk of
+    muon sites. The angles are evaluated a few at a time.
+    """
+    sl = slice(a['bounds'][i], a['bounds'][i + 1])
+    B, alpha, w = a['B'][sl], a['alpha'][sl], a['weights'][sl]
     
+    hist = FieldHistogram(bins, bmax)
+    angles = nplfc.rotation_angles(nangles)
+    step = max(1, block_size // max(1, len(B)))
+    for start in range(0, len(angles), step):
+        rot = np.exp(1.j * (alpha[:, None] - angles[None, start:start + step]))
+        hist.add(np.real(B[:, None, :] * rot[:, :, None]), w[:, None])
+    return hist
+
 
+def locfield_histogram(sample, supercellsize, radius, nangles, bins = 100, bmax = None, ACont = 0., nnn = 2, rcont = 10.0, positions = None, cartesian = False, weights = None, workers = None, block_size = nplfc.BLOCK_SIZE):
+    """
+    Evaluates the distribution of the local fields of an incommensurate
+    structure.
+    
+    The fields of 'incommensurate' simulations (see :py:func:`~locfield`)
+    at all the muon sites and at `nangles` angles are binned as they 
+    are computed, without storing them. The total field 
+    :math:`\\mathbf{B}_L + \\mathbf{B}_D + \\mathrm{ACont} \\cdot \\mathbf{B}_C`
+    of each site is an ellipse in the angle, and only its complex 
+    amplitude is kept in memory.
+    
+    :param sample: the sample object
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` (and `rcont`) is chosen.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param int nangles: number of angles (equally spaced in the full turn) evaluated for each site.
+    :param int bins: number of bins of the histograms. Default 100.
+    :param float bmax: largest field of the bins, in Tesla. Default None, i.e. the largest field of all the sites.
+    :param float ACont: contact hyperfine coupling of the total field (see :py:class:`~LocalFields`). Default 0.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param weights: weight of each muon site, e.g. its multiplicity when only the inequivalent sites are given. Default None, i.e. one.
+    :param int workers: number of processes used to evaluate the muon sites. The histograms of the processes are merged. Without shared memory (Python < 3.8) the evaluation is serial and a warning is issued. Default None, i.e. serial execution.
+    :param int block_size: maximum number of (muon, atom) pairs in the lattice sums and of (muon, angle) pairs binned at once. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: the histograms of the magnitude and of the components of the total field. Each angle of each site is counted with the weight of the site.
+    :rtype: :py:class:`~muesr.engines.histogram.FieldHistogram`
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    _, sc, r, nnn, rc, nangles, _ = _parse_locfield_args('i', supercellsize,
+                                                radius, nnn, rcont, nangles,
+                                                None)
+    try:
+        acont = float(ACont)
+    except:
+        raise TypeError("Cannot convert ACont to float.")
+    # validates the bins before the lattice sums
+    FieldHistogram(bins, 1. if bmax is None else bmax)
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    mus = _muon_positions(sample, positions, cartesian)
+    
+    if weights is None:
+        weights = np.ones(len(mus))
+    try:
+        weights = np.array(weights, dtype=np.float64).reshape(-1)
+    except:
+        raise TypeError("Cannot convert weights to NumPy array.")
+    if weights.shape != (len(mus),):
+        raise ValueError("One weight for each muon site must be specified.")
+    
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    
+    # a few chunks of sites for each process
+    nchunks = min(len(mus), 4 * parse_workers(workers))
+    bounds = np.array([len(c) for c in np.array_split(mus, nchunks)])
+    bounds = np.concatenate([[0], np.cumsum(bounds)])
+    
+    arrays = {'p': p, 'fc': fc, 'k': k, 'phi': phi, 'latpar': latpar,
+              'muons': mus, 'bounds': bounds}
+    # the neighbour index is shared with the other arrays, not sent
+    # with each task
+    if nnn > 0 and rc > 0:
+        neighbours = neighbour_index(sample, rc).subset(
+                                        _magnetic_atoms(sample.mm.fc_view()))
+        arrays.update(neighbours.to_arrays('nb_'))
+    res = map_sites(_histogram_amplitudes, arrays, nchunks,
+                    (sc, r, nnn, rc, acont, block_size), workers)
+    B = np.concatenate([b for b, _ in res])
+    alpha = np.concatenate([a for _, a in res])
     
-    res = []
-    # if is outside for (minimal) sake of performances
-    for mu in sample.muons:
-        if ctype == 's' or ctype == 'sum':
-            res.append(LocalFields(*lfcext.Fields(ctype, p,fc,k,phi,mu,sc,latpar,r,nnn,rc)))
-        elif ctype == 'i' or ctype == 'incommensurate':
-            res.append(LocalFields(*lfcext.Fields(ctype, p,fc,k,phi,mu,sc,latpar,r,nnn,rc,nangles)))
-        elif ctype == 'r' or ctype == 'rotate':
-            res.append(LocalFields(*lfcext.Fields(ctype, p,fc,k,phi,mu,sc,latpar,r,nnn,rc,nangles,axis)))
+    if bmax is None:
+        # slightly larger than the largest field, to include it
+        bmax = ellipse_bmax(B).max() * (1. + 1e-9) if len(B) > 0 else 0.
+        if bmax == 0:
+            bmax = 1.
     
-    return res
+    arrays = {'B': B, 'alpha': alpha, 'weights': weights, 'bounds': bounds}
+    res = map_sites(_histogram_chunk, arrays, nchunks,
+                    (bins, bmax, nangles, block_size), workers)
     
+    hist = FieldHistogram(bins, bmax)
+    for h in res:
+        hist = hist + h
+    return hist
 
-def dipten(sample, supercellsize, radius):
+
+def _dipten_groups(sample, resolve, magnetic_atoms):
+    """
+    Index of the group of each magnetic atom for the `resolve` option
+    of :py:func:`dipten`. Groups are numbered in order of appearance in
+    the cell. Returns None if `resolve` is None.
+    """
+    if resolve is None:
+        return None
+    if not isstr(resolve):
+        raise TypeError("resolve must be of type str")
+    
+    if resolve == 'atoms':
+        return np.arange(len(magnetic_atoms))
+    elif resolve == 'species':
+        symbols = np.array(sample._cell.get_chemical_symbols())
+        _, first, groups = np.unique(symbols[magnetic_atoms],
+                                     return_index=True, return_inverse=True)
+        return np.argsort(np.argsort(first))[groups.reshape(-1)]
+    elif resolve == 'orbits':
+        sample._check_sym()
+        positions = sample._cell.get_scaled_positions()[magnetic_atoms]
+        return sample._sym.tag_sites(positions)
+    raise ValueError("Invalid resolve option.")
+
+
+def _group_tensors(T, groups):
+    """
+    Sums the per atom tensors `T` (shape (..., na, 3, 3)) of the atoms
+    of each group.
+    """
+    G = np.zeros([len(groups), groups.max() + 1 if len(groups) else 0])
+    G[np.arange(len(groups)), groups] = 1.
+    return np.einsum('...akl,ag->...gkl', T, G)
+
+
+def _dipten_site(a, i, sc, r, groups=None):
+    """
+    Dipolar tensor at the i-th muon site of a['muons'], or the tensors
+    of each group of atoms if `groups` is given.
+    """
+    mu = a['muons'][i]
+    if sc is None:
+        sc, mu, _ = _sphere_frame(a['p'], mu, np.zeros(1), np.zeros(3), 's',
+                                  r, a['latpar'])
+    if groups is None:
+        return lfcext.DipolarTensor(a['p'], mu, sc, a['latpar'], r)
+    # per atom sums, with all the phases equal to one
+    T = nplfc.PhaseTensors(a['p'], np.zeros(3), mu, sc, a['latpar'], r,
+                           0, 0.)[0][0]
+    return _group_tensors(T.real, groups)
+
+
+def dipten(sample, supercellsize, radius, workers = None, symmetry = False, resolve = None):
     """
     Calculates dipolar tensor for given muon sites.
     
@@ -380,11 +1405,15 @@ def dipten(sample, supercellsize, radius):
         1/N_A = 1.6605E-24 mole
         
     :param sample: the sample object
-    :param list supercell: the size of the supercell along the lattice coordinates.
+    :param list supercell: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` is chosen for each muon site.
     :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
-    :return: a list of numpy ndarray containing the dipolar tensor for each muon site defined in the sample. 
+    :param int workers: number of processes used to evaluate the muon sites. Without shared memory (Python < 3.8) the evaluation is serial and a warning is issued. Default None, i.e. serial execution.
+    :param bool symmetry: evaluate only one muon site for each set of sites equivalent under the operations of the symmetry of the sample which map the magnetic atoms onto themselves, and obtain the tensors of the other sites by symmetry. Ignored if the symmetry of the sample is not defined or if `resolve` is given. Default False.
+    :param str resolve: if given, the contributions of the magnetic atoms are returned separately. Can be 'atoms' (one tensor for each magnetic atom, in the order of the cell), 'species' (the atoms of each chemical species are summed) or 'orbits' (the atoms of each orbit of the symmetry of the sample are summed). Groups are ordered by their first atom in the cell. Default None, i.e. the tensor of all the magnetic atoms.
+    :return: a list of numpy ndarray containing the dipolar tensor for each muon site defined in the sample, with shape (3,3) or (ngroups,3,3) if `resolve` is given.
     :rtype: list
     :raises: TypeError, ValueError: when radius cannot be converted to float or when radius is negative.
+    :raises: SymmetryError: if `resolve` is 'orbits' and the symmetry is not defined.
     """
     
     # check current status is ok
@@ -399,21 +1428,23 @@ def dipten(sample, supercellsize, radius):
         raise TypeError("Cannot convert radius to float.")
     
     
-    try:
-        sc = np.array(supercellsize, dtype=np.int32)
-        if sc.shape != (3,):
-            raise ValueError("Supercellsize has wrong shape.")
-    except:
-        raise TypeError("Cannot convert supercellsize to NumPy array.")
+    if supercellsize is None:
+        sc = None
+    else:
+        try:
+            sc = np.array(supercellsize, dtype=np.int32)
+            if sc.shape != (3,):
+                raise ValueError("Supercellsize has wrong shape.")
+        except:
+            raise TypeError("Cannot convert supercellsize to NumPy array.")
                 
     # Remove non magnetic atoms from list
 
-    unitcell = sample.cell
+    snapshot = sample.snapshot()
+    positions = snapshot.positions
+    latpar = snapshot.lattice
     
-    positions = unitcell.get_scaled_positions()
-    latpar = unitcell.get_cell()
-    
-    ufc = sample.mm.fc
+    ufc = sample.mm.fc_view()
     
     magnetic_atoms=[]
     for i, e in enumerate(ufc):
@@ -421,10 +1452,84 @@ def dipten(sample, supercellsize, radius):
             magnetic_atoms.append(i)
 
     p = positions[magnetic_atoms,:]
+    groups = _dipten_groups(sample, resolve, magnetic_atoms)
+    
+    muons = _muon_positions(sample, None, False)
+    rep = np.arange(len(muons))
+    if symmetry and groups is None and sample._sym is not None:
+        rep, R, _ = _site_orbits(sample, muons, magnetic=False)
+    reps, inverse = np.unique(rep, return_inverse=True)
+    
+    arrays = {'p': p, 'latpar': latpar, 'muons': muons[reps]}
+    res = map_sites(_dipten_site, arrays, len(reps), (sc, r, groups),
+                    workers)
+    
+    if len(reps) == len(muons):
+        return res
     
-    res = []
-    for mu in sample.muons:
-        res.append(lfcext.DipolarTensor(p,mu,sc,latpar,r))
+    return [np.dot(m, np.dot(res[j], m.T)) for j, m in zip(inverse, R)]
 
-    return res        
 
+
+def dipten_batch(sample, supercellsize, radius, positions = None, cartesian = False, block_size = nplfc.BLOCK_SIZE, resolve = None):
+    """
+    Calculates dipolar tensors for many muon sites at once.
+    
+    Same as :py:func:`~dipten`, but the lattice is enumerated a single
+    time and the sums for all the sites are evaluated together using
+    the vectorized routines of :py:mod:`muesr.engines.nplfc`.
+    
+    :param sample: the sample object
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the sphere of radius `radius` around all the sites is chosen.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once, which bounds the memory used by the sums (about 250 bytes per pair). Results do not depend on it. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :param str resolve: 'atoms', 'species' or 'orbits' to obtain the contributions of each magnetic atom or group of atoms, as in :py:func:`~dipten`. Default None.
+    :return: numpy ndarray of shape (N,3,3), or (N,ngroups,3,3) if `resolve` is given, containing the dipolar tensor for each muon site, in 1/Angstrom^3.
+    :rtype: numpy.ndarray
+    :raises: TypeError, ValueError
+    """
+    
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+    
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+    
+    try:
+        r= float(radius) # Lorentz radius (in A)
+    except:
+        raise TypeError("Cannot convert radius to float.")
+    if r<0:
+        raise ValueError("Lorentz radius must be greater or equal to 0.")
+    
+    if supercellsize is None:
+        sc = None
+    else:
+        try:
+            sc = np.array(supercellsize, dtype=np.int32)
+        except:
+            raise TypeError("Cannot convert supercellsize to NumPy array.")
+        if sc.shape != (3,):
+            raise ValueError("Supercellsize has wrong shape.")
+    
+    mus = _muon_positions(sample, positions, cartesian)
+    
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    
+    groups = _dipten_groups(sample, resolve, _magnetic_atoms(sample.mm.fc_view()))
+    
+    if sc is None:
+        sc, mus, _ = _sphere_frame(p, mus, phi, k, 's', r, latpar)
+    
+    if groups is None:
+        return nplfc.DipolarTensor(p, mus, sc, latpar, r, block_size)
+    
+    # per atom sums, with all the phases equal to one
+    T = nplfc.PhaseTensors(p, np.zeros(3), mus, sc, latpar, r, 0, 0.,
+                           block_size)[0]
+    return _group_tensors(T.real, groups)
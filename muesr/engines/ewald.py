@@ -0,0 +1,655 @@
+"""
+Ewald summation of the dipolar lattice sums.
+
+The dipolar field generated by the magnetic sublattice at a muon site
+is obtained by splitting the dipolar kernel in a short range part,
+summed in real space, and a long range part, summed in reciprocal
+space. Both series converge exponentially, so the cost of a
+calculation only depends on the requested accuracy and not on the
+size of a supercell.
+
+The results correspond to the limit of an infinite Lorentz sphere of
+the brute force sums performed by :py:func:`muesr.engines.clfc.locfield`
+and :py:func:`muesr.engines.clfc.dipten`. The magnetic structure is
+referred to the unit cell hosting the muon, i.e. the phases of the
+moments are those obtained with a supercell for which
+k.floor(supercell/2) is an integer.
+"""
+
+import math
+import numpy as np
+
+from muesr.core.sample import Sample
+from muesr.core.neighbours import neighbour_index
+from muesr.engines import nplfc
+from muesr.engines.clfc import LocalFields, _parse_ctype_args, \
+                               _parse_contact_args, _magnetic_sublattice, \
+                               _magnetic_atoms, _muon_positions, \
+                               _rotation_axes
+
+# default relative accuracy of the lattice sums
+ACCURACY = 1e-6
+
+_erfc = np.vectorize(math.erfc, otypes=[np.float64])
+
+
+def ewald_parameters(latpar, accuracy=ACCURACY):
+    """
+    Splitting parameter and cutoffs of the Ewald sums.
+
+    :param latpar: lattice vectors (rows).
+    :param float accuracy: relative accuracy of the lattice sums.
+    :return: the splitting parameter eta (1/Angstrom), the real space
+             cutoff (Angstrom) and the reciprocal space cutoff
+             (1/Angstrom).
+    :rtype: tuple
+    """
+    if not 0. < accuracy < 1.:
+        raise ValueError("accuracy must be in the interval (0,1).")
+    volume = abs(np.linalg.det(latpar))
+    # balances the number of terms in the two sums
+    eta = np.sqrt(np.pi) / volume**(1. / 3.)
+    s = np.sqrt(-np.log(accuracy))
+    # the real space terms decay as (eta r)^3 exp(-(eta r)^2)
+    s = np.sqrt(-np.log(accuracy) + 3. * np.log(s + 1.))
+    return eta, s / eta, 2. * eta * s
+
+
+def cell_translations(latpar, radius):
+    """
+    Lattice translations, in fractional coordinates, of the cells that
+    contain all the points closer than `radius` to any point of the
+    cell at the origin.
+    """
+    # distances between the lattice planes are 1/|b_i|
+    b = np.linalg.inv(latpar).T
+    n = np.ceil(radius * np.linalg.norm(b, axis=1)).astype(np.int64) + 1
+    grid = np.mgrid[-n[0]:n[0] + 1, -n[1]:n[1] + 1, -n[2]:n[2] + 1]
+    return grid.reshape(3, -1).T.astype(np.float64)
+
+
+def _real_space(rho, k, latpar, eta, rcut, block_size):
+    """
+    Short range part of the lattice sums. `rho` has shape (nmu, na, 3).
+    """
+    T = cell_translations(latpar, rcut)
+    R = np.dot(T, latpar)
+    phase = np.exp(-2.j * np.pi * np.dot(T, k))
+
+    nmu, na = rho.shape[:2]
+    res = np.zeros([nmu * na, 9], dtype=np.complex128)
+    rho = rho.reshape(-1, 3)
+
+    mstep = max(1, int(block_size) // max(1, T.shape[0]))
+    for mstart in range(0, nmu * na, mstep):
+        msl = slice(mstart, min(mstart + mstep, nmu * na))
+        r = rho[msl, None, :] + R[None, :, :]
+        d = np.sqrt(np.einsum('jtk,jtk->jt', r, r))
+        # only the terms inside the cutoff are evaluated
+        j, t = np.nonzero((d <= rcut) & (d > 0.))
+        r = r[j, t]
+        d = d[j, t]
+
+        x = eta * d
+        g = 2. / np.sqrt(np.pi) * x * np.exp(-x * x)
+        erfc = _erfc(x)
+        B = (erfc + g) / d**3 * phase[t]
+        C = (3. * erfc + g * (3. + 2. * x * x)) / d**5 * phase[t]
+
+        terms = C[:, None] * (r[:, :, None] * r[:, None, :]).reshape(-1, 9)
+        terms -= B[:, None] * np.eye(3).ravel()[None, :]
+
+        nj = msl.stop - msl.start
+        for c in range(9):
+            res[msl, c] += np.bincount(j, terms[:, c].real, nj) + \
+                           1.j * np.bincount(j, terms[:, c].imag, nj)
+    return res.reshape(nmu, na, 3, 3)
+
+
+def _reciprocal_space(rho, k, latpar, eta, gcut):
+    """
+    Long range part of the lattice sums. `rho` has shape (nmu, na, 3).
+    """
+    volume = abs(np.linalg.det(latpar))
+    b = 2. * np.pi * np.linalg.inv(latpar).T
+    q = -np.dot(k, b)
+
+    n = np.ceil((gcut + np.linalg.norm(q)) *
+                np.linalg.norm(latpar, axis=1) / (2. * np.pi))
+    n = n.astype(np.int64)
+    H = np.mgrid[-n[0]:n[0] + 1, -n[1]:n[1] + 1, -n[2]:n[2] + 1]
+    p = np.dot(H.reshape(3, -1).T, b) - q
+    p2 = np.einsum('gk,gk->g', p, p)
+
+    # the p = 0 term depends on the shape of the sample. For a
+    # sphere its angular average is taken.
+    zero = p2 < 1e-12 * eta**2
+    select = (p2 <= gcut**2) & ~zero
+    p = p[select]
+    p2 = p2[select]
+
+    w = np.exp(-p2 / (4. * eta**2)) / p2
+    pp = np.einsum('g,gi,gj->gij', w, p, p)
+    phase = np.exp(1.j * np.einsum('gk,mak->mag', p, rho))
+
+    res = -4. * np.pi / volume * np.einsum('mag,gij->maij', phase, pp)
+    if np.any(zero):
+        res -= 4. * np.pi / (3. * volume) * np.eye(3)
+    return res, np.any(zero)
+
+
+def DipolarTensors(positions, Muon, K, Cell, accuracy=ACCURACY,
+                   block_size=nplfc.BLOCK_SIZE):
+    """
+    Dipolar tensors connecting each magnetic atom to each muon site,
+    weighted by the phases of the propagation vector `K`.
+
+    Element [m,a] of the result is the sum over the lattice
+    translations T of
+
+    (3 r r^T / r^5 - 1 / r^3) exp(-2 pi i K.T)
+
+    with r = p_a + T - mu_m in Cartesian coordinates, evaluated for
+    an infinite sphere.
+
+    :param positions: atomic positions in fractional coordinates.
+    :param Muon: (N,3) array of muon positions in fractional coordinates.
+    :param K: propagation vector in r.l.u.
+    :param Cell: lattice vectors (rows).
+    :param float accuracy: relative accuracy of the lattice sums.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated
+                           at once in real space.
+    :return: complex array of shape (N, na, 3, 3) in 1/Angstrom^3 and a
+             bool which is True when K is a reciprocal lattice vector,
+             i.e. when the sample has a net magnetization.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    K = np.asarray(K, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+
+    eta, rcut, gcut = ewald_parameters(Cell, accuracy)
+
+    # translating the muon to the cell at the origin multiplies the
+    # sums by exp(-2 pi i K.n)
+    n = np.floor(Muon)
+    rho = np.dot(positions[None, :, :] - (Muon - n)[:, None, :], Cell)
+
+    res, magnetized = _reciprocal_space(rho, K, Cell, eta, gcut)
+    res += _real_space(rho, K, Cell, eta, rcut, block_size)
+    res *= np.exp(-2.j * np.pi * np.dot(n, K))[:, None, None, None]
+    return res, magnetized
+
+
+def grid_points(grid):
+    """
+    Fractional coordinates of the points of a regular n1 x n2 x n3
+    grid spanning the unit cell, with shape (n1, n2, n3, 3).
+    """
+    grid = np.asarray(grid, dtype=np.int64)
+    return np.indices(grid).transpose(1, 2, 3, 0) / grid.astype(np.float64)
+
+
+def _grid_parameters(latpar, grid, accuracy):
+    """
+    Ewald parameters for grid calculations. The reciprocal space sum
+    is evaluated on all the grid points with a single FFT, so the
+    splitting parameter is increased up to the resolution of the grid
+    to shorten the real space sum.
+    """
+    eta, rcut, gcut = ewald_parameters(latpar, accuracy)
+    s = eta * rcut
+    # largest reciprocal vector sampled by the grid along each direction
+    b = np.linalg.norm(np.linalg.inv(latpar).T, axis=1)
+    eta = max(eta, np.pi * np.min(grid * b) / (2. * s))
+    return eta, s / eta, 2. * eta * s
+
+
+def _reciprocal_grid(positions, m0, K, Cell, eta, gcut, grid):
+    """
+    Long range part of the lattice sums on all the points of the grid,
+    evaluated with a single FFT.
+
+    If `m0` (shape (ns, na, 3)) is given, the fields generated by the
+    complex moments m0 are returned with shape (ns, n1, n2, n3, 3),
+    otherwise the tensors summed over the atoms are returned, with
+    shape (n1, n2, n3, 3, 3).
+    """
+    volume = abs(np.linalg.det(Cell))
+    b = 2. * np.pi * np.linalg.inv(Cell).T
+
+    n = np.ceil((gcut + np.linalg.norm(np.dot(K, b))) *
+                np.linalg.norm(Cell, axis=1) / (2. * np.pi))
+    n = n.astype(np.int64)
+    H = np.mgrid[-n[0]:n[0] + 1, -n[1]:n[1] + 1, -n[2]:n[2] + 1]
+    H = H.reshape(3, -1).T
+    p = np.dot(H + K, b)
+    p2 = np.einsum('gk,gk->g', p, p)
+
+    zero = p2 < 1e-12 * eta**2
+    select = (p2 <= gcut**2) & ~zero
+    H, p, p2 = H[select], p[select], p2[select]
+
+    w = -4. * np.pi / volume * np.exp(-p2 / (4. * eta**2)) / p2
+    sf = np.exp(2.j * np.pi * np.dot(H + K, positions.T))
+
+    if m0 is None:
+        coeff = np.einsum('g,gi,gj->gij', w * sf.sum(axis=1), p, p)
+        coeff = coeff.reshape(1, -1, 9)
+    else:
+        S = np.einsum('ga,sak->sgk', sf, m0)
+        coeff = (w * np.einsum('gk,sgk->sg', p, S))[:, :, None] * p[None]
+
+    # on the grid points H and H + grid give the same contribution
+    idx = np.ravel_multi_index((H % grid).T, grid)
+    ns, _, nc = coeff.shape
+    data = np.zeros([ns, np.prod(grid), nc], dtype=np.complex128)
+    for s in range(ns):
+        for c in range(nc):
+            data[s, :, c] = np.bincount(idx, coeff[s, :, c].real,
+                                        data.shape[1]) + \
+                            1.j * np.bincount(idx, coeff[s, :, c].imag,
+                                              data.shape[1])
+    data = data.reshape((ns,) + tuple(grid) + (nc,))
+
+    # sum over H of exp(-2 pi i H.u) for u = g / grid
+    res = np.fft.fftn(data, axes=(1, 2, 3))
+    u = grid_points(grid)
+    res *= np.exp(-2.j * np.pi * np.dot(u, K))[None, :, :, :, None]
+
+    if np.any(zero):
+        if m0 is None:
+            res -= 4. * np.pi / (3. * volume) * positions.shape[0] * \
+                   np.eye(3).ravel()
+        else:
+            res -= 4. * np.pi / (3. * volume) * \
+                   m0.sum(axis=1)[:, None, None, None, :]
+
+    if m0 is None:
+        return res[0].reshape(tuple(grid) + (3, 3)), np.any(zero)
+    return res, np.any(zero)
+
+
+def GridFields(calc_type, positions, FC, K, Phi, Cell, grid, nangles=None,
+               rot_axis=None, accuracy=ACCURACY, block_size=nplfc.BLOCK_SIZE):
+    """
+    Dipolar fields on all the points of a regular grid spanning the
+    unit cell, with the conventions of :py:func:`Fields`.
+
+    The long range part of the Ewald sum is evaluated on the whole grid
+    with a fast Fourier transform, and the splitting parameter is
+    chosen so that the short range part only involves the neighbours
+    of each point.
+
+    :param str calc_type: 's', 'r' or 'i'
+    :param positions: atomic positions in fractional coordinates.
+    :param FC: Fourier components in Cartesian coordinates.
+    :param K: propagation vector in r.l.u.
+    :param Phi: phases in units of 2 pi.
+    :param Cell: lattice vectors (rows).
+    :param grid: number of points along the three lattice vectors.
+    :param nangles: number of divisions of the full turn or array of
+                    angles in radians.
+    :param rot_axis: rotation axis for 'r' calculations, or (na,3) array
+                     of axes, one for each atom.
+    :param float accuracy: relative accuracy of the lattice sums.
+    :param int block_size: maximum number of (point, atom) pairs
+                           evaluated at once in real space.
+    :return: the dipolar fields in Tesla with shape (n1, n2, n3, 3),
+             or (n1, n2, n3, nangles, 3) for 'r' and 'i' calculations,
+             and a bool which is True when the sample has a net
+             magnetization.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+    grid = np.asarray(grid, dtype=np.int64)
+
+    fcs = nplfc.fourier_component_sets(calc_type, FC, rot_axis)
+    m0 = fcs * np.exp(-2.j * np.pi * Phi)[None, :, None]
+
+    eta, rcut, gcut = _grid_parameters(Cell, grid, accuracy)
+
+    BD, magnetized = _reciprocal_grid(positions, m0, K, Cell, eta, gcut, grid)
+    BD = BD.reshape(m0.shape[0], -1, 3)
+
+    u = grid_points(grid).reshape(-1, 3)
+    na = positions.shape[0]
+    step = max(1, int(block_size) // (27 * max(1, na)))
+    for start in range(0, u.shape[0], step):
+        sl = slice(start, min(start + step, u.shape[0]))
+        rho = np.dot(positions[None, :, :] - u[sl, None, :], Cell)
+        T = _real_space(rho, K, Cell, eta, rcut, block_size)
+        BD[:, sl, :] += np.einsum('maij,saj->smi', T, m0)
+
+    BD *= nplfc.DIPOLAR_PREFACTOR
+    alpha = 2. * np.pi * np.dot(u, K)
+    res = nplfc.assemble(calc_type, BD, alpha, nangles)
+    return res.reshape(tuple(grid) + res.shape[1:]), magnetized
+
+
+def GridDipolarTensors(positions, Cell, grid, accuracy=ACCURACY,
+                       block_size=nplfc.BLOCK_SIZE):
+    """
+    Dipolar tensors, summed over the atoms in `positions`, on all the
+    points of a regular grid spanning the unit cell.
+
+    :param positions: atomic positions in fractional coordinates.
+    :param Cell: lattice vectors (rows).
+    :param grid: number of points along the three lattice vectors.
+    :param float accuracy: relative accuracy of the lattice sums.
+    :param int block_size: maximum number of (point, atom) pairs
+                           evaluated at once in real space.
+    :return: real array of shape (n1, n2, n3, 3, 3) in 1/Angstrom^3.
+    :rtype: numpy.ndarray
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+    grid = np.asarray(grid, dtype=np.int64)
+    K = np.zeros(3)
+
+    eta, rcut, gcut = _grid_parameters(Cell, grid, accuracy)
+
+    res, _ = _reciprocal_grid(positions, None, K, Cell, eta, gcut, grid)
+    res = res.reshape(-1, 3, 3)
+
+    u = grid_points(grid).reshape(-1, 3)
+    na = positions.shape[0]
+    step = max(1, int(block_size) // (27 * max(1, na)))
+    for start in range(0, u.shape[0], step):
+        sl = slice(start, min(start + step, u.shape[0]))
+        rho = np.dot(positions[None, :, :] - u[sl, None, :], Cell)
+        res[sl] += _real_space(rho, K, Cell, eta, rcut, block_size).sum(axis=1)
+
+    return np.real(res).reshape(tuple(grid) + (3, 3))
+
+
+def _contact(positions, fcs, K, Phi, Muon, Cell, nnn, rc, neighbours=None):
+    """
+    Contact fields of the sets of Fourier components `fcs`, with the
+    same conventions of :py:func:`DipolarTensors`.
+    """
+    w, atoms, T = nplfc.contact_weights(positions, Cell, Muon, nnn, rc,
+                                        neighbours)
+    phase = np.exp(-2.j * np.pi * (np.dot(T, K) + Phi[atoms]))
+    return nplfc.CONTACT_PREFACTOR * np.einsum('mn,smnk->smk', w * phase,
+                                               fcs[:, atoms, :])
+
+
+def Fields(calc_type, positions, FC, K, Phi, Muon, Cell, nnn, rcont,
+           nangles=None, rot_axis=None, accuracy=ACCURACY, neighbours=None):
+    """
+    Calculates the local field components at the muon site(s) with the
+    Ewald method.
+
+    Arguments are the same as :py:func:`muesr.engines.nplfc.Fields`,
+    but no supercell and Lorentz radius are needed since the sums are
+    performed for an infinite sphere.
+
+    :param str calc_type: 's', 'r' or 'i'
+    :param positions: atomic positions in fractional coordinates.
+    :param FC: Fourier components in Cartesian coordinates.
+    :param K: propagation vector in r.l.u.
+    :param Phi: phases in units of 2 pi.
+    :param Muon: muon position(s) in fractional coordinates.
+    :param Cell: lattice vectors (rows).
+    :param int nnn: number of nearest neighbours for the contact field.
+    :param float rcont: maximum distance for the contact field neighbours.
+    :param nangles: number of divisions of the full turn or array of
+                    angles in radians.
+    :param rot_axis: rotation axis for 'r' calculations, or (na,3) array
+                     of axes, one for each atom.
+    :param float accuracy: relative accuracy of the lattice sums.
+    :param neighbours: a :py:class:`~muesr.core.neighbours.PeriodicNeighbours`
+                       index of `positions` used for the contact field.
+                       Built if None.
+    :return: Contact, Dipolar and Lorentz fields in Tesla.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.asarray(Muon, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+
+    single = (Muon.ndim == 1)
+    Muon = np.atleast_2d(Muon)
+
+    fcs = nplfc.fourier_component_sets(calc_type, FC, rot_axis)
+    # moments of the cell at the origin
+    m0 = fcs * np.exp(-2.j * np.pi * Phi)[None, :, None]
+
+    tensors, magnetized = DipolarTensors(positions, Muon, K, Cell, accuracy)
+    BD = nplfc.DIPOLAR_PREFACTOR * np.einsum('maij,saj->smi', tensors, m0)
+
+    # The Lorentz field of an infinite sphere, (mu_0/3) M, cancels the
+    # shape dependent term of the dipolar sum.
+    BL = np.zeros_like(BD)
+    if magnetized:
+        volume = abs(np.linalg.det(Cell))
+        BL[:] = nplfc.DIPOLAR_PREFACTOR * 4. * np.pi / (3. * volume) * \
+                m0.sum(axis=1)[:, None, :]
+
+    BC = _contact(positions, fcs, K, Phi, Muon, Cell, int(nnn), float(rcont),
+                  neighbours)
+
+    alpha = 2. * np.pi * np.dot(Muon, K)
+    res = [nplfc.assemble(calc_type, B, alpha, nangles) for B in (BC, BD, BL)]
+
+    if single:
+        res = [B[0] for B in res]
+    return tuple(res)
+
+
+def locfield(sample, ctype, nnn = 2, rcont = 10.0, nangles = None, axis = None, accuracy = ACCURACY, positions = None, cartesian = False, angles = None):
+    """
+    Evaluates local fields at the muon sites with the Ewald method.
+
+    Same as :py:func:`muesr.engines.clfc.locfield`, but the dipolar
+    and Lorentz fields are obtained for an infinite Lorentz sphere
+    with a cost that only depends on the requested accuracy.
+
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param float accuracy: relative accuracy of the lattice sums. Default 1e-6.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :return: a list of :py:class:`~muesr.engines.clfc.LocalFields` containing the local field components for each muon site.
+    :rtype: list
+    :raises: TypeError, ValueError
+    """
+
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+
+    ctype, nangles, axis = _parse_ctype_args(ctype, nangles, axis, angles)
+    nnn, rc = _parse_contact_args(nnn, rcont)
+
+    try:
+        accuracy = float(accuracy)
+    except:
+        raise TypeError("Cannot convert accuracy to float.")
+
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+
+    mus = _muon_positions(sample, positions, cartesian)
+
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    axis = _rotation_axes(sample, axis)
+
+    neighbours = None
+    if nnn > 0 and rc > 0:
+        neighbours = neighbour_index(sample, rc).subset(
+                                        _magnetic_atoms(sample.mm.fc_view()))
+
+    BC, BD, BL = Fields(ctype, p, fc, k, phi, mus, latpar, nnn, rc,
+                        nangles, axis, accuracy, neighbours)
+
+    return [LocalFields(c, d, l) for c, d, l in zip(BC, BD, BL)]
+
+
+def dipten(sample, accuracy = ACCURACY, positions = None, cartesian = False):
+    """
+    Calculates dipolar tensors for the muon sites with the Ewald method.
+
+    Same as :py:func:`muesr.engines.clfc.dipten`, but the tensors are
+    obtained for an infinite Lorentz sphere.
+    The results are provided in 1/Angstrom^3.
+
+    :param sample: the sample object
+    :param float accuracy: relative accuracy of the lattice sums. Default 1e-6.
+    :param positions: (N,3) array of muon positions. If None (default) the muon sites defined in the sample are used.
+    :param bool cartesian: if True, `positions` are in Cartesian coordinates, otherwise (default) in fractional coordinates.
+    :return: a list of numpy ndarray containing the dipolar tensor for each muon site.
+    :rtype: list
+    :raises: TypeError, ValueError
+    """
+
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+
+    try:
+        accuracy = float(accuracy)
+    except:
+        raise TypeError("Cannot convert accuracy to float.")
+
+    mus = _muon_positions(sample, positions, cartesian)
+
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+
+    tensors, magnetized = DipolarTensors(p, mus, np.zeros(3), latpar,
+                                         accuracy)
+
+    return list(np.real(tensors.sum(axis=1)))
+
+
+def _parse_grid(grid):
+    """
+    Validates the number of grid points along the lattice vectors.
+    """
+    try:
+        grid = np.array(grid, dtype=np.int64)
+    except:
+        raise TypeError("Cannot convert grid to NumPy array.")
+    if grid.shape != (3,):
+        raise ValueError("Grid has wrong shape.")
+    if np.min(grid) <= 0:
+        raise ValueError("Grid size must be strictly positive.")
+    return grid
+
+
+def locfield_grid(sample, ctype, grid, nangles = None, axis = None, accuracy = ACCURACY, angles = None):
+    """
+    Evaluates the dipolar and Lorentz fields on a regular grid of
+    points spanning the unit cell.
+    
+    The grid points have fractional coordinates (i/n1, j/n2, l/n3).
+    The fields are obtained with the Ewald method, as in 
+    :py:func:`~locfield`, but the reciprocal space sum is performed on
+    the whole grid with a fast Fourier transform.
+    The fields close to the atomic positions are not meaningful.
+    The contact field is not evaluated.
+    
+    A scalar map, e.g. the modulus of the dipolar field, can be saved
+    for XCrysDen or VESTA with 
+    ``write_xsf(filename, sample.cell, np.linalg.norm(r.D, axis=-1))``
+    (see :py:mod:`muesr.i_o.xsf.xsfio`).
+    
+    :param sample: the sample object
+    :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+    :param list grid: number of grid points along the three lattice vectors.
+    :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+    :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+    :param float accuracy: relative accuracy of the lattice sums. Default 1e-6.
+    :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+    :return: a :py:class:`~muesr.engines.clfc.LocalFields` object whose arrays have shape (n1, n2, n3, 3), or (n1, n2, n3, nangles, 3) for 'rotate' and 'incommensurate' simulations.
+    :rtype: :py:class:`~muesr.engines.clfc.LocalFields`
+    :raises: TypeError, ValueError
+    """
+
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+
+    ctype, nangles, axis = _parse_ctype_args(ctype, nangles, axis, angles)
+    grid = _parse_grid(grid)
+
+    try:
+        accuracy = float(accuracy)
+    except:
+        raise TypeError("Cannot convert accuracy to float.")
+
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+    axis = _rotation_axes(sample, axis)
+
+    BD, magnetized = GridFields(ctype, p, fc, k, phi, latpar, grid, nangles,
+                                axis, accuracy)
+
+    # Lorentz field of an infinite sphere, uniform in the cell
+    BL = np.zeros_like(BD)
+    if magnetized:
+        volume = abs(np.linalg.det(latpar))
+        fcs = nplfc.fourier_component_sets(ctype, fc, axis)
+        m0 = fcs * np.exp(-2.j * np.pi * phi)[None, :, None]
+        B = nplfc.DIPOLAR_PREFACTOR * 4. * np.pi / (3. * volume) * \
+            m0.sum(axis=1)[:, None, :]
+        alpha = 2. * np.pi * np.dot(grid_points(grid).reshape(-1, 3), k)
+        BL[:] = nplfc.assemble(ctype, np.repeat(B, alpha.size, axis=1),
+                               alpha, nangles).reshape(BD.shape)
+
+    return LocalFields(np.zeros_like(BD), BD, BL)
+
+
+def dipten_grid(sample, grid, accuracy = ACCURACY):
+    """
+    Calculates the dipolar tensor on a regular grid of points spanning
+    the unit cell with the Ewald method.
+    
+    Same as :py:func:`~dipten`, for the grid points of 
+    :py:func:`~locfield_grid`.
+    The results are provided in 1/Angstrom^3.
+
+    :param sample: the sample object
+    :param list grid: number of grid points along the three lattice vectors.
+    :param float accuracy: relative accuracy of the lattice sums. Default 1e-6.
+    :return: numpy ndarray of shape (n1, n2, n3, 3, 3) containing the dipolar tensor on the grid points.
+    :rtype: numpy.ndarray
+    :raises: TypeError, ValueError
+    """
+
+    # check current status is ok
+    sample._check_lattice()
+    sample._check_magdefs()
+
+    grid = _parse_grid(grid)
+
+    try:
+        accuracy = float(accuracy)
+    except:
+        raise TypeError("Cannot convert accuracy to float.")
+
+    latpar = sample._cell.get_cell()
+    p, fc, phi, k = _magnetic_sublattice(sample)
+
+    return GridDipolarTensors(p, latpar, grid, accuracy)
@@ -0,0 +1,156 @@
+"""
+Histograms of local field distributions.
+
+The fields of many muon sites and angles are binned as they are
+computed, so that only the counts of the bins are stored. Histograms
+with the same bins obtained from different sites, processes or runs
+are combined with :py:meth:`FieldHistogram.merge` (or ``+``).
+"""
+
+import numpy as np
+
+
+def _bin_indexes(x, edges):
+    """
+    Index of the bin of each value in `x`, with the equally spaced
+    `edges`, as in numpy.histogram: the last bin includes its right
+    edge. Values out of range have index -1.
+    """
+    nbins = len(edges) - 1
+    lo, hi = edges[0], edges[-1]
+    idx = np.floor((x - lo) * (nbins / (hi - lo))).astype(np.int64)
+    idx = np.clip(idx, 0, nbins - 1)
+    # correct the rounding errors close to the edges
+    idx -= (x < edges[idx])
+    idx += (x >= edges[idx + 1]) & (idx != nbins - 1)
+    return np.where((x >= lo) & (x <= hi), idx, -1)
+
+
+class FieldHistogram(object):
+    """
+    Weighted histograms of the magnitude and of the Cartesian
+    components of local fields.
+
+    The magnitude is binned in `bins` equal bins in [0, bmax] and
+    the components in `bins` equal bins in [-bmax, bmax]. Values out
+    of range are not counted.
+
+    :param int bins: number of bins.
+    :param float bmax: largest field, in Tesla.
+    :raises: TypeError, ValueError
+    """
+
+    def __init__(self, bins, bmax):
+        try:
+            bins = int(bins)
+        except:
+            raise TypeError("Cannot convert bins to int.")
+        try:
+            bmax = float(bmax)
+        except:
+            raise TypeError("Cannot convert bmax to float.")
+        if bins <= 0:
+            raise ValueError("bins must be strictly positive.")
+        if not bmax > 0:
+            raise ValueError("bmax must be strictly positive.")
+
+        self._bmax = bmax
+        self.magnitude_edges = np.linspace(0., bmax, bins + 1)
+        self.component_edges = np.linspace(-bmax, bmax, bins + 1)
+        self.magnitude = np.zeros(bins)
+        self.components = np.zeros([3, bins])
+        self.weight = 0.
+
+    @property
+    def bins(self):
+        """
+        Number of bins.
+        """
+        return len(self.magnitude)
+
+    @property
+    def bmax(self):
+        """
+        Largest field of the bins, in Tesla.
+        """
+        return self._bmax
+
+    def add(self, fields, weights=None):
+        """
+        Adds fields to the histograms.
+
+        :param fields: array of shape (..., 3) of fields in Tesla.
+        :param weights: weights of the fields, broadcastable to
+                        fields.shape[:-1]. Default None, i.e. one.
+        """
+        fields = np.asarray(fields, dtype=np.float64)
+        if fields.shape[-1] != 3:
+            raise ValueError("Fields must have shape (..., 3).")
+        if weights is None:
+            weights = 1.
+        weights = np.broadcast_to(np.asarray(weights, dtype=np.float64),
+                                  fields.shape[:-1]).reshape(-1)
+        fields = fields.reshape(-1, 3)
+
+        self._add(self.magnitude, np.linalg.norm(fields, axis=1),
+                  self.magnitude_edges, weights)
+        for i in range(3):
+            self._add(self.components[i], fields[:, i],
+                      self.component_edges, weights)
+        self.weight += weights.sum()
+
+    @staticmethod
+    def _add(counts, x, edges, weights):
+        idx = _bin_indexes(x, edges)
+        inside = idx >= 0
+        counts += np.bincount(idx[inside], weights=weights[inside],
+                              minlength=len(counts))
+
+    def merge(self, other):
+        """
+        Returns the sum of two histograms with the same bins.
+
+        :param other: a :py:class:`FieldHistogram`.
+        :rtype: :py:class:`FieldHistogram`
+        :raises: ValueError
+        """
+        if not isinstance(other, FieldHistogram):
+            raise TypeError("Can only merge FieldHistogram objects.")
+        if other.bins != self.bins or other.bmax != self.bmax:
+            raise ValueError("Histograms have different bins.")
+        res = FieldHistogram(self.bins, self.bmax)
+        res.magnitude = self.magnitude + other.magnitude
+        res.components = self.components + other.components
+        res.weight = self.weight + other.weight
+        return res
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def density(self):
+        """
+        Probability densities of the magnitude and of the components
+        of the field, normalized to one.
+
+        :return: the densities of the magnitude (bins,) and of the
+                 components (3,bins), in 1/Tesla.
+        :rtype: tuple
+        """
+        if self.weight == 0:
+            return np.zeros_like(self.magnitude), np.zeros_like(self.components)
+        return (self.magnitude / (self.weight * np.diff(self.magnitude_edges)),
+                self.components / (self.weight * np.diff(self.component_edges)))
+
+
+def ellipse_bmax(B):
+    """
+    Largest magnitude of the fields Re[B exp(i t)] for any angle t,
+    i.e. the semi-major axis of the ellipse described by the field.
+
+    :param B: (..., 3) array of complex amplitudes.
+    :rtype: numpy.ndarray
+    """
+    B = np.asarray(B, dtype=np.complex128)
+    b2 = np.sum(np.abs(B)**2, axis=-1)
+    bb = np.abs(np.sum(B * B, axis=-1))
+    return np.sqrt(0.5 * (b2 + bb))
@@ -0,0 +1,193 @@
+"""
+Precomputed lattice sums for the fast evaluation of many magnetic
+models at fixed muon sites.
+
+The local fields are linear in the Fourier components of the magnetic
+moments. The lattice sums connecting each magnetic atom to each muon
+site are therefore computed once (for every propagation vector) and
+the fields of a new magnetic model are obtained with a tensor
+contraction.
+"""
+
+import numpy as np
+
+from muesr.core.sample import Sample
+from muesr.core.neighbours import neighbour_index
+from muesr.engines import nplfc
+from muesr.engines.clfc import LocalFields, _parse_locfield_args, \
+                               _parse_ctype_args, _rotation_axes
+
+
+class LocalFieldsCache(object):
+    """
+    Cache of the lattice sums used by :py:func:`~muesr.engines.clfc.locfield`.
+
+    The sums are evaluated for the cell and the muon sites of `sample`
+    the first time a magnetic model with a given propagation vector
+    (and set of magnetic atoms) is considered. They are discarded
+    automatically when the cell or the muon sites of the sample change.
+
+    Usage::
+
+        cache = LocalFieldsCache(sample, [30,30,30], 50.)
+        for params in candidates:
+            sample.mm.set_params(params)
+            r = cache.locfield('s')
+
+    :param sample: the sample object
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the spheres around all the muon sites is used, as in :py:func:`~muesr.engines.clfc.locfield_batch`.
+    :param float radius: the radius of the sphere used to evaluate the dipolar tensor.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :raises: TypeError, ValueError
+    """
+
+    def __init__(self, sample, supercellsize, radius, nnn = 2, rcont = 10.0):
+
+        # check sample is a Sample object
+        if not isinstance(sample, Sample):
+            raise TypeError("sample must be a Sample instance.")
+
+        _, sc, r, nnn, rc, _, _ = _parse_locfield_args('s', supercellsize,
+                                                       radius, nnn, rcont,
+                                                       None, None)
+        self._sample = sample
+        self._sc = sc
+        self._r = r
+        self._nnn = nnn
+        self._rc = rc
+
+        self._state = None
+        self._version = None
+        self._tensors = {}
+
+    def _check_state(self):
+        """
+        Drops the cached sums if the cell or the muon sites changed.
+        """
+        sample = self._sample
+        sample._check_lattice()
+        sample._check_muon()
+
+        if self._state is not None and self._version == sample.version:
+            return
+        self._version = sample.version
+
+        snapshot = sample.snapshot()
+        state = (snapshot.lattice, snapshot.positions, snapshot.muons)
+        if self._state is not None:
+            if all(a.shape == b.shape and np.array_equal(a, b)
+                   for a, b in zip(state, self._state)):
+                return
+        self._state = state
+        self._tensors = {}
+
+    def clear(self):
+        """
+        Drops all the cached lattice sums.
+        """
+        self._state = None
+        self._tensors = {}
+
+    def _get_tensors(self, fc, k):
+        """
+        Returns the magnetic atoms, i.e. those with non null Fourier
+        components `fc`, and the lattice sums for the propagation
+        vector `k`, evaluating them if needed, together with the
+        supercell, the muon positions in the supercell and the origin
+        of the supercell used to evaluate them.
+        """
+        self._check_state()
+        latpar, positions, mus = self._state
+
+        # same selection of clfc.locfield
+        magnetic = np.any(np.abs(fc) > 1e-8, axis=1)
+        k = np.asarray(k, dtype=np.float64)
+
+        key = (tuple(k), tuple(magnetic))
+        if key not in self._tensors:
+            sc, origin = self._sc, np.zeros(3)
+            if sc is None:
+                radius = max(self._r, self._rc) if self._nnn > 0 else self._r
+                origin, sc = nplfc.sphere_supercell(positions[magnetic], mus,
+                                                    radius, latpar)
+                mus = mus - origin - np.floor(sc / 2.)
+            neighbours = None
+            if self._nnn > 0 and self._rc > 0:
+                neighbours = neighbour_index(self._sample, self._rc).subset(
+                                                    np.nonzero(magnetic)[0])
+            tensors = nplfc.PhaseTensors(positions[magnetic], k, mus, sc,
+                                         latpar, self._r, self._nnn,
+                                         self._rc, neighbours=neighbours)
+            self._tensors[key] = (tensors, sc, mus, origin)
+        return (magnetic,) + self._tensors[key]
+
+    def locfield(self, ctype, nangles = None, axis = None, mm = None, angles = None, params = None):
+        """
+        Evaluates local fields at the muon sites.
+
+        Same as :py:func:`~muesr.engines.clfc.locfield`, with the
+        supercell, the radius and the contact options given when the
+        cache was created.
+
+        :param str ctype: calculation type. Can be 'sum', 'rotate' or 'incommensurate' (or abbreviations 's', 'r', 'i').
+        :param int nangles: for 'rotate' and 'incommensurate' simulations, a nangles number of  estimation will perfomed on local moments incrementally rotated by 360/nangles.
+        :param list axis: for 'rotate' simulations, axis used to perform the rotation, or a list with one axis for each atom of the cell.
+        :param mm: the magnetic model. If None (default) the current magnetic model of the sample is used.
+        :param list angles: for 'rotate' simulations, list of rotation angles in degrees. If given, `nangles` is ignored.
+        :param params: (n_batch, n_params) array of parameters of a symbolic magnetic model (see :py:meth:`~muesr.core.magmodel.SMM.fc_batch`). The fields of all the sets of parameters are evaluated at once, without changing the model. Default None, i.e. the current Fourier components of the model are used.
+        :return: a list of :py:class:`~muesr.engines.clfc.LocalFields` containing the local field components for each muon site defined in the sample. If `params` is given, the arrays have a leading dimension of size n_batch.
+        :rtype: list
+        :raises: TypeError, ValueError
+        """
+        ctype, nangles, axis = _parse_ctype_args(ctype, nangles, axis, angles)
+
+        if mm is None:
+            self._sample._check_magdefs()
+            mm = self._sample.mm
+
+        k, phi = mm.k, mm.phi
+        if params is None:
+            fc = mm.fc_view()
+            # same selection of clfc.locfield
+            active = fc
+        else:
+            if not mm.isSymbolic:
+                raise TypeError("params can only be used with symbolic models.")
+            fc = mm.fc_batch(params)
+            # atoms magnetic for any set of parameters
+            active = np.abs(fc).max(axis=0)
+        magnetic, tensors, sc, mus, origin = self._get_tensors(active, k)
+        axis = _rotation_axes(self._sample, axis, active)
+
+        phi = phi[magnetic]
+        if self._sc is None:
+            # same phases of clfc.locfield_batch
+            phi = phi + np.dot(k, np.floor(sc / 2.) if ctype == 'i' else origin)
+
+        BC, BD, BL = nplfc.FieldsFromTensors(ctype, tensors,
+                                             fc[..., magnetic, :], k, phi,
+                                             mus, sc, self._r, nangles, axis)
+
+        if params is not None:
+            # sites first
+            BC, BD, BL = [np.moveaxis(B, 0, 1) for B in (BC, BD, BL)]
+        return [LocalFields(c, d, l) for c, d, l in zip(BC, BD, BL)]
+
+    def dipten(self, mm = None):
+        """
+        Calculates the dipolar tensors for the muon sites.
+
+        Same as :py:func:`~muesr.engines.clfc.dipten`, with the
+        supercell and the radius given when the cache was created.
+
+        :param mm: the magnetic model used to select the magnetic atoms. If None (default) the current magnetic model of the sample is used.
+        :return: a list of numpy ndarray containing the dipolar tensor for each muon site defined in the sample.
+        :rtype: list
+        """
+        if mm is None:
+            self._sample._check_magdefs()
+            mm = self._sample.mm
+
+        tensors = self._get_tensors(mm.fc_view(), np.zeros(3))[1]
+        return list(np.real(tensors[0].sum(axis=1)))
@@ -0,0 +1,1216 @@
+"""
+Vectorized NumPy implementation of the lattice sums performed by the
+lfclib extension.
+
+The functions :py:func:`Fields` and :py:func:`DipolarTensor` take the
+same arguments as their lfclib counterparts, but the muon position can
+also be an (N,3) array. In this case the lattice is enumerated only
+once and the sums for all the muon sites are evaluated together.
+"""
+
+import numpy as np
+
+from muesr.core.neighbours import PeriodicNeighbours
+
+# mu_0/(4 pi) * mu_B in T * Angstrom^3
+DIPOLAR_PREFACTOR = 0.9274009
+# (2 mu_0/3) * mu_B in T * Angstrom^3
+CONTACT_PREFACTOR = 7.769376
+
+# maximum number of (muon, atom) pairs evaluated at once
+BLOCK_SIZE = 2**20
+
+# number of lattice translations of a tile. The contributions of the
+# replicas of a tile are summed together and the sums of the tiles are
+# accumulated in order with compensated summation, so that results do
+# not depend on the block size.
+TILE_SIZE = 128
+
+
+def lattice_translations(sc):
+    """
+    Returns the lattice translations spanning the supercell `sc` as an
+    (n,3) float array. The last lattice direction runs fastest.
+    """
+    sc = np.asarray(sc, dtype=np.int64)
+    grid = np.indices(sc).reshape(3, -1).T
+    return grid.astype(np.float64)
+
+
+def muon_supercell_positions(mu, sc, latpar):
+    """
+    Cartesian position of the muon(s) placed in the central cell of
+    the supercell, i.e. in the cell with indexes floor(sc/2).
+    """
+    return np.dot(np.atleast_2d(mu) + np.floor(np.asarray(sc) / 2.), latpar)
+
+
+def sphere_supercell(positions, mu, radius, latpar):
+    """
+    Smallest block of unit cells containing all the replicas of
+    `positions` closer than `radius` to the muon site(s) `mu`
+    (shape (3,) or (N,3), fractional coordinates).
+
+    Returns the lattice translation of the first cell of the block
+    and the number of cells along each lattice vector. To use the
+    block as the supercell of :py:func:`Fields`, the muon positions
+    must be replaced with mu - origin - floor(size/2).
+    """
+    mu = np.atleast_2d(mu)
+    positions = np.atleast_2d(positions)
+    if positions.size == 0:
+        return np.zeros(3), np.ones(3, dtype=np.int32)
+    # half width of the sphere along each lattice direction
+    h = radius * np.linalg.norm(np.linalg.inv(latpar).T, axis=1)
+    lo = np.ceil(mu[:, None, :] - h - positions[None, :, :] - 1e-12)
+    hi = np.floor(mu[:, None, :] + h - positions[None, :, :] + 1e-12)
+    origin = lo.min(axis=(0, 1))
+    size = hi.max(axis=(0, 1)) - origin + 1
+    return origin, np.maximum(size, 1).astype(np.int32)
+
+
+def _images(positions, translations, latpar):
+    """
+    Cartesian positions of all the replicas of `positions` generated
+    by `translations`. Returns an array of shape (nt, na, 3).
+    The products are evaluated element by element, so that each replica
+    is obtained with the same rounding wherever it is in the array.
+    """
+    f = translations[:, None, :] + positions[None, :, :]
+    return f[..., 0, None] * latpar[0] + f[..., 1, None] * latpar[1] + \
+           f[..., 2, None] * latpar[2]
+
+
+def _moments(fcs, k, phi, translations):
+    """
+    Complex magnetic moments of the replicas, i.e.
+    FC exp(-2 pi i (k.T + phi)), for each set of Fourier components
+    in `fcs` (shape (ns, na, 3)). The propagation vector and the phases
+    are either shared by all the sets, with shapes (3,) and (na,), or
+    given for each set, with shapes (ns, 3) and (ns, na).
+    Returns an array of shape (ns, nt, na, 3).
+    """
+    k = np.atleast_2d(k)
+    kT = translations[:, 0] * k[:, 0, None] + \
+         translations[:, 1] * k[:, 1, None] + \
+         translations[:, 2] * k[:, 2, None]
+    phase = np.exp(-2.j * np.pi * (kT[:, :, None] +
+                                   np.atleast_2d(phi)[:, None, :]))
+    return fcs[:, None, :, :] * phase[:, :, :, None]
+
+
+def _blocks(nmu, natoms, ntrans, block_size):
+    """
+    Yields pairs of slices splitting the muon sites and the lattice
+    translations in blocks so that no more than `block_size`
+    (muon, atom) pairs are evaluated at once.
+    The translations are the inner loop.
+    """
+    block_size = max(1, int(block_size))
+    nimages = natoms * ntrans
+    mstep = max(1, min(nmu, block_size // max(1, nimages)))
+    tstep = max(1, block_size // (mstep * max(1, natoms)))
+    for mstart in range(0, nmu, mstep):
+        msl = slice(mstart, min(mstart + mstep, nmu))
+        for tstart in range(0, ntrans, tstep):
+            yield msl, slice(tstart, min(tstart + tstep, ntrans))
+
+
+def _tiles(sc, tsl):
+    """
+    Lattice translations of the tiles in the slice `tsl`, in the order
+    of :py:func:`lattice_translations`, as an array of shape
+    (nt, TILE_SIZE, 3), and the mask of the translations belonging to
+    the supercell, since the last tile can be incomplete.
+    """
+    sc = np.asarray(sc, dtype=np.int64)
+    idx = np.arange(tsl.start * TILE_SIZE, tsl.stop * TILE_SIZE)
+    valid = idx < np.prod(sc)
+    T = np.array(np.unravel_index(np.where(valid, idx, 0), sc),
+                 dtype=np.float64).T
+    return T.reshape(-1, TILE_SIZE, 3), valid.reshape(-1, TILE_SIZE)
+
+
+def _tile_pairs(positions, sc, latpar, mupos, r, rmin, block_size):
+    """
+    Enumerates the replicas of `positions` generated by the lattice
+    translations of the supercell `sc`. The translations are generated
+    in tiles, which are evaluated in blocks of no more than
+    `block_size` (muon, atom) pairs, so that the whole lattice is never
+    stored in memory.
+
+    Yields the slice of the muon sites, the translations of the tiles
+    (nt, TILE_SIZE, 3), the components of the vectors from
+    the muons to the replicas (3, m, nt, na, TILE_SIZE), their length
+    and the mask of the replicas in the spherical shell rmin < d <= r,
+    both of shape (m, nt, na, TILE_SIZE).
+    Tiles with no replicas in the shell of any muon of the block are
+    skipped. Nothing is yielded if there are no atoms.
+    """
+    na = positions.shape[0]
+    if na == 0:
+        return
+    ntiles = -(-int(np.prod(sc)) // TILE_SIZE)
+    for msl, tsl in _blocks(mupos.shape[0], na * TILE_SIZE, ntiles,
+                            block_size):
+        T, valid = _tiles(sc, tsl)
+        images = _images(positions, T.reshape(-1, 3), latpar)
+        images = images.reshape(-1, TILE_SIZE, na, 3).transpose(0, 2, 1, 3)
+        valid = np.broadcast_to(valid[:, None, :], images.shape[:3])
+
+        # skip the tiles far from the bounding sphere of the sites
+        center = mupos[msl].mean(axis=0)
+        spread = np.max(np.linalg.norm(mupos[msl] - center, axis=1))
+        d = np.linalg.norm(images - center, axis=3)
+        margin = 1e-6 * (1. + r)
+        keep = np.any(valid & (d <= r + spread + margin), axis=(1, 2))
+        if rmin > 0:
+            keep &= np.any(valid & (d > rmin - spread - margin), axis=(1, 2))
+        if not np.any(keep):
+            continue
+
+        images = images[keep]
+        rvec = np.array([images[None, :, :, :, i] -
+                         mupos[msl, i, None, None, None] for i in range(3)])
+        dist = np.sqrt(rvec[0] * rvec[0] + rvec[1] * rvec[1] +
+                       rvec[2] * rvec[2])
+        inside = (dist <= r) & (dist > rmin) & valid[None, keep]
+        yield msl, T[keep], rvec, dist, inside
+
+
+class _TileSum(object):
+    """
+    Compensated (Kahan) summation of the sums of the tiles of lattice
+    translations, of shape (nmu,) + `shape`. The tiles must be added in
+    order. A tile is added to the sum of a muon site only if one of its
+    replicas contributes, i.e. tiles without contributions are
+    equivalent to skipped tiles.
+    """
+
+    def __init__(self, nmu, shape, dtype=np.float64):
+        self.total = np.zeros((nmu,) + tuple(shape), dtype=dtype)
+        self._comp = np.zeros_like(self.total)
+
+    def add(self, msl, values, mask):
+        """
+        Adds the sums of the tiles `values`, of shape (m, nt) + shape,
+        to the muon sites `msl` where `mask` (shape (m, nt)) is True.
+        """
+        total = self.total[msl]
+        comp = self._comp[msl]
+        extra = (None,) * (values.ndim - 2)
+        for t in range(values.shape[1]):
+            m = mask[(slice(None), t) + extra]
+            y = values[:, t] - comp
+            s = total + y
+            comp = np.where(m, (s - total) - y, comp)
+            total = np.where(m, s, total)
+        self.total[msl] = total
+        self._comp[msl] = comp
+
+
+def _tile_sum(x):
+    """
+    Sums of the contributions of the replicas of each tile: the last
+    two axes, (na, TILE_SIZE), are summed.
+    """
+    x = np.ascontiguousarray(x)
+    return x.reshape(x.shape[:-2] + (-1,)).sum(axis=-1)
+
+
+def _complex_fields(positions, fcs, k, phi, mupos, sc, latpar, r, nnn, rc,
+                    block_size=BLOCK_SIZE, rmin=0., neighbours=None,
+                    gradient=False):
+    """
+    Evaluates the contact, dipolar and Lorentz fields generated by
+    complex moments for the sets of Fourier components `fcs` (shape
+    (ns, na, 3)) at the Cartesian positions `mupos` (shape (nmu, 3)).
+    Each set can have its own propagation vector and phases (see
+    :py:func:`_moments`).
+    If `gradient` is True, the derivatives of the contact and dipolar
+    fields with respect to the muon position are also evaluated, in
+    the same pass over the lattice.
+
+    The lattice is enumerated in tiles of translations and memory usage
+    is bounded by `block_size` (muon, atom) pairs. The sums of the tiles
+    are accumulated with compensated summation and the results do not
+    depend on `block_size`.
+    If `rmin` is positive, only the moments in the spherical shell
+    rmin < d <= r contribute to the dipolar and Lorentz fields.
+    The nearest moments used for the contact field are searched with
+    `neighbours`, a :py:class:`~muesr.core.neighbours.PeriodicNeighbours`
+    index of `positions`, which is built if not given.
+
+    Returns three complex arrays of shape (ns, nmu, 3), followed by
+    the Jacobians dB_i/dx_j of the contact and of the dipolar fields,
+    of shape (ns, nmu, 3, 3), if `gradient` is True. The physical
+    fields are obtained by taking the real part.
+    """
+    ns = fcs.shape[0]
+    nmu = mupos.shape[0]
+    na = positions.shape[0]
+
+    SD = _TileSum(nmu, [ns, 3], np.complex128)
+    SL = _TileSum(nmu, [ns, 3], np.complex128)
+    if gradient:
+        SG = _TileSum(nmu, [ns, 3, 3], np.complex128)
+
+    for msl, T, rvec, dist, inside in _tile_pairs(positions, sc, latpar,
+                                                  mupos, r, rmin,
+                                                  block_size):
+        # moments of the replicas, shape (ns, nt, na, TILE_SIZE) for each
+        # component
+        moments = _moments(fcs, k, phi, T.reshape(-1, 3))
+        moments = moments.reshape(ns, -1, TILE_SIZE, na, 3)
+        moments = [np.ascontiguousarray(moments[..., i].transpose(0, 1, 3, 2))
+                   [:, None] for i in range(3)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ir3 = np.where(inside, 1. / dist**3, 0.)
+            ir5 = np.where(inside, 3. / dist**5, 0.)
+        rm = rvec[0] * moments[0] + rvec[1] * moments[1] + \
+             rvec[2] * moments[2]
+
+        BD = np.array([_tile_sum(ir5 * rm * rvec[i] - ir3 * moments[i])
+                       for i in range(3)])
+        BL = np.array([_tile_sum(np.where(inside, moments[i], 0.))
+                       for i in range(3)])
+
+        mask = np.any(inside, axis=(2, 3))
+        # (3, ns, m, nt) -> (m, nt, ns, 3)
+        SD.add(msl, BD.transpose(2, 3, 1, 0), mask)
+        SL.add(msl, BL.transpose(2, 3, 1, 0), mask)
+
+        if gradient:
+            # derivatives of the dipolar kernel with respect to the
+            # replica position, which are symmetric. The muon moves
+            # in the opposite direction.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ir7 = np.where(inside, 15. / dist**7, 0.)
+            G = np.empty((3, 3) + BD.shape[1:], dtype=np.complex128)
+            for i in range(3):
+                for j in range(i, 3):
+                    x = ir5 * (rvec[i] * moments[j] + moments[i] * rvec[j]) - \
+                        ir7 * rm * rvec[i] * rvec[j]
+                    if i == j:
+                        x = x + ir5 * rm
+                    G[i, j] = G[j, i] = -_tile_sum(x)
+            # (3, 3, ns, m, nt) -> (m, nt, ns, 3, 3)
+            SG.add(msl, G.transpose(3, 4, 2, 0, 1), mask)
+
+    BD = SD.total.transpose(1, 0, 2)
+    BL = SL.total.transpose(1, 0, 2)
+
+    BD *= DIPOLAR_PREFACTOR
+    if r > 0:
+        BL *= DIPOLAR_PREFACTOR / r**3
+    else:
+        BL[:] = 0.
+
+    points = np.dot(mupos, np.linalg.inv(latpar))
+    w, atoms, T = contact_weights(positions, latpar, points, nnn, rc,
+                                  neighbours)
+    # shape (1, nmu, nnn), or (ns, nmu, nnn) with a k for each set
+    phase = np.exp(-2.j * np.pi * (np.moveaxis(np.dot(T, np.atleast_2d(k).T),
+                                               -1, 0) +
+                                   np.atleast_2d(phi)[:, atoms]))
+    BC = CONTACT_PREFACTOR * np.einsum('smn,smnk->smk', w * phase,
+                                       fcs[:, atoms, :])
+
+    if not gradient:
+        return BC, BD, BL
+
+    GD = DIPOLAR_PREFACTOR * SG.total.transpose(1, 0, 2, 3)
+    dw = _contact_weight_gradients(positions, latpar, points, w, atoms, T)
+    GC = CONTACT_PREFACTOR * np.einsum('mnj,smn,smnk->smkj', dw, phase,
+                                       fcs[:, atoms, :])
+    return BC, BD, BL, GC, GD
+
+
+def _near_fields(positions, fcs, k, phi, mupos, disp, sc, latpar, rnear,
+                 block_size=BLOCK_SIZE):
+    """
+    Dipolar fields generated by the moments closer than `rnear` to the
+    Cartesian positions `mupos` (shape (nmu, 3)), evaluated at the
+    displaced positions mupos + disp, with `disp` of shape (nmu, nd, 3).
+    The moments are selected around the undisplaced positions, so that
+    the same moments contribute for all the displacements.
+
+    Returns the complex dipolar fields, of shape (ns, nmu, nd, 3),
+    without the prefactor, and the sums of the moments, of shape
+    (ns, nmu, 3), used for the Lorentz field.
+    """
+    ns = fcs.shape[0]
+    nmu, nd = disp.shape[:2]
+    na = positions.shape[0]
+
+    SD = _TileSum(nmu, [nd, ns, 3], np.complex128)
+    SL = _TileSum(nmu, [ns, 3], np.complex128)
+
+    # the displacements multiply the number of pairs
+    for msl, T, rvec, dist, inside in _tile_pairs(positions, sc, latpar,
+                                                  mupos, rnear, 0.,
+                                                  max(1, block_size // nd)):
+        moments = _moments(fcs, k, phi, T.reshape(-1, 3))
+        moments = moments.reshape(ns, -1, TILE_SIZE, na, 3)
+        moments = [np.ascontiguousarray(moments[..., i].transpose(0, 1, 3, 2))
+                   for i in range(3)]
+
+        # (m, nd, nt, na, TILE_SIZE)
+        rv = [rvec[i][:, None] - disp[msl, :, i, None, None, None]
+              for i in range(3)]
+        near = np.broadcast_to(inside[:, None], rv[0].shape)
+        dist = np.sqrt(rv[0] * rv[0] + rv[1] * rv[1] + rv[2] * rv[2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ir3 = np.where(near, 1. / dist**3, 0.)
+            ir5 = np.where(near, 3. / dist**5, 0.)
+        m = [x[:, None, None] for x in moments]
+        rm = rv[0] * m[0] + rv[1] * m[1] + rv[2] * m[2]
+
+        BD = np.array([_tile_sum(ir5 * rm * rv[i] - ir3 * m[i])
+                       for i in range(3)])
+        BL = np.array([_tile_sum(np.where(inside, x[:, None], 0.))
+                       for x in moments])
+
+        mask = np.any(inside, axis=(2, 3))
+        # (3, ns, m, nd, nt) -> (m, nt, nd, ns, 3)
+        SD.add(msl, BD.transpose(2, 4, 3, 1, 0), mask)
+        # (3, ns, m, nt) -> (m, nt, ns, 3)
+        SL.add(msl, BL.transpose(2, 3, 1, 0), mask)
+
+    return SD.total.transpose(2, 0, 1, 3), SL.total.transpose(1, 0, 2)
+
+
+def contact_weights(positions, latpar, points, nnn, rc, neighbours=None):
+    """
+    Weights of the `nnn` moments nearest to each point, not farther
+    than `rc`, in the estimate of the contact field. The weights are
+    proportional to 1/r^3 and normalized to one.
+
+    :param positions: atomic positions in fractional coordinates.
+    :param latpar: lattice vectors (rows).
+    :param points: (N,3) array of positions in fractional coordinates.
+    :param int nnn: number of nearest neighbours.
+    :param float rc: maximum distance of the neighbours.
+    :param neighbours: a :py:class:`~muesr.core.neighbours.PeriodicNeighbours`
+                       index of `positions`. Built if None.
+    :return: the weights (N, nnn), the indexes of the atoms (N, nnn)
+             and the lattice translations (N, nnn, 3) of the neighbours.
+             Missing neighbours have null weight. If there are no atoms
+             the arrays have no neighbours, i.e. shape (N, 0).
+    :rtype: tuple
+    """
+    points = np.atleast_2d(points)
+    nmu = points.shape[0]
+    if nnn <= 0 or rc <= 0 or positions.shape[0] == 0:
+        n = max(nnn, 0) if positions.shape[0] > 0 else 0
+        return (np.zeros([nmu, n]),
+                np.zeros([nmu, n], dtype=np.int64),
+                np.zeros([nmu, n, 3]))
+
+    if neighbours is None or neighbours.cutoff < rc:
+        neighbours = PeriodicNeighbours(latpar, positions, rc)
+    dist, atoms, T = neighbours.query(points, nnn, rc)
+
+    valid = atoms >= 0
+    w = np.where(valid, 1. / np.where(valid, dist, 1.)**3, 0.)
+    wsum = w.sum(axis=1)
+    wsum[wsum == 0] = 1.
+    return w / wsum[:, None], np.where(valid, atoms, 0), T
+
+
+def _contact_weight_gradients(positions, latpar, points, w, atoms, T):
+    """
+    Derivatives, with respect to the Cartesian position of the point,
+    of the weights returned by :py:func:`contact_weights`. Returns an
+    array of shape (N, nnn, 3).
+    """
+    valid = w > 0
+    rvec = np.dot(positions[atoms] + T - points[:, None, :], latpar)
+    d = np.sqrt(np.einsum('mnk,mnk->mn', rvec, rvec))
+    d = np.where(valid, d, 1.)
+    u = np.where(valid, 1. / d**3, 0.)
+    du = np.where(valid, 3. / d**5, 0.)[:, :, None] * rvec
+    U = u.sum(axis=1)
+    U[U == 0] = 1.
+    return (du - w[:, :, None] * du.sum(axis=1)[:, None, :]) / \
+           U[:, None, None]
+
+
+def _rotation_sets(fc, axis):
+    """
+    Fourier components needed to evaluate the fields generated by the
+    moments rotated around `axis`:
+
+    R(t) m = cos(t) m + sin(t) axis x m + (1 - cos(t)) axis (axis . m)
+
+    `axis` is either a single axis or an (na, 3) array with an axis for
+    each atom.
+    """
+    axis = np.broadcast_to(np.asarray(axis, dtype=np.float64), fc.shape)
+    fc_cross = np.cross(axis, fc)
+    fc_par = axis * np.sum(fc * axis, axis=-1)[..., None]
+    return np.array([fc, fc_cross, fc_par])
+
+
+def _incommensurate_phase(K, Muon, sc):
+    """
+    Phase from which lfclib measures the angles of 'i' calculations.
+    """
+    return 2. * np.pi * (2. * np.dot(K, np.floor(sc / 2.)) +
+                         np.dot(np.atleast_2d(Muon), K))
+
+
+def Fields(calc_type, positions, FC, K, Phi, Muon, Supercell, Cell, r,
+           nnn, rcont, nangles=None, rot_axis=None, block_size=BLOCK_SIZE,
+           neighbours=None):
+    """
+    Calculates the local field components at the muon site(s).
+
+    Arguments are the same as lfclib.Fields, but `Muon` can either be
+    a single position of shape (3,) or an (N,3) array of positions in
+    fractional coordinates.
+
+    The returned arrays have shape (3,) for 's' calculations and
+    (nangles,3) for 'r' and 'i' calculations. When N muon sites are
+    given a leading dimension of size N is added.
+
+    :param str calc_type: 's', 'r' or 'i'
+    :param positions: atomic positions in fractional coordinates.
+    :param FC: Fourier components in Cartesian coordinates.
+    :param K: propagation vector in r.l.u.
+    :param Phi: phases in units of 2 pi.
+    :param Muon: muon position(s) in fractional coordinates.
+    :param Supercell: number of replicas along the lattice vectors.
+    :param Cell: lattice vectors (rows).
+    :param float r: Lorentz sphere radius.
+    :param int nnn: number of nearest neighbours for the contact field.
+    :param float rcont: maximum distance for the contact field neighbours.
+    :param nangles: number of divisions of the full turn or array of
+                    angles in radians.
+    :param rot_axis: rotation axis for 'r' calculations, or (na,3) array
+                     of axes, one for each atom.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated
+                           at once. Bounds the memory used by the sums,
+                           which do not depend on it.
+    :param neighbours: a :py:class:`~muesr.core.neighbours.PeriodicNeighbours`
+                       index of `positions` used for the contact field.
+                       Built if None.
+    :return: Contact, Dipolar and Lorentz fields in Tesla.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.asarray(Muon, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+
+    single = (Muon.ndim == 1)
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+
+    fcs = fourier_component_sets(calc_type, FC, rot_axis)
+    fields = _complex_fields(positions, fcs, K, Phi, mupos, sc, Cell,
+                             float(r), int(nnn), float(rcont), block_size,
+                             neighbours=neighbours)
+    alpha = _incommensurate_phase(K, Muon, sc)
+    res = [assemble(calc_type, B, alpha, nangles) for B in fields]
+
+    if single:
+        res = [B[0] for B in res]
+    return tuple(res)
+
+
+def ModelFields(calc_type, positions, FC, K, Phi, Muon, Supercell, Cell, r,
+                nnn, rcont, nangles=None, rot_axis=None, block_size=BLOCK_SIZE,
+                neighbours=None):
+    """
+    Calculates the local field components of many magnetic models, e.g.
+    magnetic domains or arms of the star of the propagation vector, in
+    a single pass over the lattice. The replicas of the atoms and their
+    distances from the muons are shared by all the models.
+
+    Arguments are the same as in :py:func:`Fields`, but each model has
+    its own Fourier components, propagation vector and phases:
+
+    :param FC: (nm,na,3) Fourier components in Cartesian coordinates.
+               Atoms with null Fourier components are not magnetic in
+               the model and are ignored by its contact field.
+    :param K: (nm,3) propagation vectors in r.l.u.
+    :param Phi: (nm,na) phases in units of 2 pi.
+    :param rot_axis: rotation axis for 'r' calculations, or (na,3) array
+                     of axes, one for each atom, shared by all the models.
+    :param neighbours: list with a
+                       :py:class:`~muesr.core.neighbours.PeriodicNeighbours`
+                       index of the magnetic atoms of each model, used for
+                       the contact field. Built if None.
+    :return: Contact, Dipolar and Lorentz fields in Tesla, with a leading
+             dimension of size nm.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+    nm = FC.shape[0]
+
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+
+    # the sets of all the models are summed together
+    fcs = np.array([fourier_component_sets(calc_type, f, rot_axis)
+                    for f in FC])
+    ns = fcs.shape[1]
+    _, BD, BL = _complex_fields(positions,
+                                fcs.reshape((nm * ns,) + FC.shape[1:]),
+                                np.repeat(K, ns, axis=0),
+                                np.repeat(Phi, ns, axis=0), mupos, sc, Cell,
+                                float(r), 0, 0., block_size)
+    BD = BD.reshape((nm, ns) + BD.shape[1:])
+    BL = BL.reshape((nm, ns) + BL.shape[1:])
+
+    # the nearest moments of the contact field depend on the model
+    points = np.dot(mupos, np.linalg.inv(Cell))
+    BC = np.zeros_like(BD)
+    for m in range(nm):
+        magnetic = np.flatnonzero(np.any(FC[m] != 0, axis=1))
+        w, atoms, T = contact_weights(positions[magnetic], Cell, points,
+                                      int(nnn), float(rcont),
+                                      None if neighbours is None
+                                      else neighbours[m])
+        atoms = magnetic[atoms] if magnetic.size else atoms
+        phase = np.exp(-2.j * np.pi * (np.dot(T, K[m]) + Phi[m, atoms]))
+        BC[m] = CONTACT_PREFACTOR * np.einsum('mn,smnk->smk', w * phase,
+                                              fcs[m][:, atoms, :])
+
+    res = []
+    for B in (BC, BD, BL):
+        res.append(np.array([assemble(calc_type, B[m],
+                                      _incommensurate_phase(K[m], Muon, sc),
+                                      nangles) for m in range(nm)]))
+    return tuple(res)
+
+
+def KScanFields(calc_type, positions, FC, K, Phi, Muon, Supercell, Cell, r,
+                nnn, rcont, nangles=None, rot_axis=None, block_size=BLOCK_SIZE,
+                neighbours=None, offset=None):
+    """
+    Calculates the local field components at the muon sites for many
+    propagation vectors in a single pass over the lattice.
+
+    Only the phases exp(-2 pi i K.T) of the lattice translations T
+    depend on the propagation vector. The dipolar kernels are applied
+    to the Fourier components once for each replica and summed over
+    the atoms. The sums over the translations of a tile are then
+    evaluated for all the propagation vectors with a single matrix
+    product.
+
+    Arguments are the same as in :py:func:`Fields`, with:
+
+    :param K: (nk,3) array of propagation vectors in r.l.u.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated
+                           at once. It is further reduced so that the
+                           sums of the tiles of all the propagation
+                           vectors do not exceed it.
+    :param offset: lattice translation added to the translations of the
+                   supercell in the phases. Default None, i.e. zero.
+    :return: Contact, Dipolar and Lorentz fields in Tesla, with shape
+             (nk,N,3) for 's' calculations and (nk,N,nangles,3) for 'r'
+             and 'i' calculations.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.atleast_2d(np.asarray(K, dtype=np.float64))
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+    offset = np.zeros(3) if offset is None else \
+             np.asarray(offset, dtype=np.float64)
+    r = float(r)
+
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+    nmu = mupos.shape[0]
+    na = positions.shape[0]
+    nk = K.shape[0]
+
+    fcs = fourier_component_sets(calc_type, FC, rot_axis)
+    ns = fcs.shape[0]
+    # moments of the replicas in the cell at the origin, (ns, na) for
+    # each component
+    m0 = fcs * np.exp(-2.j * np.pi * Phi)[None, :, None]
+    m0 = [m0[:, :, i, None] for i in range(3)]
+
+    SD = _TileSum(nmu, [nk, ns, 3], np.complex128)
+    SL = _TileSum(nmu, [nk, ns, 3], np.complex128)
+
+    # each (muon, tile) pair stores the sums of all the k vectors
+    block_size = max(1, min(block_size, block_size * na * TILE_SIZE //
+                                        (2 * 3 * ns * nk)))
+    for msl, T, rvec, dist, inside in _tile_pairs(positions, sc, Cell,
+                                                  mupos, r, 0., block_size):
+        m = inside.shape[0]
+        nt = T.shape[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ir3 = np.where(inside, 1. / dist**3, 0.)
+            ir5 = np.where(inside, 3. / dist**5, 0.)
+
+        # sums over the atoms, shape (2, 3, ns, m, nt, TILE_SIZE)
+        Y = np.empty((2, 3, ns, m, nt, TILE_SIZE), dtype=np.complex128)
+        for s in range(ns):
+            mm = [x[s] for x in m0]
+            rm = rvec[0] * mm[0] + rvec[1] * mm[1] + rvec[2] * mm[2]
+            for i in range(3):
+                Y[0, i, s] = (ir5 * rm * rvec[i] - ir3 * mm[i]).sum(axis=2)
+                Y[1, i, s] = np.where(inside, mm[i], 0.).sum(axis=2)
+
+        # phases of the translations of each tile, (nt, TILE_SIZE, nk)
+        Tk = T + offset
+        phase = np.exp(-2.j * np.pi * np.dot(Tk, K.T))
+        Z = np.matmul(Y.transpose(4, 0, 1, 2, 3, 5).reshape(nt, -1, TILE_SIZE),
+                      phase)
+        # (nt, 2, 3, ns, m, nk) -> (2, m, nt, nk, ns, 3)
+        Z = Z.reshape(nt, 2, 3, ns, m, nk).transpose(1, 4, 0, 5, 3, 2)
+
+        mask = np.any(inside, axis=(2, 3))
+        SD.add(msl, Z[0], mask)
+        SL.add(msl, Z[1], mask)
+
+    # (nmu, nk, ns, 3) -> (nk, ns, nmu, 3)
+    BD = DIPOLAR_PREFACTOR * SD.total.transpose(1, 2, 0, 3)
+    BL = SL.total.transpose(1, 2, 0, 3)
+    if r > 0:
+        BL *= DIPOLAR_PREFACTOR / r**3
+    else:
+        BL[:] = 0.
+
+    points = np.dot(mupos, np.linalg.inv(Cell))
+    w, atoms, T = contact_weights(positions, Cell, points, int(nnn),
+                                  float(rcont), neighbours)
+    phase = np.exp(-2.j * np.pi * (np.dot(T + offset, K.T) +
+                                   Phi[atoms, None]))
+    BC = CONTACT_PREFACTOR * np.einsum('mn,mnq,smnc->qsmc', w, phase,
+                                       fcs[:, atoms, :])
+
+    res = []
+    for B in (BC, BD, BL):
+        res.append(np.array([assemble(calc_type, B[q],
+                                      _incommensurate_phase(K[q], Muon, sc),
+                                      nangles) for q in range(nk)]))
+    return tuple(res)
+
+
+def FieldGradients(positions, FC, K, Phi, Muon, Supercell, Cell, r, nnn,
+                   rcont, block_size=BLOCK_SIZE, neighbours=None):
+    """
+    Calculates the local field components of 's' calculations at the
+    muon sites together with their derivatives with respect to the
+    muon position, using the analytic derivatives of the dipolar
+    kernel and of the weights of the contact field.
+
+    The Lorentz field does not depend on the muon position as long as
+    no moment enters or leaves the Lorentz sphere, so its derivative
+    is null.
+    Arguments are the same as in :py:func:`Fields`.
+
+    :return: Contact, Dipolar and Lorentz fields (N,3) in Tesla, and
+             the Jacobians of the Contact and Dipolar fields (N,3,3),
+             J[i,j] = dB_i/dx_j, in Tesla/Angstrom, with x the
+             Cartesian position of the muon.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+    fields = _complex_fields(positions, FC[None], K, Phi, mupos, sc, Cell,
+                             float(r), int(nnn), float(rcont), block_size,
+                             neighbours=neighbours, gradient=True)
+    return tuple(np.real(B[0]) for B in fields)
+
+
+def ComplexFields(positions, FC, K, Phi, Muon, Supercell, Cell, r, nnn,
+                  rcont, block_size=BLOCK_SIZE, neighbours=None):
+    """
+    Calculates the complex amplitudes of the local field components at
+    the muon sites. The fields of an 'i' calculation at the angle t are
+    Re[B exp(i(alpha - t))], so that the fields at any number of angles
+    are obtained without storing them.
+
+    Arguments are the same as in :py:func:`Fields`.
+
+    :return: the complex Contact, Dipolar and Lorentz fields (N,3) in
+             Tesla and the phases alpha (N,).
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+    fields = _complex_fields(positions, FC[None], K, Phi, mupos, sc, Cell,
+                             float(r), int(nnn), float(rcont), block_size,
+                             neighbours=neighbours)
+    return tuple(B[0] for B in fields) + (_incommensurate_phase(K, Muon, sc),)
+
+
+def DisplacedFields(calc_type, positions, FC, K, Phi, Muon, Supercell, Cell,
+                    r, nnn, rcont, displacements, rnear, nangles=None,
+                    rot_axis=None, block_size=BLOCK_SIZE, neighbours=None):
+    """
+    Calculates the local field components at many displaced positions
+    around each muon site, e.g. to average the fields over the zero
+    point motion of the muon.
+
+    The Lorentz sphere is centred at the undisplaced site for all the
+    displacements. The moments closer than `rnear` to the site are
+    summed exactly at each displaced position. The field of the other
+    moments of the sphere, which is smooth on the scale of the
+    displacements, is evaluated once at the site together with its
+    derivative and expanded to first order in the displacement.
+    The contact field is evaluated at each displaced position.
+
+    Arguments are the same as in :py:func:`Fields`, with:
+
+    :param displacements: (N,S,3) array of S Cartesian displacements,
+                          in Angstrom, for each of the N muon sites.
+    :param float rnear: radius of the sphere of moments summed exactly.
+    :return: Contact, Dipolar and Lorentz fields in Tesla, with shape
+             (N,S,3) for 's' calculations and (N,S,nangles,3) for 'r'
+             and 'i' calculations.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+    disp = np.asarray(displacements, dtype=np.float64)
+    r = float(r)
+    rnear = min(float(rnear), r)
+    nmu, nd = disp.shape[:2]
+
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+    fcs = fourier_component_sets(calc_type, FC, rot_axis)
+    ns = fcs.shape[0]
+
+    BD, SL = _near_fields(positions, fcs, K, Phi, mupos, disp, sc, Cell,
+                          rnear, block_size)
+    BD *= DIPOLAR_PREFACTOR
+    BL = SL * (DIPOLAR_PREFACTOR / r**3) if r > 0 else np.zeros_like(SL)
+    if rnear < r:
+        _, FD, FL, _, GD = _complex_fields(positions, fcs, K, Phi, mupos, sc,
+                                           Cell, r, 0, 0., block_size,
+                                           rmin=rnear, gradient=True)
+        # first order expansion of the field of the far moments
+        BD += FD[:, :, None, :] + np.einsum('smkj,mdj->smdk', GD, disp)
+        BL += FL
+    BL = np.broadcast_to(BL[:, :, None, :], BD.shape)
+
+    icell = np.linalg.inv(Cell)
+    points = np.dot((mupos[:, None, :] + disp).reshape(-1, 3), icell)
+    w, atoms, T = contact_weights(positions, Cell, points, int(nnn),
+                                  float(rcont), neighbours)
+    phase = np.exp(-2.j * np.pi * (np.dot(T, K) + Phi[atoms]))
+    BC = CONTACT_PREFACTOR * np.einsum('mn,smnk->smk', w * phase,
+                                       fcs[:, atoms, :])
+
+    alpha = _incommensurate_phase(K, (Muon[:, None, :] +
+                                      np.dot(disp, icell)).reshape(-1, 3), sc)
+    res = [assemble(calc_type, B.reshape(ns, -1, 3), alpha, nangles)
+           for B in (BC, BD, BL)]
+    return tuple(B.reshape((nmu, nd) + B.shape[1:]) for B in res)
+
+
+def AdaptiveFields(calc_type, positions, FC, K, Phi, Muon, Cell, radius,
+                   step, max_radius, tolerance, nnn, rcont, nangles=None,
+                   rot_axis=None, block_size=BLOCK_SIZE):
+    """
+    Calculates the local field components at a single muon site,
+    increasing the radius of the Lorentz sphere until the fields are
+    converged.
+
+    The sums start from a sphere of radius `radius` which is grown by
+    `step` at each iteration. Only the moments in the new spherical
+    shell are evaluated and added to the sums of the inner sphere.
+    The iterations stop when the dipolar and the Lorentz fields change
+    by less than `tolerance` in two consecutive shells, or when
+    `max_radius` is reached.
+
+    The phases refer to the unit cell at the origin, as for the
+    automatic supercell of :py:mod:`muesr.engines.clfc`.
+
+    :param str calc_type: 's', 'r' or 'i'
+    :param positions: atomic positions in fractional coordinates.
+    :param FC: Fourier components in Cartesian coordinates.
+    :param K: propagation vector in r.l.u.
+    :param Phi: phases in units of 2 pi.
+    :param Muon: muon position of shape (3,) in fractional coordinates.
+    :param Cell: lattice vectors (rows).
+    :param float radius: initial radius of the Lorentz sphere.
+    :param float step: radius increment.
+    :param float max_radius: maximum radius of the Lorentz sphere.
+    :param float tolerance: convergence threshold in Tesla.
+    :param int nnn: number of nearest neighbours for the contact field.
+    :param float rcont: maximum distance for the contact field neighbours.
+    :param nangles: number of divisions of the full turn or array of
+                    angles in radians.
+    :param rot_axis: rotation axis for 'r' calculations, or (na,3) array
+                     of axes, one for each atom.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated
+                           at once.
+    :return: Contact, Dipolar and Lorentz fields in Tesla, the final
+             radius and the largest change of the fields in the last
+             two shells, used as error estimate (inf if less than two
+             shells were added).
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    FC = np.asarray(FC, dtype=np.complex128)
+    K = np.asarray(K, dtype=np.float64)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    Muon = np.asarray(Muon, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+
+    fcs = fourier_component_sets(calc_type, FC, rot_axis)
+    alpha = 2. * np.pi * np.atleast_1d(np.dot(K, Muon))
+
+    def shell(rmin, rmax, nnn):
+        # sums over the block of cells enclosing the sphere, referred
+        # to the unit cell at the origin
+        origin, sc = sphere_supercell(positions, Muon,
+                                      max(rmax, rcont) if nnn > 0 else rmax,
+                                      Cell)
+        mupos = np.dot(Muon - origin, Cell)[None, :]
+        BC, BD, BL = _complex_fields(positions, fcs, K,
+                                     Phi + np.dot(K, origin), mupos, sc,
+                                     Cell, rmax, nnn, rcont, block_size,
+                                     rmin)
+        # Lorentz sums are accumulated without the 1/r^3 factor
+        return BC, BD, BL * rmax**3
+
+    def fields(B):
+        return assemble(calc_type, B, alpha, nangles)[0]
+
+    r = float(radius)
+    BC, BD, SL = shell(0., r, int(nnn))
+    D, L = fields(BD), fields(SL / r**3)
+
+    changes = []
+    while r < max_radius:
+        rn = min(r + step, max_radius)
+        _, dBD, dSL = shell(r, rn, 0)
+        BD += dBD
+        SL += dSL
+        r = rn
+
+        Dn, Ln = fields(BD), fields(SL / r**3)
+        changes.append(max(np.max(np.abs(Dn - D)), np.max(np.abs(Ln - L))))
+        D, L = Dn, Ln
+
+        if len(changes) > 1 and max(changes[-2:]) < tolerance:
+            break
+
+    error = max(changes[-2:]) if len(changes) > 1 else np.inf
+    return fields(BC), D, L, r, error
+
+
+def fourier_component_sets(calc_type, FC, rot_axis=None):
+    """
+    Sets of Fourier components, with shape (ns, na, 3), whose fields
+    are combined by :py:func:`assemble` to obtain the result of a
+    calculation of type `calc_type`. If `FC` has shape (nb, na, 3),
+    the sets have shape (ns, nb, na, 3).
+    """
+    if calc_type == 's' or calc_type == 'i':
+        return FC[None]
+    elif calc_type == 'r':
+        return _rotation_sets(FC, rot_axis)
+    raise ValueError("Invalid calculation type.")
+
+
+def rotation_angles(nangles):
+    """
+    Angles, in radians, of 'r' and 'i' calculations. `nangles` is
+    either the number of divisions of the full turn or an array of
+    angles in radians.
+    """
+    angles = np.asarray(nangles, dtype=np.float64)
+    if angles.ndim == 0:
+        return 2. * np.pi * np.arange(int(nangles)) / int(nangles)
+    return angles.reshape(-1)
+
+
+def assemble(calc_type, B, alpha=None, nangles=None):
+    """
+    Combines the complex fields `B` (shape (ns, nmu, 3), or
+    (ns, nb, nmu, 3) for batches of Fourier components) generated by
+    the sets of :py:func:`fourier_component_sets` into the real fields
+    of a calculation of type `calc_type`.
+
+    For 'i' calculations `alpha` (shape (nmu,)) is the phase from which
+    the angles are measured. `nangles` is the number of divisions of
+    the full turn or an array of angles (see :py:func:`rotation_angles`).
+    Returns an array of shape (nmu, 3) or (nmu, nangles, 3), with a
+    leading dimension nb for batches.
+    """
+    if calc_type == 's':
+        return np.real(B[0])
+
+    angles = rotation_angles(nangles)
+    if calc_type == 'i':
+        rot = np.exp(1.j * (alpha[:, None] - angles[None, :]))
+        return np.real(B[0][..., None, :] * rot[:, :, None])
+    elif calc_type == 'r':
+        coeffs = np.array([np.cos(angles), np.sin(angles),
+                           1. - np.cos(angles)])
+        return np.einsum('sa,s...mk->...mak', coeffs, np.real(B))
+    raise ValueError("Invalid calculation type.")
+
+
+def PhaseTensors(positions, K, Muon, Supercell, Cell, r, nnn, rcont,
+                 block_size=BLOCK_SIZE, neighbours=None, gradient=False):
+    """
+    Lattice sums connecting each atom to each muon site, weighted by
+    the phases exp(-2 pi i K.T) of the lattice translations T.
+
+    The fields generated by any set of Fourier components and phases
+    with propagation vector `K` are obtained from these sums with
+    :py:func:`FieldsFromTensors`, without enumerating the lattice
+    again.
+
+    :param positions: atomic positions in fractional coordinates.
+    :param K: propagation vector in r.l.u.
+    :param Muon: (N,3) array of muon positions in fractional coordinates.
+    :param Supercell: number of replicas along the lattice vectors.
+    :param Cell: lattice vectors (rows).
+    :param float r: Lorentz sphere radius.
+    :param int nnn: number of nearest neighbours for the contact field.
+    :param float rcont: maximum distance for the contact field neighbours.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated
+                           at once.
+    :param neighbours: a :py:class:`~muesr.core.neighbours.PeriodicNeighbours`
+                       index of `positions` used for the contact field.
+                       Built if None.
+    :param bool gradient: if True, the derivatives of the dipolar tensors
+                          and of the contact weights with respect to the
+                          Cartesian muon position are also returned.
+    :return: the dipolar tensors (N, na, 3, 3) in 1/Angstrom^3, the
+             number of replicas inside the Lorentz sphere (N, na) and
+             the contact weights (N, na), all weighted by the phases.
+             If `gradient` is True, they are followed by the
+             derivatives of the dipolar tensors (N, na, 3, 3, 3) and of
+             the contact weights (N, na, 3), the last index being the
+             direction of the displacement. These are used with
+             :py:func:`GradientsFromTensors`.
+    :rtype: tuple
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    K = np.asarray(K, dtype=np.float64)
+    Muon = np.atleast_2d(np.asarray(Muon, dtype=np.float64))
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+    r = float(r)
+    nnn = int(nnn)
+    rc = float(rcont)
+
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+
+    nmu = mupos.shape[0]
+    na = positions.shape[0]
+
+    SD = _TileSum(nmu, [na, 3, 3], np.complex128)
+    SL = _TileSum(nmu, [na], np.complex128)
+    if gradient:
+        SG = _TileSum(nmu, [na, 3, 3, 3], np.complex128)
+
+    for msl, T, rvec, dist, inside in _tile_pairs(positions, sc, Cell,
+                                                  mupos, r, 0., block_size):
+        # phases of the translations, shape (nt, 1, TILE_SIZE)
+        kT = T[..., 0] * K[0] + T[..., 1] * K[1] + T[..., 2] * K[2]
+        phase = np.exp(-2.j * np.pi * kT)[:, None, :]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ir3 = np.where(inside, phase / dist**3, 0.)
+            ir5 = np.where(inside, 3. * phase / dist**5, 0.)
+
+        # replicas of each atom are summed over the translations
+        TD = np.empty(ir3.shape[:3] + (3, 3), dtype=np.complex128)
+        for i in range(3):
+            for j in range(i, 3):
+                x = ir5 * rvec[i] * rvec[j]
+                if i == j:
+                    x = x - ir3
+                TD[..., i, j] = TD[..., j, i] = \
+                    np.ascontiguousarray(x).sum(axis=-1)
+        TL = np.where(inside, phase, 0.).sum(axis=-1)
+
+        mask = np.any(inside, axis=(2, 3))
+        SD.add(msl, TD, mask)
+        SL.add(msl, TL, mask)
+
+        if gradient:
+            # derivatives of the dipolar kernel with respect to the
+            # replica position, symmetric in the three indexes. The
+            # muon moves in the opposite direction.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ir7 = np.where(inside, 15. * phase / dist**7, 0.)
+            G = np.empty(ir3.shape[:3] + (3, 3, 3), dtype=np.complex128)
+            for i in range(3):
+                for j in range(i, 3):
+                    for l in range(j, 3):
+                        x = -ir7 * rvec[i] * rvec[j] * rvec[l]
+                        if i == j:
+                            x = x + ir5 * rvec[l]
+                        if j == l:
+                            x = x + ir5 * rvec[i]
+                        if i == l:
+                            x = x + ir5 * rvec[j]
+                        x = -np.ascontiguousarray(x).sum(axis=-1)
+                        for a, b, c in set([(i, j, l), (i, l, j), (j, i, l),
+                                            (j, l, i), (l, i, j), (l, j, i)]):
+                            G[..., a, b, c] = x
+            SG.add(msl, G, mask)
+
+    TD, TL = SD.total, SL.total
+
+    points = Muon + np.floor(sc / 2.)
+    w, atoms, T = contact_weights(positions, Cell, points, nnn, rc,
+                                  neighbours)
+    phase = np.exp(-2.j * np.pi * np.dot(T, K))
+    pw = w * phase
+    # weights of the replicas of the same atom are summed
+    idx = (np.arange(nmu)[:, None] * na + atoms).ravel()
+    TC = np.bincount(idx, pw.real.ravel(), nmu * na) + \
+         1.j * np.bincount(idx, pw.imag.ravel(), nmu * na)
+
+    if not gradient:
+        return TD, TL, TC.reshape(nmu, na)
+
+    dw = _contact_weight_gradients(positions, Cell, points, w, atoms, T)
+    dw = dw * phase[:, :, None]
+    GC = np.empty([nmu * na, 3], dtype=np.complex128)
+    for j in range(3):
+        GC[:, j] = np.bincount(idx, dw[..., j].real.ravel(), nmu * na) + \
+                   1.j * np.bincount(idx, dw[..., j].imag.ravel(), nmu * na)
+
+    return TD, TL, TC.reshape(nmu, na), SG.total, GC.reshape(nmu, na, 3)
+
+
+def FieldsFromTensors(calc_type, tensors, FC, K, Phi, Muon, Supercell, r,
+                      nangles=None, rot_axis=None):
+    """
+    Calculates the local field components at the muon sites from the
+    lattice sums returned by :py:func:`PhaseTensors`.
+
+    Other arguments and the results are the same as in
+    :py:func:`Fields`. `Muon` must be the (N,3) array of positions used
+    to obtain `tensors`.
+    `FC` can also be an array of shape (nb, na, 3) of nb sets of
+    Fourier components, which are evaluated at once. In this case the
+    results have a leading dimension of size nb.
+    """
+    TD, TL, TC = tensors
+    FC = np.asarray(FC, dtype=np.complex128)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    K = np.asarray(K, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+
+    fcs = fourier_component_sets(calc_type, FC, rot_axis)
+    m0 = fcs * np.exp(-2.j * np.pi * Phi)[None, :, None]
+
+    BD = DIPOLAR_PREFACTOR * np.einsum('makl,s...al->s...mk', TD, m0)
+    BL = np.einsum('ma,s...ak->s...mk', TL, m0)
+    if r > 0:
+        BL *= DIPOLAR_PREFACTOR / r**3
+    else:
+        BL[:] = 0.
+    BC = CONTACT_PREFACTOR * np.einsum('ma,s...ak->s...mk', TC, m0)
+
+    alpha = _incommensurate_phase(K, Muon, sc)
+    return tuple(assemble(calc_type, B, alpha, nangles) for B in (BC, BD, BL))
+
+
+def GradientsFromTensors(gradients, FC, Phi):
+    """
+    Calculates the derivatives of the contact and dipolar fields of
+    's' calculations with respect to the Cartesian muon position from
+    the derivatives of the lattice sums returned by
+    :py:func:`PhaseTensors` with `gradient` True.
+
+    :param gradients: the derivatives of the dipolar tensors and of the
+                      contact weights, i.e. the last two arrays returned
+                      by :py:func:`PhaseTensors`.
+    :param FC: Fourier components in Cartesian coordinates.
+    :param Phi: phases in units of 2 pi.
+    :return: the Jacobians J[i,j] = dB_i/dx_j of the Contact and Dipolar
+             fields (N,3,3) in Tesla/Angstrom.
+    :rtype: tuple
+    """
+    GD, GC = gradients
+    FC = np.asarray(FC, dtype=np.complex128)
+    Phi = np.asarray(Phi, dtype=np.float64)
+    m0 = FC * np.exp(-2.j * np.pi * Phi)[:, None]
+
+    JD = DIPOLAR_PREFACTOR * np.einsum('maklj,al->mkj', GD, m0)
+    JC = CONTACT_PREFACTOR * np.einsum('maj,ak->mkj', GC, m0)
+    return np.real(JC), np.real(JD)
+
+
+def DipolarTensor(positions, Muon, Supercell, Cell, r,
+                  block_size=BLOCK_SIZE):
+    """
+    Calculates the dipolar tensor at the muon site(s) in 1/Angstrom^3.
+
+    Arguments are the same as lfclib.DipolarTensor, but `Muon` can
+    either be a single position of shape (3,) or an (N,3) array of
+    positions in fractional coordinates. In the latter case an array
+    of shape (N,3,3) is returned.
+    The optional `block_size` is the maximum number of (muon, atom)
+    pairs evaluated at once. Results do not depend on it.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    Muon = np.asarray(Muon, dtype=np.float64)
+    Cell = np.asarray(Cell, dtype=np.float64)
+    sc = np.asarray(Supercell, dtype=np.int64)
+    r = float(r)
+
+    single = (Muon.ndim == 1)
+    mupos = muon_supercell_positions(Muon, sc, Cell)
+
+    S = _TileSum(mupos.shape[0], [3, 3])
+    for msl, T, rvec, dist, inside in _tile_pairs(positions, sc, Cell,
+                                                  mupos, r, 0., block_size):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ir3 = np.where(inside, 1. / dist**3, 0.)
+            ir5 = np.where(inside, 3. / dist**5, 0.)
+
+        D = np.empty(ir3.shape[:2] + (3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                x = ir5 * rvec[i] * rvec[j]
+                if i == j:
+                    x = x - ir3
+                D[..., i, j] = D[..., j, i] = _tile_sum(x)
+
+        S.add(msl, D, np.any(inside, axis=(2, 3)))
+
+    res = S.total
+    if single:
+        return res[0]
+    return res
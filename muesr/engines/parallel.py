@@ -0,0 +1,135 @@
+"""
+Parallel evaluation of per-site quantities over a pool of processes.
+
+The arrays needed by the calculations (lattice, positions, Fourier
+components, muon sites, ...) are copied once in shared memory blocks
+which are attached by the worker processes, so that only their names
+are sent with each task.
+"""
+
+import sys
+import warnings
+import numpy as np
+
+from muesr.core.lazyimport import LazyModule
+
+# multiprocessing and concurrent.futures are slow to import and are only
+# needed by parallel calculations. Shared memory is available since
+# Python 3.8.
+have_shm = sys.version_info >= (3, 8)
+shared_memory = LazyModule('multiprocessing.shared_memory')
+concurrent_futures = LazyModule('concurrent.futures')
+
+
+class SharedArrays(object):
+    """
+    Copies a dictionary of numpy arrays in shared memory blocks.
+    The blocks are released when the object is used as a context
+    manager or when :py:meth:`close` is called.
+
+    :param dict arrays: the arrays to be shared.
+    """
+    def __init__(self, arrays):
+        self._blocks = []
+        self.descr = {}
+        try:
+            for name, a in arrays.items():
+                a = np.ascontiguousarray(a)
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(1, a.nbytes))
+                self._blocks.append(shm)
+                np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+                self.descr[name] = (shm.name, a.shape, a.dtype.str)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _task(func, descr, indexes, args):
+    """
+    Attaches the shared arrays and evaluates `func` for the sites in
+    `indexes`.
+    """
+    blocks = []
+    arrays = {}
+    try:
+        for name, (shm_name, shape, dtype) in descr.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            blocks.append(shm)
+            arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+        # results must not reference the shared buffers
+        return [func(arrays, i, *args) for i in indexes]
+    finally:
+        del arrays
+        for shm in blocks:
+            shm.close()
+
+
+def parse_workers(workers):
+    """
+    Validates the number of worker processes. None means serial
+    execution.
+    """
+    if workers is None:
+        return 1
+    try:
+        workers = int(workers)
+    except:
+        raise TypeError("Cannot convert workers to int.")
+    if workers < 1:
+        raise ValueError("workers must be strictly positive.")
+    return workers
+
+
+def map_sites(func, arrays, nsites, args=(), workers=None):
+    """
+    Evaluates ``func(arrays, i, *args)`` for i in range(nsites).
+
+    When `workers` is larger than 1 the sites are split in contiguous
+    chunks evaluated by a pool of processes, and `arrays` is shared
+    through shared memory. `func` must be a module level function.
+    The serial and the parallel execution call `func` with the same
+    values, so the results are identical. If shared memory is not
+    available (Python < 3.8) the sites are evaluated serially and a
+    RuntimeWarning is issued.
+
+    :param func: the function evaluating a single site.
+    :param dict arrays: numpy arrays needed by `func`.
+    :param int nsites: number of sites.
+    :param tuple args: other (small) arguments of `func`.
+    :param int workers: number of processes. Default None, i.e. serial
+                        execution.
+    :return: the list of results, in the order of the sites.
+    :rtype: list
+    """
+    workers = parse_workers(workers)
+
+    if workers > 1 and not have_shm:
+        warnings.warn("Shared memory not available, {} workers requested "
+                      "but sites are evaluated serially.".format(workers),
+                      RuntimeWarning, stacklevel=3)
+    if workers == 1 or nsites < 2 or not have_shm:
+        return [func(arrays, i, *args) for i in range(nsites)]
+
+    workers = min(workers, nsites)
+    # a few chunks per process to balance the load
+    chunks = np.array_split(np.arange(nsites), min(nsites, 4 * workers))
+
+    with SharedArrays(arrays) as shared:
+        with concurrent_futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_task, func, shared.descr,
+                                   chunk.tolist(), args)
+                       for chunk in chunks]
+            return [r for f in futures for r in f.result()]
@@ -49,6 +49,8 @@ def export_fpstudio(sample, filename):
         outbuffer += "LATTICE P\n"
         outbuffer += "SYMM x,y,z\n"
         outbuffer += "MSYM u,v,w,0.0\n"
+        fcs = sample.mm.fc_view(2)
+        phi = sample.mm.phi
         for i, atom in enumerate(sample.cell):
             outbuffer += "MATOM "
             outbuffer += atom[0]+str(i) + " "
@@ -57,9 +59,9 @@ def export_fpstudio(sample, filename):
             outbuffer += " SCALE 0.8 ENVELOP\n"
             
             outbuffer += "skp 1 1 "
-            outbuffer += " ".join([str(x) for x in sample.mm.fcLattBM[i].real]) + " "
-            outbuffer += " ".join([str(x) for x in sample.mm.fcLattBM[i].imag]) + " "
-            outbuffer += str(sample.mm.phi[i]) + "\n"
+            outbuffer += " ".join([str(x) for x in fcs[i].real]) + " "
+            outbuffer += " ".join([str(x) for x in fcs[i].imag]) + " "
+            outbuffer += str(phi[i]) + "\n"
         
         
 
@@ -7,19 +7,21 @@ from muesr.core.sample   import Sample
 from muesr.core.sampleErrors   import *
 from muesr.core.spg      import spacegroup_from_data
 from muesr.core.magmodel import MM
+from muesr.core.lazyimport import available, LazyModule
 
 
-have_yaml = True
+# PyYAML is imported when a sample is loaded or saved
+have_yaml = available('yaml')
+yaml = LazyModule('yaml')
 
 
-try:
-    from yaml import load, dump
-    try:
-        from yaml import CLoader as Loader, CDumper as Dumper
-    except ImportError:
-        from yaml import Loader, Dumper
-except:
-    have_yaml = False
+def _yaml_loader():
+    # use the C implementation if available
+    return getattr(yaml, 'CLoader', yaml.Loader)
+
+
+def _yaml_dumper():
+    return getattr(yaml, 'CDumper', yaml.Dumper)
 
 
 
@@ -64,7 +66,11 @@ def save_sample(sample, filename="", fileobj=None, overwrite=False):
     muondict = {}
     try:
         sample._check_muon()
-        muondict['Positions'] = [x.tolist() for x in sample.muons]
+        snap = sample.snapshot()
+        muondict['Positions'] = snap.muons.tolist()
+        muondict['Labels'] = snap.muon_labels.tolist()
+        muondict['Orbits'] = snap.muon_orbits.tolist()
+        muondict['Weights'] = snap.muon_weights.tolist()
     except MuonError:
         pass
     
@@ -107,7 +113,7 @@ def save_sample(sample, filename="", fileobj=None, overwrite=False):
         
     outdict['Symmetry'] = symdict
 
-    output = dump(outdict, Dumper=Dumper)
+    output = yaml.dump(outdict, Dumper=_yaml_dumper())
     
     if fileobj is None:
         if filename == "":
@@ -153,9 +159,9 @@ def load_sample(filename="", fileobj=None):
         if filename == "":
             raise ValueError("Specify filename or File object")
         with open(filename,'r') as f:
-            data = load(f, Loader=Loader)
+            data = yaml.load(f, Loader=_yaml_loader())
     else:
-        data = load(fileobj, Loader=Loader)
+        data = yaml.load(fileobj, Loader=_yaml_loader())
 
     if not(type(data) is dict):
         raise ValueError('Invalid data file. (problems with YAML?)')
@@ -202,8 +208,11 @@ def load_sample(filename="", fileobj=None):
     if 'Muon' in data.keys():
         m = data['Muon']
         if 'Positions' in m:
-            for p in m['Positions']:
-                sample.add_muon(p)
+            # labels, orbits and weights are missing in old files
+            sample.add_muons(np.reshape(m['Positions'], (-1, 3)),
+                             labels=m.get('Labels'),
+                             orbits=m.get('Orbits'),
+                             weights=m.get('Weights'))
         else:
             warnings.warn('Muon positions not loaded!', RuntimeWarning)
     else:
@@ -9,6 +9,13 @@ from muesr.core.parsers import mybool
 
 
 def write_xsf(fileobj, images, data=None):
+    """
+    Writes the structure(s) in `images` in XCrysDen format.
+    
+    If `data`, an (n1,n2,n3) array of values on the periodic grid
+    of points (i/n1, j/n2, l/n3) of the (last) cell, is given, it is
+    written in a 3D datagrid block.
+    """
     
     # this should work with unicode too.
     if not hasattr(fileobj, 'write'):
@@ -73,24 +80,25 @@ def write_xsf(fileobj, images, data=None):
     if data.dtype == complex:
         data = np.abs(data)
 
+    # data is given on the periodic grid (i/n1, j/n2, l/n3). XSF general
+    # grids also include the points on the far faces of the cell.
+    data = np.pad(data, [(0, 1)] * 3, mode='wrap')
+
     shape = data.shape
     fileobj.write('  %d %d %d\n' % shape)
 
     cell = atoms.get_cell()
     origin = np.zeros(3)
-    for i in range(3):
-        if not pbc[i]:
-            origin += cell[i] / shape[i]
     fileobj.write('  %f %f %f\n' % tuple(origin))
 
     for i in range(3):
-        fileobj.write('  %f %f %f\n' %
-                      tuple(cell[i] * (shape[i] + 1) / shape[i]))
+        fileobj.write('  %f %f %f\n' % tuple(cell[i]))
 
-    for x in range(shape[2]):
+    # first index runs fastest
+    for z in range(shape[2]):
         for y in range(shape[1]):
             fileobj.write('   ')
-            fileobj.write(' '.join(['%f' % d for d in data[x, y]]))
+            fileobj.write(' '.join(['%f' % d for d in data[:, y, z]]))
             fileobj.write('\n')
         fileobj.write('\n')
 
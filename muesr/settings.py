@@ -257,4 +257,25 @@ class Settings(object):
         return None
 
 
-config = Settings()
+class _LazySettings(object):
+    """
+    Creates the :py:class:`Settings` object, which reads the 
+    configuration file and checks the temporary directory, the first 
+    time one of its attributes is used.
+    """
+    def __init__(self):
+        object.__setattr__(self, '_settings', None)
+
+    def _get(self):
+        if self._settings is None:
+            object.__setattr__(self, '_settings', Settings())
+        return self._settings
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+
+config = _LazySettings()
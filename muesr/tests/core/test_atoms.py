@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.core.atoms import Atoms
+from muesr.core.sample import Sample
+from muesr.core.cells import get_simple_supercell
+
+
+class TestAtoms(unittest.TestCase):
+
+    def setUp(self):
+        self.lattice = np.array([[3., 0., 0.],
+                                 [0.5, 3.5, 0.],
+                                 [0., 0.3, 4.]])
+        self.atoms = Atoms(symbols=['Fe', 'co', 'O'],
+                           scaled_positions=[[0, 0, 0],
+                                             [0.5, 0.5, 0.5],
+                                             [0.1, 0.2, 0.3]],
+                           cell=self.lattice, pbc=True)
+
+    def test_init(self):
+        with self.assertRaises(ValueError):
+            Atoms(symbols=['Fe'], cell=self.lattice)
+        with self.assertRaises(KeyError):
+            Atoms(symbols=['Xx'], scaled_positions=[[0, 0, 0]],
+                  cell=self.lattice)
+
+        a = self.atoms
+        self.assertEqual(len(a), 3)
+        self.assertEqual(a.get_chemical_symbols(), ['Fe', 'Co', 'O'])
+        np.testing.assert_array_equal(a.get_atomic_numbers(), [26, 27, 8])
+        np.testing.assert_allclose(a.get_masses(), [55.845, 58.933195, 15.9994])
+        self.assertIsNone(a.get_magnetic_moments())
+
+        b = Atoms(numbers=[26, 27, 8], positions=a.get_positions(),
+                  cell=self.lattice)
+        np.testing.assert_allclose(b.get_scaled_positions(),
+                                   a.get_scaled_positions(), atol=1e-15)
+        self.assertEqual(b.get_chemical_symbols(), a.get_chemical_symbols())
+
+    def test_cached_quantities(self):
+        a = self.atoms
+        pos = a.get_positions()
+        np.testing.assert_allclose(pos, a.get_scaled_positions().dot(self.lattice))
+        self.assertAlmostEqual(a.get_volume(), np.linalg.det(self.lattice))
+        np.testing.assert_allclose(a.get_reciprocal_cell().dot(self.lattice.T),
+                                   np.eye(3), atol=1e-15)
+
+        # the returned arrays are copies
+        a.get_positions()[1] = 0.
+        np.testing.assert_array_equal(a.get_positions(), pos)
+        with self.assertRaises(ValueError):
+            a.cell[0, 0] = 1.
+
+        # and the cache is invalidated by changes
+        a.set_cell(2. * self.lattice)
+        np.testing.assert_allclose(a.get_positions(), 2. * pos)
+        self.assertAlmostEqual(a.get_volume(), 8. * np.linalg.det(self.lattice))
+        a.set_scaled_positions(np.zeros([3, 3]))
+        np.testing.assert_array_equal(a.get_positions(), 0.)
+        with self.assertRaises(ValueError):
+            a.set_scaled_positions(np.zeros([2, 3]))
+
+    def test_extend_and_delete(self):
+        a = self.atoms
+        for i in range(100):
+            self.assertEqual(a.extend(symbol='mu', scaled_position=[0.01 * i, 0, 0]), -1)
+        a.extend(number=26, position=[1., 1., 1.])
+        self.assertEqual(len(a), 104)
+        self.assertEqual(a[3][0], 'mu')
+        self.assertEqual(a[-1][1], 26)
+        np.testing.assert_allclose(a.get_positions()[-1], [1., 1., 1.])
+        np.testing.assert_array_equal(a.get_scaled_positions()[3:103, 0],
+                                      0.01 * np.arange(100))
+        self.assertEqual(a.get_masses()[50], 0.2)
+        with self.assertRaises(ValueError):
+            a.extend(scaled_position=[0, 0, 0])
+
+        a.del_atom(3)
+        a.del_atom(-1)
+        self.assertEqual(len(a), 102)
+        self.assertEqual(a.get_scaled_positions()[3, 0], 0.01)
+        self.assertEqual(a.get_chemical_symbols()[-1], 'mu')
+        with self.assertRaises(IndexError):
+            a.del_atom(102)
+
+        a.edit_atom(0, symbol='Ni')
+        self.assertEqual(a[0][:2], ('Ni', 28))
+        self.assertEqual(a.get_masses()[0], 58.6934)
+
+    def test_extend_after_setters(self):
+        a = self.atoms
+        a.extend(symbol='mu', scaled_position=[0.2, 0.2, 0.2])
+        a.set_masses([1., 2., 3., 4.])
+        a.extend(symbol='H', scaled_position=[0.3, 0.2, 0.2])
+        np.testing.assert_allclose(a.get_masses(), [1., 2., 3., 4., 1.00794])
+
+        a.set_magnetic_moments(np.ones([5, 3]))
+        a.extend(symbol='mu', scaled_position=[0.4, 0.2, 0.2], magmom=[0, 0, 2.])
+        np.testing.assert_array_equal(a.get_magnetic_moments()[-2:],
+                                      [[1., 1., 1.], [0., 0., 2.]])
+
+        a.set_chemical_symbols(['Ni'] * 6)
+        a.extend(symbol='Fe', scaled_position=[0.5, 0.2, 0.2])
+        self.assertEqual(a.get_chemical_symbols(), ['Ni'] * 6 + ['Fe'])
+        self.assertEqual(a.get_masses()[-1], 55.845)
+        self.assertEqual(len(a), 7)
+        np.testing.assert_array_equal(a.get_scaled_positions()[-1], [0.5, 0.2, 0.2])
+
+    def test_magnetic_moments(self):
+        a = self.atoms
+        a.set_magnetic_moments(np.ones([3, 3]))
+        a.extend(symbol='mu', scaled_position=[0.2, 0.2, 0.2])
+        np.testing.assert_array_equal(a.get_magnetic_moments()[-1], 0.)
+        np.testing.assert_array_equal(a[0][3], 1.)
+        with self.assertRaises(ValueError):
+            a.set_magnetic_moments(np.ones([2, 3]))
+
+    def test_simple_supercell(self):
+        s = Sample()
+        s.cell = self.atoms
+        s.new_mm()
+        s.mm.k = np.array([0.1, 0.3, 0.25])
+        s.mm.fc = np.array([[1, 0, 1j], [0, 2, 0], [0.5j, 0, 1]])
+        s.mm.phi = np.array([0., 0.2, 0.7])
+        multi = [2, 3, 4]
+        sc = get_simple_supercell(s, multi)
+        self.assertEqual(len(sc), 3 * 24)
+        np.testing.assert_allclose(sc.get_cell(), np.diag(multi).dot(self.lattice))
+
+        # the reference: nested loops, with the first index running fastest
+        pos = self.atoms.get_scaled_positions()
+        n = 0
+        for l in range(3):
+            for k in range(4):
+                for j in range(3):
+                    for i in range(2):
+                        t = np.array([i, j, k])
+                        np.testing.assert_allclose(sc[n][2], (pos[l] + t) / multi)
+                        self.assertEqual(sc[n][0], self.atoms[l][0])
+                        ph = 2. * np.pi * (np.dot(s.mm.k, t) + s.mm.phi[l])
+                        m = np.cos(ph) * np.real(s.mm.fc[l]) + \
+                            np.sin(ph) * np.imag(s.mm.fc[l])
+                        np.testing.assert_allclose(sc[n][3], m, atol=1e-14)
+                        n += 1
+
+
+if __name__ == '__main__':
+    unittest.main()
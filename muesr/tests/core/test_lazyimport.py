@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import subprocess
+import unittest
+
+from muesr.core.lazyimport import available, LazyModule
+
+
+class TestLazyImport(unittest.TestCase):
+
+    def test_available(self):
+        self.assertTrue(available('json'))
+        self.assertFalse(available('muesr_no_such_module'))
+        self.assertFalse(available('muesr_no_such_module.sub'))
+
+    def test_lazy_module(self):
+        mod = LazyModule('json.tool')
+        self.assertIn('not loaded', repr(mod))
+        self.assertTrue(callable(mod.main))
+        self.assertIs(mod._load(), sys.modules['json.tool'])
+        with self.assertRaises(AttributeError):
+            mod.no_such_attribute
+        with self.assertRaises(ImportError):
+            LazyModule('muesr_no_such_module').x
+
+    def test_optional_dependencies_not_imported(self):
+        code = ("import sys, muesr.core, muesr.engines, muesr.i_o, "
+                "muesr.utilities; from muesr.core.magmodel import have_sympy; "
+                "print(','.join(m for m in ('sympy', 'yaml', 'spglib', "
+                "'concurrent.futures') if m in sys.modules))")
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+                               os.path.dirname(os.path.abspath(__file__)))))
+        env = dict(os.environ, PYTHONPATH=root)
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(out.decode().strip(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -122,9 +122,35 @@ class TestMM(unittest.TestCase):
         
         with self.assertRaises(TypeError):
             self._mm.fc_set('a',1) #must 0,1,2
-        
-        
-        
+
+    def test_fc_view(self):
+        randomfcs = np.random.rand(self.NUMFCS,3)+1.j*np.random.rand(self.NUMFCS,3)
+        self._mm.fcLattBM = randomfcs
+
+        view = self._mm.fc_view(2)
+        np.testing.assert_array_almost_equal(view, randomfcs)
+        np.testing.assert_array_equal(view, self._mm.fcLattBM)
+        # converted once and not copied
+        self.assertIs(self._mm.fc_view(2), view)
+        self.assertIs(self._mm.fc_view(), self._mm.fc_view(0))
+        with self.assertRaises(ValueError):
+            view[0,0] = 1.
+        with self.assertRaises(ValueError):
+            self._mmnolat.fc_view(1)
+
+        # the views are replaced, not modified, when the FCs are set
+        cart = self._mm.fc_view()
+        self._mm.fc = np.zeros([self.NUMFCS,3],dtype=np.complex128)
+        np.testing.assert_array_equal(self._mm.fc_view(2), 0.)
+        np.testing.assert_array_almost_equal(view, randomfcs)
+        self.assertFalse(np.all(cart == 0.))
+
+        # the array given by the user is copied
+        randomfcs[0,0] = 10.
+        self._mm.fc = randomfcs
+        randomfcs[0,0] = 20.
+        self.assertEqual(self._mm.fc_view()[0,0], 10.)
+
     def test_phi_property(self):
         np.testing.assert_array_equal(self._mm.phi, np.zeros(self.NUMFCS))
         
@@ -255,6 +281,29 @@ if have_sympy:
                 #np.testing.assert_array_equal(self._smmnolat.fcLattBM, np.zeros([self.NUMFCS,3]))
             
             
+        def test_fc_batch(self):
+            values = np.random.rand(5, 3)
+
+            with self.assertRaises(RuntimeError):
+                self._smm.fc_batch(values)
+
+            for cs in (0, 1, 2):
+                self._smm.set_symFC('[[x,2*y,0],[z,1.j,x*y]]', cs)
+                res = self._smm.fc_batch(values)
+                self.assertEqual(res.shape, (5, self.NUMFCS, 3))
+                for v, r in zip(values, res):
+                    self._smm.set_params(v)
+                    np.testing.assert_array_almost_equal(r, self._smm.fc)
+
+            with self.assertRaises(ValueError):
+                self._smm.fc_batch(np.random.rand(5, 2))
+            with self.assertRaises(TypeError):
+                self._smm.fc_batch([[{}, 1, 2]])
+
+            self._smmnolat.set_symFC('[[x,y,z],[0,0,0]]', 1)
+            with self.assertRaises(ValueError):
+                self._smmnolat.fc_batch(values)
+
         def test_phi_property(self):
             np.testing.assert_array_equal(self._smm.phi, np.zeros(self.NUMFCS))
             
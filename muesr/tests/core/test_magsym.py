@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.core.atoms import Atoms
+from muesr.core.sample import Sample
+from muesr.core.sampleErrors import *
+from muesr.core.spg import Spacegroup
+from muesr.core.magsym import cartesian_rotations, sublattice_operations, \
+                              magnetic_operations, site_orbits
+
+
+class TestMagneticSymmetry(unittest.TestCase):
+
+    def setUp(self):
+        self.sample = Sample()
+        self.sample.cell = Atoms(symbols=['Fe'], scaled_positions=[[0,0,0]],
+                                 cell=np.diag([3.,3.,4.]))
+        self.sample.new_mm()
+        self.sample.mm.fc = np.array([[0.,0.,1.]], dtype=np.complex128)
+
+    def test_cartesian_rotations(self):
+        latpar = np.array([[3.,0,0],[-1.5,3.*np.sqrt(3)/2.,0],[0,0,5.]])
+        rot, _ = Spacegroup(191).get_op()
+        Rc = cartesian_rotations(rot, latpar)
+        for R in Rc:
+            np.testing.assert_allclose(np.dot(R, R.T), np.eye(3), atol=1e-12)
+
+    def test_magnetic_operations(self):
+        with self.assertRaises(SymmetryError):
+            magnetic_operations(self.sample)
+
+        self.sample.sym = Spacegroup(123)
+        rot, trans = sublattice_operations(self.sample, [0])
+        self.assertEqual(len(rot), 16)
+
+        # ferromagnet along z: 4/mm'm'
+        rot, trans, tr = magnetic_operations(self.sample)
+        self.assertEqual(len(rot), 16)
+        Rc = cartesian_rotations(rot, self.sample.cell.get_cell())
+        for R, t in zip(Rc, tr):
+            m = t * np.linalg.det(R) * np.dot(R, [0.,0.,1.])
+            np.testing.assert_allclose(m, [0.,0.,1.], atol=1e-12)
+        self.assertEqual(np.sum(tr == -1), 8)
+
+        # moments in the plane break the fourfold axis
+        self.sample.mm.fc = np.array([[1.,0.,0.]], dtype=np.complex128)
+        rot, trans, tr = magnetic_operations(self.sample)
+        self.assertEqual(len(rot), 8)
+
+        # a propagation vector along x reduces the operations to those
+        # leaving k unchanged or reversing it
+        self.sample.mm.k = np.array([0.3,0.,0.])
+        rot, trans, tr = magnetic_operations(self.sample)
+        self.assertEqual(len(rot), 8)
+        for R in rot:
+            self.assertAlmostEqual(abs(np.dot(R.T, [1.,0.,0.])[0]), 1.)
+
+    def test_site_orbits(self):
+        self.sample.sym = Spacegroup(123)
+        rot, trans, tr = magnetic_operations(self.sample)
+
+        points = np.array([[0.1,0.2,0.3],
+                           [0.9,0.8,0.3],
+                           [0.2,0.1,0.7],
+                           [0.4,0.4,0.4],
+                           [0.1,0.2,1.3]])
+        rep, op = site_orbits(points, rot, trans)
+        np.testing.assert_array_equal(rep, [0,0,0,3,0])
+        np.testing.assert_array_equal(op == -1, [True,False,False,True,False])
+        for i in (1, 2, 4):
+            p = np.dot(rot[op[i]], points[0]) + trans[op[i]]
+            d = points[i] - p
+            np.testing.assert_allclose(d, np.round(d), atol=1e-12)
+
+        # translations must preserve the phases of the structure
+        rep, op = site_orbits(points, rot, trans, k=[0.,0.,0.3])
+        np.testing.assert_array_equal(rep, [0,0,2,3,4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.core.atoms import Atoms
+from muesr.core.sample import Sample
+from muesr.core.sampleErrors import *
+from muesr.core.neighbours import PeriodicNeighbours, neighbour_index
+
+
+class TestPeriodicNeighbours(unittest.TestCase):
+
+    def setUp(self):
+        # a skewed cell, where the 27 neighbouring cells are not enough
+        self.latpar = np.array([[4., 0., 0.],
+                                [3.5, 2., 0.],
+                                [0.5, 0.3, 5.]])
+        self.positions = np.array([[0., 0., 0.],
+                                   [0.5, 0.5, 0.5],
+                                   [0.25, 0.1, 0.7],
+                                   [1.2, -0.3, 0.1]])
+        rng = np.random.RandomState(7)
+        self.points = rng.uniform(-1.5, 2.5, size=(200, 3))
+
+    def _brute_force(self, points, k, rmax):
+        n = 5
+        T = np.mgrid[-n:n+1, -n:n+1, -n:n+1].reshape(3, -1).T
+        images = self.positions[None, :, :] + T[:, None, :]
+        t, a = np.indices(images.shape[:2]).reshape(2, -1)
+        images = images.reshape(-1, 3)
+        dist, atoms, trans = [], [], []
+        for p in points:
+            d = np.linalg.norm(np.dot(images - p, self.latpar), axis=1)
+            order = np.argsort(d, kind='stable')
+            order = order[d[order] <= rmax][:k]
+            dist.append(np.pad(d[order], (0, k - len(order)),
+                               constant_values=np.inf))
+            atoms.append(np.pad(a[order], (0, k - len(order)),
+                                constant_values=-1))
+            trans.append(T[t[order]])
+        return np.array(dist), np.array(atoms), trans
+
+    def test_init(self):
+        with self.assertRaises(ValueError):
+            PeriodicNeighbours(self.latpar, self.positions, 0.)
+
+        index = PeriodicNeighbours(self.latpar, self.positions, 6.)
+        self.assertEqual(index.cutoff, 6.)
+        with self.assertRaises(ValueError):
+            index.query(self.points, 2, rmax=7.)
+
+    def test_query(self):
+        index = PeriodicNeighbours(self.latpar, self.positions, 6.)
+        for k, rmax in ((1, 6.), (4, 6.), (30, 3.)):
+            dist, atoms, T = index.query(self.points, k, rmax)
+            rdist, ratoms, rT = self._brute_force(self.points, k, rmax)
+            np.testing.assert_allclose(dist, rdist)
+            found = np.isfinite(rdist)
+            np.testing.assert_array_equal(atoms[found], ratoms[found])
+            np.testing.assert_array_equal(atoms[~found], -1)
+            for i in range(len(self.points)):
+                n = len(rT[i])
+                np.testing.assert_array_equal(T[i, :n], rT[i])
+
+        # translations are absolute and atoms are those given
+        dist, atoms, T = index.query(self.points, 3)
+        for i, p in enumerate(self.points):
+            r = np.dot(self.positions[atoms[i]] + T[i] - p, self.latpar)
+            np.testing.assert_allclose(np.linalg.norm(r, axis=1), dist[i])
+
+    def test_subset(self):
+        index = PeriodicNeighbours(self.latpar, self.positions, 6.)
+        sub = index.subset([1, 3])
+        self.assertIs(sub, index.subset([1, 3]))
+        self.assertEqual(sub.cutoff, index.cutoff)
+
+        ref = PeriodicNeighbours(self.latpar, self.positions[[1, 3]], 6.)
+        for a, b in zip(sub.query(self.points, 2), ref.query(self.points, 2)):
+            np.testing.assert_array_equal(a, b)
+
+    def test_arrays(self):
+        index = PeriodicNeighbours(self.latpar, self.positions, 6.)
+        arrays = index.to_arrays('nb_')
+        self.assertTrue(all(k.startswith('nb_') for k in arrays))
+        copy = PeriodicNeighbours.from_arrays(arrays, 'nb_')
+        self.assertEqual(copy.cutoff, index.cutoff)
+        for a, b in zip(copy.query(self.points, 3), index.query(self.points, 3)):
+            np.testing.assert_array_equal(a, b)
+
+    def test_sample_index(self):
+        sample = Sample()
+        with self.assertRaises(CellError):
+            neighbour_index(sample, 5.)
+
+        sample.cell = Atoms(symbols=['Co', 'O'],
+                            scaled_positions=[[0, 0, 0], [0.5, 0.5, 0.5]],
+                            cell=np.diag([3., 3., 4.]))
+        index = neighbour_index(sample, 5.)
+        self.assertIs(index, neighbour_index(sample, 3.))
+        self.assertIsNot(index, neighbour_index(sample, 8.))
+
+        index = neighbour_index(sample, 5.)
+        cell = sample.cell
+        cell.set_cell(np.diag([3., 3., 5.]))
+        sample.cell = cell
+        self.assertIsNot(index, neighbour_index(sample, 5.))
+
+        dist, atoms, T = neighbour_index(sample, 5.).query([0.5, 0.5, 0.3], 1)
+        self.assertAlmostEqual(dist[0, 0], 1.)
+        self.assertEqual(atoms[0, 0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,7 @@ if have_sympy:
     from muesr.core.magmodel import SMM
 
 from muesr.core.spg import Spacegroup
+from muesr.core.neighbours import neighbour_index
 
 class TestSample(unittest.TestCase):
  
@@ -61,6 +62,106 @@ class TestSample(unittest.TestCase):
         
         
         
+    def test_snapshot(self):
+        self._sample._reset(cell=True,muon=True,sym=True,magdefs=True)
+        
+        with self.assertRaises(CellError):
+            self._sample.snapshot()
+        
+        v = self._sample.version
+        self._set_a_cell()
+        self.assertGreater(self._sample.version, v)
+        
+        snap = self._sample.snapshot()
+        self.assertEqual(snap.muons.shape, (0,3))
+        self.assertIsNone(snap.fc)
+        self.assertEqual(snap.symbols, ('Co',))
+        np.testing.assert_array_equal(snap.lattice, 3.*np.eye(3))
+        
+        v = self._sample.version
+        self._sample.add_muon([0.1,0.2,0.3])
+        self._sample.new_mm()
+        self.assertEqual(self._sample.version, v + 2)
+        
+        snap = self._sample.snapshot()
+        np.testing.assert_array_equal(snap.muons, [[0.1,0.2,0.3]])
+        np.testing.assert_array_equal(snap.fc, np.zeros([1,3]))
+        self.assertEqual(snap.version, self._sample.version)
+        
+        # the arrays are read-only and are not copied again
+        with self.assertRaises(ValueError):
+            snap.muons[0,0] = 1.
+        with self.assertRaises(ValueError):
+            snap.lattice[0,0] = 1.
+        with self.assertRaises(AttributeError):
+            snap.muons = None
+        self.assertIs(self._sample.snapshot().muons, snap.muons)
+        
+        # the public properties still return copies
+        self._sample.muons[0][0] = 1.
+        self.assertEqual(self._sample.snapshot().muons[0,0], 0.1)
+        
+        self._sample.add_muon([0.5,0.5,0.5])
+        self.assertEqual(snap.muons.shape, (1,3))
+        self.assertEqual(self._sample.snapshot().muons.shape, (2,3))
+        
+    def test_add_muons(self):
+        self._sample._reset(cell=True,muon=True,sym=True,magdefs=True)
+        
+        with self.assertRaises(CellError):
+            self._sample.add_muons(np.zeros([2,3]))
+        
+        self._set_a_cell()
+        with self.assertRaises(TypeError):
+            self._sample.add_muons('0 0 0')
+        with self.assertRaises(ValueError):
+            self._sample.add_muons(np.zeros(3))
+        with self.assertRaises(ValueError):
+            self._sample.add_muons(np.zeros([2,3]), labels=['a'])
+        with self.assertRaises(TypeError):
+            self._sample.add_muons(np.zeros([2,3]), labels=['a', 1])
+        with self.assertRaises(ValueError):
+            self._sample.add_muons(np.zeros([2,3]), orbits=[0,1,2])
+        with self.assertRaises(ValueError):
+            self._sample.add_muons(np.zeros([2,3]), weights=[1.,-1.])
+        with self.assertRaises(MuonError):
+            self._sample.remove_muons(0)
+        
+        rng = np.random.RandomState(7)
+        pos = rng.uniform(size=[1000,3])
+        self._sample.add_muon([0.1,0.2,0.3], label='first', weight=2.)
+        self._sample.add_muons(pos, orbits=np.arange(1000) % 3)
+        self._sample.add_muons(3. * pos[:10], cartesian=True,
+                               labels=['c'] * 10, weights=0.5)
+        
+        snap = self._sample.snapshot()
+        self.assertEqual(snap.muons.shape, (1011,3))
+        np.testing.assert_array_equal(snap.muons[1:1001], pos)
+        np.testing.assert_allclose(snap.muons[1001:], pos[:10])
+        self.assertEqual(snap.muon_labels[0], 'first')
+        self.assertEqual(snap.muon_labels[1], '')
+        self.assertEqual(snap.muon_labels[-1], 'c')
+        np.testing.assert_array_equal(snap.muon_orbits[:4], [-1,0,1,2])
+        np.testing.assert_array_equal(snap.muon_weights[[0,1,-1]],
+                                      [2.,1.,0.5])
+        np.testing.assert_array_equal(self._sample.muons[0], [0.1,0.2,0.3])
+        
+        # slices, masks and lists of indexes
+        self._sample.remove_muons(slice(1001, None))
+        self._sample.remove_muons(self._sample.snapshot().muons[:,0] > 0.5)
+        keep = np.r_[True, pos[:,0] <= 0.5]
+        np.testing.assert_array_equal(self._sample.snapshot().muons,
+                                      snap.muons[:1001][keep])
+        self._sample.remove_muons([0, -1])
+        self.assertEqual(len(self._sample.muons), keep.sum() - 2)
+        with self.assertRaises(IndexError):
+            self._sample.remove_muons(10000)
+        
+        # the old snapshot is not modified
+        np.testing.assert_array_equal(snap.muons[1:1001], pos)
+        with self.assertRaises(ValueError):
+            snap.muon_weights[0] = 1.
+    
     def test_add_muon_property(self):
         self._sample._reset(cell=True,muon=True,sym=True,magdefs=True)
 
@@ -214,6 +315,28 @@ class TestSample(unittest.TestCase):
         self.assertEqual(current_cell.get_chemical_symbols(),['Co'])
         current_cell.set_chemical_symbols(['Co'])
         self.assertEqual(current_cell.get_chemical_symbols(),['Co'])
+        
+        # the cell is copied: only the setter changes the sample
+        atoms = Atoms(symbols=['Co'], scaled_positions=[[0,0,0]],
+                      cell=3.*np.eye(3))
+        self._sample.cell = atoms
+        snap = self._sample.snapshot()
+        index = neighbour_index(self._sample, 5.)
+        atoms.set_scaled_positions([[0.5,0.5,0.5]])
+        atoms.set_cell(4.*np.eye(3))
+        np.testing.assert_array_equal(self._sample.cell.get_scaled_positions(),
+                                      [[0,0,0]])
+        np.testing.assert_array_equal(self._sample.snapshot().positions,
+                                      [[0,0,0]])
+        np.testing.assert_array_equal(snap.lattice, 3.*np.eye(3))
+        self.assertIs(neighbour_index(self._sample, 5.), index)
+        
+        self._sample.cell = atoms
+        np.testing.assert_array_equal(self._sample.snapshot().positions,
+                                      [[0.5,0.5,0.5]])
+        np.testing.assert_array_equal(self._sample.snapshot().lattice,
+                                      4.*np.eye(3))
+        self.assertIsNot(neighbour_index(self._sample, 5.), index)
 
     def test_reset(self):
         
@@ -241,7 +364,7 @@ class TestSample(unittest.TestCase):
         self._set_a_cell()
         self._sample.add_muon([0,1.,2])
         self._sample._reset(muon=True)
-        self.assertEqual(self._sample._muon, [])
+        self.assertEqual(len(self._sample._muon), 0)
         with self.assertRaises(MuonError):
             self._sample.muons
         
@@ -310,8 +433,7 @@ class TestSample(unittest.TestCase):
         self._sample.add_muon(np.zeros(3))
         self.assertTrue(self._sample._check_muon())
         
-        self._sample.add_muon(np.zeros(3))
-        self._sample._muon[1] = 'a'
+        self._sample._muon = [np.zeros(3)]
         with self.assertRaises(MuonError):
             self._sample._check_muon()        
 
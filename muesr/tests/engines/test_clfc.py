@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import warnings
 import numpy as np
 
 from muesr.core.atoms import Atoms
@@ -10,21 +11,18 @@ from muesr.core.sampleErrors import *
 from muesr.core.magmodel import MM, have_sympy
 if have_sympy:
     from muesr.core.magmodel import SMM
+from muesr.core.spg import Spacegroup
+from muesr.utilities.muon import muon_find_equiv
 
-have_lfclib = False
-try:
-    import lfclib as lfcext
-    have_lfclib = True
-except Exception as e:
-    print(e)
-
-
-if have_lfclib:
-    from muesr.engines.clfc import LocalFields, find_largest_sphere, locfield
+# lfcext is lfclib if available, the NumPy implementation otherwise.
+from muesr.engines.clfc import LocalFields, find_largest_sphere, locfield, \
+                               locfield_batch, locfield_adaptive, dipten, \
+                               dipten_batch, locfield_histogram, \
+                               locfield_gradient, locfield_zpm, \
+                               locfield_models, locfield_kscan, lfcext
+from muesr.engines import nplfc
 
 class TestLocalFields(unittest.TestCase):
-    def setUp(self):
-        self.assertTrue(have_lfclib,"lfclib not found! Sorry, it's a mandatory")
         
     def test_init(self):
 
@@ -98,7 +96,6 @@ class TestLocalFields(unittest.TestCase):
 class TestCLFC(unittest.TestCase):
  
     def setUp(self):
-        self.assertTrue(have_lfclib)
         self.sample = Sample()
 
     def _set_a_cell(self):
@@ -169,11 +166,512 @@ class TestCLFC(unittest.TestCase):
 
         with self.assertRaises(ValueError):
             locfield(self.sample, 's', [0,2,2], 3.)
+
+    def _set_a_magnetic_sample(self):
+        self.sample._reset(cell=True,muon=True,sym=True,magdefs=True)
+        self.sample.cell = Atoms(symbols=['Co','O'],
+                                  scaled_positions=[[0,0,0],[0.5,0.5,0.]],
+                                  cell=[[3.,0,0],
+                                        [0,3.,0],
+                                        [0,0,4.]])
+        self.sample.new_mm()
+        self.sample.mm.k = np.array([0.1,0.,0.2])
+        self.sample.mm.fc = np.array([[1.,1.j,0.],[0.,0.,0.]],
+                                     dtype=np.complex128)
+        self.sample.add_muon([0.1,0.2,0.3])
+        self.sample.add_muon([0.5,0.,0.5])
+        self.sample.add_muon([0.25,0.75,0.1])
+
+    def test_locfield_batch(self):
+        self._set_a_magnetic_sample()
+        
+        with self.assertRaises(ValueError):
+            locfield_batch(self.sample, 's', [4,4,4], 5., positions=[[0.,0.]])
+        
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            ref = locfield(self.sample, ctype, [6,6,6], 8., **extra)
+            res = locfield_batch(self.sample, ctype, [6,6,6], 8., **extra)
+            
+            self.assertEqual(len(res.T), 3)
+            for i, r in enumerate(ref):
+                np.testing.assert_allclose(res.D[i], r.D, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(res.L[i], r.L, rtol=1e-5, atol=1e-9)
+                np.testing.assert_allclose(res.C[i], r.C, rtol=1e-5, atol=1e-6)
+        
+        # cartesian positions
+        res = locfield_batch(self.sample, 's', [6,6,6], 8.,
+                             positions=[[1.5,0.,2.]], cartesian=True)
+        ref = locfield_batch(self.sample, 's', [6,6,6], 8.,
+                             positions=[[0.5,0.,0.5]])
+        np.testing.assert_array_almost_equal(res.D, ref.D)
+        
+    def test_locfield_histogram(self):
+        self._set_a_magnetic_sample()
+        
+        with self.assertRaises(ValueError):
+            locfield_histogram(self.sample, [6,6,6], 8., None)
+        with self.assertRaises(ValueError):
+            locfield_histogram(self.sample, [6,6,6], 8., 36, bins=0)
+        with self.assertRaises(ValueError):
+            locfield_histogram(self.sample, [6,6,6], 8., 36, weights=[1.,2.])
+        
+        for sc in ([6,6,6], None):
+            hist = locfield_histogram(self.sample, sc, 8., 72, bins=40,
+                                      ACont=0.5, weights=[1.,2.,3.])
+            ref = locfield_batch(self.sample, 'i', sc, 8., nangles=72)
+            ref.ACont = 0.5
+            w = np.repeat([1.,2.,3.], 72)
+            T = ref.T.reshape(-1, 3)
+            # bmax is the largest field at any angle
+            bmax = np.linalg.norm(T, axis=1).max()
+            self.assertGreaterEqual(hist.bmax, bmax)
+            self.assertLess(hist.bmax, 1.01 * bmax)
+            c, _ = np.histogram(np.linalg.norm(T, axis=1),
+                                bins=hist.magnitude_edges, weights=w)
+            np.testing.assert_allclose(hist.magnitude, c)
+            for i in range(3):
+                c, _ = np.histogram(T[:,i], bins=hist.component_edges,
+                                    weights=w)
+                np.testing.assert_allclose(hist.components[i], c)
             
+            # histograms of the processes are merged
+            res = locfield_histogram(self.sample, sc, 8., 72, bins=40,
+                                     ACont=0.5, weights=[1.,2.,3.],
+                                     workers=2, block_size=50)
+            np.testing.assert_array_equal(res.magnitude, hist.magnitude)
+            np.testing.assert_array_equal(res.components, hist.components)
+        
+    def test_locfield_gradient(self):
+        self._set_a_magnetic_sample()
         
+        with self.assertRaises(TypeError):
+            locfield_gradient(self.sample, [6,6,6], 'a')
+        
+        for sc in ([6,6,6], None):
+            B, J = locfield_gradient(self.sample, sc, 8.)
+            ref = locfield_batch(self.sample, 's', sc, 8.)
+            np.testing.assert_array_equal(B.D, ref.D)
+            self.assertEqual(J.D.shape, (3,3,3))
+            np.testing.assert_array_equal(J.L, np.zeros([3,3,3]))
             
+            # finite differences of the total field, at sites where no
+            # moment is on the surface of the Lorentz sphere
+            pos = [[0.3,0.2,1.4],[1.1,2.3,0.7]]
+            B, J = locfield_gradient(self.sample, sc, 8., positions=pos,
+                                     cartesian=True)
+            B.ACont = J.ACont = 1.
+            h = 1e-5
+            for j in range(3):
+                dx = np.zeros(3)
+                dx[j] = h
+                a = locfield_batch(self.sample, 's', sc, 8., positions=pos+dx,
+                                   cartesian=True)
+                b = locfield_batch(self.sample, 's', sc, 8., positions=pos-dx,
+                                   cartesian=True)
+                a.ACont = b.ACont = 1.
+                np.testing.assert_allclose(J.T[:,:,j], (a.T-b.T)/(2*h),
+                                           atol=1e-6)
+        
+    def test_locfield_models(self):
+        self._set_a_magnetic_sample()
+        # a second domain with another k and magnetic atom
+        self.sample.new_mm()
+        self.sample.mm.k = np.array([0.,0.3,0.2])
+        self.sample.mm.fc = np.array([[0.,0.,1.],[0.5j,0.,0.5]],
+                                     dtype=np.complex128)
+        self.sample.mm.phi = np.array([0.,0.25])
+        
+        with self.assertRaises(IndexError):
+            locfield_models(self.sample, 's', [6,6,6], 8., models=[0,2])
+        with self.assertRaises(TypeError):
+            locfield_models(self.sample, 's', [6,6,6], 8., models=['a'])
+        with self.assertRaises(ValueError):
+            locfield_models(self.sample, 's', [6,6,6], 8., weights=[1.])
+        
+        for sc in ([6,6,6], None):
+            for ctype, extra in (('s',{}),
+                                 ('i',{'nangles': 6}),
+                                 ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+                res = locfield_models(self.sample, ctype, sc, 8.,
+                                      block_size=500, **extra)
+                self.assertEqual(res.D.shape[0], 2)
+                for m in range(2):
+                    self.sample.current_mm_idx = m
+                    ref = locfield_batch(self.sample, ctype, sc, 8., **extra)
+                    res.ACont = ref.ACont = 1.
+                    np.testing.assert_allclose(res.D[m], ref.D, atol=1e-12)
+                    np.testing.assert_allclose(res.L[m], ref.L, atol=1e-12)
+                    np.testing.assert_allclose(res.C[m], ref.C, atol=1e-12)
+        
+        # weighted average and models given as objects
+        res = locfield_models(self.sample, 's', [6,6,6], 8.)
+        avg = locfield_models(self.sample, 's', [6,6,6], 8., 
+                              models=[self.sample.mm, 0], weights=[3., 1.])
+        np.testing.assert_allclose(avg.T, 0.75 * res.T[1] + 0.25 * res.T[0])
+        
+    def test_locfield_kscan(self):
+        self._set_a_magnetic_sample()
         
+        with self.assertRaises(ValueError):
+            locfield_kscan(self.sample, 's', [6,6,6], 8., [[0.,0.]])
+        
+        kvectors = np.array([[0.,0.,0.],[0.1,0.,0.2],[0.5,0.5,0.],
+                             [0.13,0.27,0.31]])
+        for sc in ([6,6,6], None):
+            for ctype, extra in (('s',{}),
+                                 ('i',{'nangles': 6}),
+                                 ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+                res = locfield_kscan(self.sample, ctype, sc, 8., kvectors,
+                                     **extra)
+                self.assertEqual(res.D.shape[0], 4)
+                for i, k in enumerate(kvectors):
+                    self.sample.mm.k = k
+                    ref = locfield_batch(self.sample, ctype, sc, 8., **extra)
+                    res.ACont = ref.ACont = 1.
+                    np.testing.assert_allclose(res.D[i], ref.D, atol=1e-12)
+                    np.testing.assert_allclose(res.L[i], ref.L, atol=1e-12)
+                    np.testing.assert_allclose(res.C[i], ref.C, atol=1e-12)
+        
+    def test_locfield_zpm(self):
+        self._set_a_magnetic_sample()
+        pos = [[0.3,0.2,1.4],[1.1,2.3,0.7]]
+        
+        with self.assertRaises(ValueError):
+            locfield_zpm(self.sample, 's', [6,6,6], 8.)
+        with self.assertRaises(ValueError):
+            locfield_zpm(self.sample, 's', [6,6,6], 8., covariance=np.eye(3),
+                         displacements=np.zeros([2,3]))
+        with self.assertRaises(ValueError):
+            locfield_zpm(self.sample, 's', [6,6,6], 8.,
+                         covariance=[[1,1,0],[0,1,0],[0,0,1]])
+        with self.assertRaises(ValueError):
+            locfield_zpm(self.sample, 's', [6,6,6], 8.,
+                         covariance=-np.eye(3))
+        with self.assertRaises(ValueError):
+            locfield_zpm(self.sample, 's', [6,6,6], 8.,
+                         displacements=np.zeros([2,4]))
+        with self.assertRaises(TypeError):
+            locfield_zpm(self.sample, 's', [6,6,6], 8.,
+                         covariance=np.eye(3), rnear='a')
+        
+        # no motion
+        for ctype, extra in (('s',{}), ('i',{'nangles': 6})):
+            ref = locfield_batch(self.sample, ctype, [6,6,6], 8., **extra)
+            res = locfield_zpm(self.sample, ctype, [6,6,6], 8.,
+                               covariance=np.zeros([3,3]), nsamples=3,
+                               **extra)
+            np.testing.assert_allclose(res.D, ref.D, atol=1e-12)
+            np.testing.assert_allclose(res.L, ref.L, atol=1e-12)
+            np.testing.assert_allclose(res.C, ref.C, atol=1e-12)
+            np.testing.assert_allclose(res.variance, 0., atol=1e-20)
+        self.assertIsNone(ref.variance)
+        
+        # small displacements along the axes: the variance is given by 
+        # the gradient of the field
+        h = 1e-3
+        disp = np.concatenate([h*np.eye(3), -h*np.eye(3)])
+        for sc in ([6,6,6], None):
+            B, J = locfield_gradient(self.sample, sc, 8., positions=pos,
+                                     cartesian=True)
+            res = locfield_zpm(self.sample, 's', sc, 8., displacements=disp,
+                               rnear=3., positions=pos, cartesian=True)
+            for acont in (0., 1.):
+                B.ACont = J.ACont = res.ACont = acont
+                np.testing.assert_allclose(res.T, B.T, atol=1e-5)
+                np.testing.assert_allclose(res.variance,
+                                           h**2/3.*np.sum(J.T**2, axis=2),
+                                           rtol=1e-2, atol=1e-14)
+        
+        # Gaussian displacements
+        cov = np.diag([0.01, 0.02, 0.005])
+        res = locfield_zpm(self.sample, 's', [6,6,6], 8., covariance=cov,
+                           nsamples=301, seed=3, positions=pos,
+                           cartesian=True)
+        self.assertEqual(res.T.shape, (2,3))
+        self.assertEqual(res.variance.shape, (2,3))
+        B, J = locfield_gradient(self.sample, [6,6,6], 8., positions=pos,
+                                 cartesian=True)
+        np.testing.assert_allclose(res.T, B.T, atol=2e-2)
+        np.testing.assert_allclose(res.variance,
+                                   np.einsum('nij,jk,nik->ni', J.T, cov, J.T),
+                                   rtol=0.3)
+        
+    def test_dipten_batch(self):
+        with self.assertRaises(TypeError):
+            dipten_batch(1, [6,6,6], 8.)
+        
+        self._set_a_magnetic_sample()
         
+        ref = dipten(self.sample, [6,6,6], 8.)
+        res = dipten_batch(self.sample, [6,6,6], 8.)
+        self.assertEqual(res.shape, (3,3,3))
+        for i, r in enumerate(ref):
+            np.testing.assert_allclose(res[i], r, rtol=1e-5, atol=1e-9)
+
+    def test_null_magnetic_model(self):
+        self._set_a_cell()
+        self.sample.new_mm()
+        self.sample.add_muon([0.5,0.5,0.5])
+        self.sample.add_muon([0.1,0.2,0.3])
+
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            res = locfield_batch(self.sample, ctype, [4,4,4], 5., **extra)
+            self.assertEqual(len(res.T), 2)
+            np.testing.assert_array_equal(res.T, 0.)
+            for r in locfield(self.sample, ctype, [4,4,4], 5., **extra):
+                np.testing.assert_array_equal(r.T, 0.)
+
+        res = dipten_batch(self.sample, [4,4,4], 5.)
+        self.assertEqual(res.shape, (2,3,3))
+        np.testing.assert_array_equal(res, 0.)
+
+    def test_dipten_resolve(self):
+        self.sample.cell = Atoms(symbols=['Fe','Co','Fe','O'],
+                                 scaled_positions=[[0,0,0],[0.5,0.5,0.5],
+                                                   [0.5,0.5,0],[0,0.5,0.25]],
+                                 cell=np.diag([3.,3.,4.]))
+        self.sample.new_mm()
+        self.sample.mm.fc = np.array([[0,0,1],[0,0,1],[1,0,0],[0,0,0]],
+                                     dtype=np.complex128)
+        self.sample.add_muon([0.1,0.2,0.3])
+        self.sample.add_muon([0.3,0.2,0.1])
+
+        with self.assertRaises(TypeError):
+            dipten(self.sample, [6,6,6], 8., resolve=1)
+        with self.assertRaises(ValueError):
+            dipten_batch(self.sample, [6,6,6], 8., resolve='bubu')
+        with self.assertRaises(SymmetryError):
+            dipten(self.sample, [6,6,6], 8., resolve='orbits')
+
+        self.sample.sym = Spacegroup(123)
+        for sc in ([6,6,6], None):
+            ref = dipten(self.sample, sc, 8.)
+            for resolve, n in (('atoms', 3), ('species', 2), ('orbits', 3)):
+                res = dipten(self.sample, sc, 8., resolve=resolve)
+                bres = dipten_batch(self.sample, sc, 8., resolve=resolve)
+                self.assertEqual(bres.shape, (2, n, 3, 3))
+                np.testing.assert_allclose(bres, res, atol=1e-12)
+                # the contributions add up to the full tensor
+                np.testing.assert_allclose(np.sum(res, axis=1), ref,
+                                           atol=1e-12)
+
+        # the two Fe atoms are in different orbits (1a and 1c)
+        res = dipten(self.sample, [6,6,6], 8., resolve='atoms')
+        bres = dipten(self.sample, [6,6,6], 8., resolve='species')
+        np.testing.assert_allclose(bres[0][0], res[0][0] + res[0][2])
+        np.testing.assert_allclose(bres[0][1], res[0][1])
+
+    def test_locfield_rotate(self):
+        self._set_a_magnetic_sample()
+        self.sample.mm.fc = np.array([[1.,1.j,0.],[0.,0.5,1.]],
+                                     dtype=np.complex128)
+        axis = np.array([1.,1.,0.])
+
+        res = locfield(self.sample, 'r', [6,6,6], 8., nangles=5, axis=axis)
+        for r, mu in zip(res, self.sample.muons):
+            c,d,l = lfcext.Fields('r', self.sample.cell.get_scaled_positions(),
+                                  self.sample.mm.fc, self.sample.mm.k,
+                                  self.sample.mm.phi, mu,
+                                  np.array([6,6,6],dtype=np.int32),
+                                  self.sample.cell.get_cell(), 8., 2, 10.,
+                                  5, axis/np.linalg.norm(axis))
+            self.assertEqual(r.D.shape, (5,3))
+            np.testing.assert_allclose(r.D, d, rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(r.L, l, rtol=1e-5, atol=1e-9)
+
+        # one axis for each atom and arbitrary angles
+        axes = np.array([[0.,0.,1.],[1.,0.,0.]])
+        angles = [0., 30., 45., 200.]
+        res = locfield(self.sample, 'r', [6,6,6], 8., axis=axes,
+                       angles=angles)
+        bres = locfield_batch(self.sample, 'r', [6,6,6], 8., axis=axes,
+                              angles=angles)
+
+        fc = self.sample.mm.fc
+        for j, angle in enumerate(angles):
+            t = np.radians(angle)
+            self.sample.mm.fc = np.array([np.dot(rotation_matrix(a, t), f)
+                                          for a, f in zip(axes, fc)])
+            ref = locfield(self.sample, 's', [6,6,6], 8.)
+            self.sample.mm.fc = fc
+            for i, r in enumerate(ref):
+                np.testing.assert_allclose(res[i].D[j], r.D, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(res[i].C[j], r.C, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(bres.D[i,j], r.D, rtol=1e-5, atol=1e-6)
+
+        with self.assertRaises(ValueError):
+            locfield(self.sample, 'r', [6,6,6], 8., axis=axes[:1], angles=angles)
+
+    def test_workers(self):
+        self._set_a_magnetic_sample()
+        self.sample.add_muon([0.3,0.3,0.3])
+        self.sample.add_muon([0.9,0.1,0.6])
+
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            ref = locfield(self.sample, ctype, [6,6,6], 8., **extra)
+            res = locfield(self.sample, ctype, [6,6,6], 8., workers=2, **extra)
+            self.assertEqual(len(res), 5)
+            for a, b in zip(ref, res):
+                np.testing.assert_array_equal(a.D, b.D)
+                np.testing.assert_array_equal(a.L, b.L)
+                np.testing.assert_array_equal(a.C, b.C)
+
+        ref = dipten(self.sample, [6,6,6], 8.)
+        res = dipten(self.sample, [6,6,6], 8., workers=3)
+        for a, b in zip(ref, res):
+            np.testing.assert_array_equal(a, b)
+
+        self.assertEqual(find_largest_sphere(self.sample, [2,2,2]),
+                         find_largest_sphere(self.sample, [2,2,2], workers=2))
+
+        with self.assertRaises(ValueError):
+            locfield(self.sample, 's', [6,6,6], 8., workers=0)
+        with self.assertRaises(ValueError):
+            locfield(self.sample, 'r', [6,6,6], 8., axis=[1.,0.], nangles=2)
+
+    def test_automatic_supercell(self):
+        self._set_a_magnetic_sample()
+        self.sample.mm.phi = np.array([0.13, 0.])
+
+        # k.floor(sc/2) must be an integer to have the same phases
+        sc = [20,20,20]
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            ref = locfield(self.sample, ctype, sc, 12., **extra)
+            res = locfield(self.sample, ctype, None, 12., **extra)
+            batch = locfield_batch(self.sample, ctype, None, 12., **extra)
+            for i, r in enumerate(ref):
+                np.testing.assert_allclose(res[i].T, r.T, atol=1e-12)
+                np.testing.assert_allclose(res[i].C, r.C, atol=1e-12)
+                np.testing.assert_allclose(batch.T[i], r.T, rtol=1e-5,
+                                           atol=1e-6)
+
+        ref = dipten(self.sample, sc, 12.)
+        for res in (dipten(self.sample, None, 12.),
+                    dipten_batch(self.sample, None, 12.)):
+            np.testing.assert_allclose(res, ref, atol=1e-12)
+
+        # the sphere is enclosed in a few cells
+        origin, size = nplfc.sphere_supercell(np.zeros([1,3]),
+                                              self.sample.muons[0], 12.,
+                                              self.sample.cell.get_cell())
+        np.testing.assert_array_equal(size, [8,8,6])
+        np.testing.assert_array_equal(origin, [-3,-3,-2])
+
+        
+            
+        
+        
+
+    def test_locfield_adaptive(self):
+        self._set_a_magnetic_sample()
+
+        with self.assertRaises(ValueError):
+            locfield_adaptive(self.sample, 's', 0.)
+        with self.assertRaises(ValueError):
+            locfield_adaptive(self.sample, 's', 1e-3, step=-1.)
+        with self.assertRaises(TypeError):
+            locfield_adaptive(self.sample, 's', 'a')
+
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            res = locfield_adaptive(self.sample, ctype, 1e-3, radius=8.,
+                                    **extra)
+            self.assertEqual(len(res), 3)
+            for i, r in enumerate(res):
+                self.assertGreater(r.radius, 8.)
+                self.assertLess(r.error, 1e-3)
+                # the sums over the shells are those of the whole sphere
+                ref = locfield(self.sample, ctype, None, r.radius,
+                               **extra)[i]
+                np.testing.assert_allclose(r.D, ref.D, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(r.L, ref.L, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(r.C, ref.C, rtol=1e-5, atol=1e-6)
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            res = locfield_adaptive(self.sample, 's', 1e-9, radius=8.,
+                                    max_radius=12.)
+            self.assertEqual(len(w), 1)
+        self.assertEqual(res[0].radius, 12.)
+        self.assertGreaterEqual(res[0].error, 1e-9)
+
+        self.assertIsNone(locfield(self.sample, 's', [2,2,2], 3.)[0].radius)
+
+    def test_symmetry(self):
+        self.sample.cell = Atoms(symbols=['Fe'], scaled_positions=[[0,0,0]],
+                                 cell=np.diag([3.,3.,3.]))
+        self.sample.new_mm()
+        self.sample.mm.fc = np.array([[1.,1.j,0.]], dtype=np.complex128)
+        for mu in ([0.1,0.23,0.37], [0.5,0.5,0.2]):
+            self.sample.add_muon(mu)
+
+        # without symmetry all the sites are evaluated
+        ref = locfield(self.sample, 's', [10,10,10], 10.)
+        res = locfield(self.sample, 's', [10,10,10], 10., symmetry=True)
+        for a, b in zip(ref, res):
+            np.testing.assert_array_equal(a.T, b.T)
+
+        self.sample.sym = Spacegroup(221)
+        muon_find_equiv(self.sample)
+        for k in ([0.,0.,0.], [0.,0.,0.5], [0.,0.,0.3]):
+            self.sample.mm.k = np.array(k)
+            for sc in ([10,10,10], [11,11,11], None):
+                ref = locfield(self.sample, 's', sc, 10.)
+                res = locfield(self.sample, 's', sc, 10., symmetry=True)
+                self.assertEqual(len(res), len(ref))
+                # the contact field is null unless ACont is set
+                for a, b in zip(ref, res):
+                    a.ACont = b.ACont = 1.
+                self.assertGreater(max(np.linalg.norm(a.C) for a in ref), 1e-3)
+                for a, b in zip(ref, res):
+                    np.testing.assert_allclose(b.D, a.D, atol=1e-12)
+                    np.testing.assert_allclose(b.L, a.L, atol=1e-12)
+                    np.testing.assert_allclose(b.C, a.C, atol=1e-12)
+
+        # moments along x, y and z on the face centers: the operations
+        # exchanging the atoms also rotate the contact field. nnn=3
+        # includes whole shells of neighbours of the sites, so that
+        # the contact field is symmetric.
+        s = Sample()
+        s.cell = Atoms(symbols=['Fe','Fe','Fe'],
+                       scaled_positions=[[0,0.5,0.5],[0.5,0,0.5],[0.5,0.5,0]],
+                       cell=np.diag([3.,3.,3.]))
+        s.new_mm()
+        s.mm.fc = np.eye(3, dtype=np.complex128)
+        s.sym = Spacegroup(221)
+        for mu in ([0.1,0.23,0.37], [0.5,0.5,0.2]):
+            s.add_muon(mu)
+        muon_find_equiv(s)
+        ref = locfield(s, 's', [10,10,10], 10., nnn=3)
+        res = locfield(s, 's', [10,10,10], 10., nnn=3, symmetry=True)
+        C = []
+        for a, b in zip(ref, res):
+            a.ACont = b.ACont = 1.
+            np.testing.assert_allclose(b.D, a.D, atol=1e-12)
+            np.testing.assert_allclose(b.C, a.C, atol=1e-12)
+            C.append(a.C)
+        # the contact fields of equivalent sites are not all equal
+        self.assertGreater(np.ptp(C, axis=0).max(), 1.)
+
+        # other calculation types are fully evaluated
+        ref = locfield(self.sample, 'i', [10,10,10], 10., nangles=6)
+        res = locfield(self.sample, 'i', [10,10,10], 10., nangles=6,
+                       symmetry=True)
+        for a, b in zip(ref, res):
+            np.testing.assert_array_equal(a.T, b.T)
+
+        ref = dipten(self.sample, [10,10,10], 10.)
+        res = dipten(self.sample, [10,10,10], 10., symmetry=True)
+        np.testing.assert_allclose(res, ref, atol=1e-12)
 
 # http://stackoverflow.com/a/6802723
 def rotation_matrix(axis, theta):
@@ -195,10 +693,6 @@ def rotation_matrix(axis, theta):
         
 class TestLFCExtension(unittest.TestCase):
     
-    def setUp(self):
-        self.assertTrue(have_lfclib)
-        
-    
     def test_one_over_r_cube(self):
         
         p  = np.array([[0.,0.,0.]])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.core.atoms import Atoms
+from muesr.core.sample import Sample
+from muesr.engines import ewald
+from muesr.engines.clfc import locfield_batch
+
+
+class TestEwald(unittest.TestCase):
+
+    def setUp(self):
+        self.sample = Sample()
+
+    def _set_a_cubic_ferromagnet(self):
+        self.sample.cell = Atoms(symbols=['Co'],
+                                  scaled_positions=[[0,0,0]],
+                                  cell=[[3.,0,0],
+                                        [0,3.,0],
+                                        [0,0,3.]])
+        self.sample.new_mm()
+        self.sample.mm.k = np.array([0.,0.,0.])
+        self.sample.mm.fc = np.array([[0.,0.,1.]],dtype=np.complex128)
+        self.sample.add_muon([0.5,0.5,0.5])
+        self.sample.add_muon([0.5,0.,0.])
+
+    def _set_a_magnetic_sample(self):
+        self.sample.cell = Atoms(symbols=['Co','O'],
+                                  scaled_positions=[[0,0,0],[0.5,0.5,0.]],
+                                  cell=[[3.,0,0],
+                                        [0,3.,0],
+                                        [0,0,4.]])
+        self.sample.new_mm()
+        self.sample.mm.k = np.array([0.1,0.,0.2])
+        self.sample.mm.fc = np.array([[1.,1.j,0.],[0.,0.,0.]],
+                                     dtype=np.complex128)
+        self.sample.add_muon([0.1,0.2,0.3])
+        self.sample.add_muon([0.5,0.,0.5])
+        self.sample.add_muon([0.25,0.75,1.1])
+
+    def test_arguments(self):
+        with self.assertRaises(TypeError):
+            ewald.locfield(None, 's')
+
+        self._set_a_cubic_ferromagnet()
+        with self.assertRaises(ValueError):
+            ewald.locfield(self.sample, 'a')
+        with self.assertRaises(ValueError):
+            ewald.locfield(self.sample, 'i')
+        with self.assertRaises(ValueError):
+            ewald.locfield(self.sample, 's', accuracy=2.)
+        with self.assertRaises(TypeError):
+            ewald.dipten(self.sample, accuracy='a')
+
+    def test_cubic_ferromagnet(self):
+        self._set_a_cubic_ferromagnet()
+
+        r = ewald.locfield(self.sample, 's', accuracy=1e-10)
+        self.assertEqual(len(r), 2)
+
+        # dipolar field vanishes at the center of the cube
+        np.testing.assert_array_almost_equal(r[0].D, np.zeros(3), decimal=10)
+
+        # Lorentz field is mu_0/3 M
+        lorentz = 0.9274009 * 4. * np.pi / (3. * 27.)
+        np.testing.assert_array_almost_equal(r[0].L, [0,0,lorentz])
+        np.testing.assert_array_almost_equal(r[1].L, [0,0,lorentz])
+
+        # moments along z, muon along x: the field is opposite to the moment
+        self.assertLess(r[1].D[2], 0.)
+        np.testing.assert_array_almost_equal(r[1].D[:2], np.zeros(2))
+
+        d = ewald.dipten(self.sample, accuracy=1e-10)
+        np.testing.assert_array_almost_equal(d[0], np.zeros([3,3]), decimal=10)
+        self.assertAlmostEqual(np.trace(d[1]), 0.)
+        np.testing.assert_array_almost_equal(0.9274009 * np.dot(d[1], [0,0,1.]),
+                                             r[1].D)
+
+    def test_accuracy(self):
+        self._set_a_magnetic_sample()
+
+        ref = ewald.locfield(self.sample, 's', accuracy=1e-12)
+        for accuracy in (1e-3, 1e-5, 1e-8):
+            res = ewald.locfield(self.sample, 's', accuracy=accuracy)
+            for a, b in zip(ref, res):
+                scale = np.max(np.abs(a.D))
+                self.assertLess(np.max(np.abs(a.D - b.D)), accuracy * scale)
+
+    def test_compare_with_brute_force(self):
+        self._set_a_magnetic_sample()
+
+        # k.floor(sc/2) must be an integer to have the same phases
+        sc = [40,40,40]
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            ref = locfield_batch(self.sample, ctype, sc, 55., **extra)
+            res = ewald.locfield(self.sample, ctype, **extra)
+            for i, r in enumerate(res):
+                self.assertEqual(r.D.shape, ref.D[i].shape)
+                # brute force sums converge slowly with the radius
+                np.testing.assert_allclose(r.T, ref.T[i], atol=2e-3)
+                np.testing.assert_allclose(r.C, ref.C[i], atol=1e-9)
+
+    def test_grid(self):
+        self._set_a_magnetic_sample()
+        self.sample.mm.fc = np.array([[1.,1.j,0.],[0.3,0.,1.]],
+                                     dtype=np.complex128)
+        self.sample.mm.phi = np.array([0.,0.3])
+
+        with self.assertRaises(ValueError):
+            ewald.locfield_grid(self.sample, 's', [4,4])
+        with self.assertRaises(ValueError):
+            ewald.locfield_grid(self.sample, 's', [4,0,4])
+        with self.assertRaises(TypeError):
+            ewald.dipten_grid(self.sample, [4,4,4], accuracy='a')
+
+        grid = [6,5,8]
+        points = ewald.grid_points(grid).reshape(-1, 3)
+        # the fields on the atomic positions are not defined, only the
+        # atom at the origin is on the grid.
+        ok = np.any(points != 0., axis=1)
+
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            res = ewald.locfield_grid(self.sample, ctype, grid, **extra)
+            ref = ewald.locfield(self.sample, ctype, nnn=0, positions=points,
+                                 **extra)
+            D = res.D.reshape((-1,) + res.D.shape[3:])
+            L = res.L.reshape((-1,) + res.D.shape[3:])
+            self.assertEqual(res.D.shape[:3], tuple(grid))
+            for i in np.nonzero(ok)[0]:
+                np.testing.assert_allclose(D[i], ref[i].D, atol=1e-6)
+                np.testing.assert_allclose(L[i], ref[i].L, atol=1e-9)
+
+        self.sample.mm.k = np.zeros(3)
+        res = ewald.locfield_grid(self.sample, 's', grid)
+        ref = ewald.locfield(self.sample, 's', nnn=0, positions=points)
+        np.testing.assert_allclose(res.L.reshape(-1, 3),
+                                   [r.L for r in ref], atol=1e-9)
+
+        res = ewald.dipten_grid(self.sample, grid).reshape(-1, 3, 3)
+        ref = ewald.dipten(self.sample, positions=points)
+        for i in np.nonzero(ok)[0]:
+            np.testing.assert_allclose(res[i], ref[i], atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.engines.histogram import FieldHistogram, ellipse_bmax
+
+
+class TestFieldHistogram(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.fields = rng.normal(size=(40, 25, 3))
+        self.weights = rng.uniform(size=40)
+
+    def test_init(self):
+        with self.assertRaises(TypeError):
+            FieldHistogram('a', 1.)
+        with self.assertRaises(TypeError):
+            FieldHistogram(10, 'a')
+        with self.assertRaises(ValueError):
+            FieldHistogram(0, 1.)
+        with self.assertRaises(ValueError):
+            FieldHistogram(10, 0.)
+
+        hist = FieldHistogram(10, 2.)
+        self.assertEqual(hist.bins, 10)
+        self.assertEqual(hist.bmax, 2.)
+        np.testing.assert_array_equal(hist.component_edges,
+                                      np.linspace(-2., 2., 11))
+
+    def test_add(self):
+        hist = FieldHistogram(30, 3.)
+        hist.add(self.fields, self.weights[:, None])
+
+        w = np.repeat(self.weights, 25)
+        f = self.fields.reshape(-1, 3)
+        ref, _ = np.histogram(np.linalg.norm(f, axis=1),
+                              bins=hist.magnitude_edges, weights=w)
+        np.testing.assert_allclose(hist.magnitude, ref)
+        for i in range(3):
+            ref, _ = np.histogram(f[:, i], bins=hist.component_edges,
+                                  weights=w)
+            np.testing.assert_allclose(hist.components[i], ref)
+        self.assertAlmostEqual(hist.weight, w.sum())
+
+        with self.assertRaises(ValueError):
+            hist.add(np.zeros([4, 2]))
+
+    def test_merge(self):
+        hist = FieldHistogram(30, 3.)
+        hist.add(self.fields)
+        a = FieldHistogram(30, 3.)
+        a.add(self.fields[:15])
+        b = FieldHistogram(30, 3.)
+        b.add(self.fields[15:])
+        res = a + b
+        np.testing.assert_array_equal(res.magnitude, hist.magnitude)
+        np.testing.assert_array_equal(res.components, hist.components)
+        self.assertEqual(res.weight, hist.weight)
+
+        with self.assertRaises(ValueError):
+            a + FieldHistogram(20, 3.)
+        with self.assertRaises(TypeError):
+            a.merge(1.)
+
+        # fields out of range are not counted but are normalized
+        mag, comp = res.density()
+        inside = np.linalg.norm(self.fields, axis=2) <= 3.
+        self.assertAlmostEqual(np.sum(mag) * 0.1, np.mean(inside))
+
+    def test_ellipse_bmax(self):
+        B = np.array([[1., 1.j, 0.], [2., 0.5j, 0.], [1.+1.j, 1.+1.j, 0.]])
+        t = np.linspace(0., 2. * np.pi, 10001)
+        fields = np.real(B[:, None, :] * np.exp(1.j * t)[None, :, None])
+        np.testing.assert_allclose(ellipse_bmax(B),
+                                   np.linalg.norm(fields, axis=2).max(axis=1),
+                                   rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
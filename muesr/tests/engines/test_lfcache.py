@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.core.atoms import Atoms
+from muesr.core.sample import Sample
+from muesr.core.sampleErrors import *
+from muesr.core.magmodel import have_sympy
+if have_sympy:
+    from muesr.core.magmodel import SMM
+from muesr.engines.clfc import locfield_batch, dipten_batch
+from muesr.engines.lfcache import LocalFieldsCache
+
+
+class TestLocalFieldsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.sample = Sample()
+        self.sample.cell = Atoms(symbols=['Co','Co','O'],
+                                  scaled_positions=[[0,0,0],
+                                                    [0.5,0.5,0.5],
+                                                    [0.5,0.5,0.]],
+                                  cell=[[3.,0,0],
+                                        [0,3.,0],
+                                        [0,0,4.]])
+        self.sample.new_mm()
+        self.sample.mm.k = np.array([0.1,0.,0.2])
+        self.sample.mm.fc = np.array([[1.,1.j,0.],[0.,0.,2.],[0.,0.,0.]],
+                                     dtype=np.complex128)
+        self.sample.add_muon([0.1,0.2,0.3])
+        self.sample.add_muon([0.5,0.,0.5])
+
+    def _compare(self, cache, ctype='s', **extra):
+        ref = locfield_batch(self.sample, ctype, [6,6,6], 8., **extra)
+        res = cache.locfield(ctype, **extra)
+        self.assertEqual(len(res), len(self.sample.muons))
+        for i, r in enumerate(res):
+            np.testing.assert_array_almost_equal(r.D, ref.D[i])
+            np.testing.assert_array_almost_equal(r.L, ref.L[i])
+            np.testing.assert_array_almost_equal(r.C, ref.C[i])
+
+    def test_init(self):
+        with self.assertRaises(TypeError):
+            LocalFieldsCache(None, [6,6,6], 8.)
+        with self.assertRaises(ValueError):
+            LocalFieldsCache(self.sample, [0,6,6], 8.)
+
+        cache = LocalFieldsCache(Sample(), [6,6,6], 8.)
+        with self.assertRaises(MagDefError):
+            cache.locfield('s')
+
+    def test_locfield(self):
+        cache = LocalFieldsCache(self.sample, [6,6,6], 8.)
+        self._compare(cache, 's')
+        self._compare(cache, 'i', nangles=6)
+        self._compare(cache, 'r', nangles=4, axis=[1.,1.,0.])
+        self.assertEqual(len(cache._tensors), 1)
+
+        # new Fourier components and phases reuse the lattice sums
+        self.sample.mm.fc = np.array([[0.,1.,1.j],[2.j,0.,0.],[0.,0.,0.]],
+                                     dtype=np.complex128)
+        self.sample.mm.phi = np.array([0.,0.25,0.])
+        self._compare(cache, 's')
+        self.assertEqual(len(cache._tensors), 1)
+
+        # a new propagation vector requires new sums
+        self.sample.mm.k = np.array([0.5,0.5,0.])
+        self._compare(cache, 's')
+        self.assertEqual(len(cache._tensors), 2)
+
+        # as well as a new set of magnetic atoms
+        self.sample.mm.fc = np.array([[0.,0.,0.],[0.,0.,1.],[0.,0.,0.]],
+                                     dtype=np.complex128)
+        self._compare(cache, 's')
+        self.assertEqual(len(cache._tensors), 3)
+
+        # other magnetic models can be given explicitly
+        self.sample.new_mm()
+        self.sample.mm.fc = np.array([[0.,0.,1.],[0.,0.,0.],[0.,0.,0.]],
+                                     dtype=np.complex128)
+        ref = cache.locfield('s')
+        self.sample.current_mm_idx = 0
+        res = cache.locfield('s', mm=self.sample._magdefs[1])
+        for a, b in zip(ref, res):
+            np.testing.assert_array_equal(a.D, b.D)
+
+    def test_invalidation(self):
+        cache = LocalFieldsCache(self.sample, [6,6,6], 8.)
+        self._compare(cache, 's')
+
+        self.sample.add_muon([0.25,0.75,0.1])
+        self._compare(cache, 's')
+        self.assertEqual(len(cache._tensors), 1)
+
+        cell = self.sample.cell
+        cell.set_cell(np.diag([3.,3.,5.]))
+        self.sample.cell = cell
+        self._compare(cache, 's')
+
+        cache.clear()
+        self.assertEqual(len(cache._tensors), 0)
+        self._compare(cache, 's')
+
+    def test_automatic_supercell(self):
+        cache = LocalFieldsCache(self.sample, None, 8.)
+        for ctype, extra in (('s',{}),
+                             ('i',{'nangles': 6}),
+                             ('r',{'nangles': 4, 'axis': [1.,1.,0.]})):
+            ref = locfield_batch(self.sample, ctype, None, 8., **extra)
+            res = cache.locfield(ctype, **extra)
+            for i, r in enumerate(res):
+                np.testing.assert_array_almost_equal(r.T, ref.T[i])
+
+        ref = dipten_batch(self.sample, None, 8.)
+        for a, b in zip(ref, cache.dipten()):
+            np.testing.assert_array_almost_equal(a, b)
+
+    def test_dipten(self):
+        cache = LocalFieldsCache(self.sample, [6,6,6], 8.)
+        ref = dipten_batch(self.sample, [6,6,6], 8.)
+        res = cache.dipten()
+        for a, b in zip(ref, res):
+            np.testing.assert_array_almost_equal(a, b)
+
+    @unittest.skipUnless(have_sympy, "Sympy not available")
+    def test_symbolic_model(self):
+        smm = SMM(3, 'a,b', self.sample.cell.get_cell())
+        smm.k = np.array([0.1,0.,0.2])
+        smm.set_symFC('[[a,1.j*a,0],[0,0,b],[0,0,0]]')
+        smm.set_params([1., 1.])
+        self.sample.mm = smm
+        cache = LocalFieldsCache(self.sample, [6,6,6], 8.)
+        for a, b in ((1., 2.), (0.5, -1.), (2., 0.3)):
+            self.sample.mm.set_params([a, b])
+            self._compare(cache, 's')
+        self.assertEqual(len(cache._tensors), 1)
+
+    @unittest.skipUnless(have_sympy, "Sympy not available")
+    def test_params_batch(self):
+        smm = SMM(3, 'a,b', self.sample.cell.get_cell())
+        smm.k = np.array([0.1,0.,0.2])
+        smm.set_symFC('[[a,1.j*a,0],[0,0,b],[0,0,0]]')
+        smm.set_params([1., 1.])
+        self.sample.mm = smm
+        cache = LocalFieldsCache(self.sample, [6,6,6], 8.)
+        params = np.array([[1., 2.], [0.5, -1.], [0., 0.3]])
+        for ctype, extra in (('s', {}), ('i', {'nangles': 6}),
+                             ('r', {'nangles': 4, 'axis': [1.,1.,0.]})):
+            res = cache.locfield(ctype, params=params, **extra)
+            for j, p in enumerate(params):
+                self.sample.mm.set_params(p)
+                ref = cache.locfield(ctype, **extra)
+                for r, b in zip(ref, res):
+                    np.testing.assert_array_almost_equal(r.D, b.D[j])
+                    np.testing.assert_array_almost_equal(r.L, b.L[j])
+                    np.testing.assert_array_almost_equal(r.C, b.C[j])
+        # the model is not changed
+        np.testing.assert_array_almost_equal(smm.fc[1], [0., 0., 0.3])
+
+        self.sample.new_mm()
+        with self.assertRaises(TypeError):
+            cache.locfield('s', params=params)
+
+
+if __name__ == '__main__':
+    unittest.main()
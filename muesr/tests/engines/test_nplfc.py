@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.engines import nplfc
+
+have_lfclib = False
+try:
+    import lfclib as lfcext
+    have_lfclib = True
+except Exception as e:
+    print(e)
+
+
+class TestNPLFC(unittest.TestCase):
+
+    def setUp(self):
+        self.p  = np.array([[0.1,0.2,0.3],[0.5,0.5,0.1]])
+        self.fc = np.array([[1.,1.j,0.],[0.,2.j,2.]],dtype=np.complex128)
+        self.k  = np.array([0.1,0.2,0.3])
+        self.phi= np.array([0.2,0.4])
+        self.sc = np.array([5,4,6],dtype=np.int32)
+        self.latpar = np.array([[4.,0.,0.],[0.5,5.,0.],[0.3,0.2,6.]])
+        self.mus = np.array([[0.3,0.6,0.2],
+                             [0.7,0.1,0.9],
+                             [0.0,0.5,0.5]])
+
+    def test_one_over_r_cube(self):
+        p  = np.array([[0.,0.,0.]])
+        fc = np.array([[0.,0.,1.]],dtype=np.complex128)
+        k  = np.array([0.,0.,0.])
+        phi= np.array([0.,])
+        sc = np.array([1,1,1],dtype=np.int32)
+        latpar = np.diag([2.,2.,2.])
+
+        c,d,l = nplfc.Fields('s', p,fc,k,phi,np.array([0.5,0.5,0.5]),sc,latpar,10.,0,1.)
+        np.testing.assert_array_equal(c,np.zeros(3))
+        np.testing.assert_array_almost_equal(l,np.array([0,0,9.2740095E-4]))
+
+        c,d,l = nplfc.Fields('s', p,fc,k,phi,np.array([0.5,0.,0.]),sc,latpar,10.,0,1.)
+        np.testing.assert_array_almost_equal(d, np.array([0,0,-0.92740095]) )
+
+    def test_batch_shapes(self):
+        c,d,l = nplfc.Fields('s', self.p,self.fc,self.k,self.phi,self.mus,
+                             self.sc,self.latpar,9.,3,5.)
+        self.assertEqual(d.shape, (3,3))
+
+        c,d,l = nplfc.Fields('i', self.p,self.fc,self.k,self.phi,self.mus,
+                             self.sc,self.latpar,9.,3,5.,7)
+        self.assertEqual(d.shape, (3,7,3))
+
+        c,d,l = nplfc.Fields('r', self.p,self.fc,self.k,self.phi,self.mus,
+                             self.sc,self.latpar,9.,3,5.,5,np.array([0,0,1.]))
+        self.assertEqual(c.shape, (3,5,3))
+
+        t = nplfc.DipolarTensor(self.p, self.mus, self.sc, self.latpar, 9.)
+        self.assertEqual(t.shape, (3,3,3))
+
+    def test_batch_equals_single(self):
+        axis = np.array([1.,2.,3.])/np.sqrt(14.)
+        for ctype, extra in (('s',()),('i',(7,)),('r',(5,axis))):
+            bc,bd,bl = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                                    self.mus,self.sc,self.latpar,9.,3,5.,
+                                    *extra)
+            for i, mu in enumerate(self.mus):
+                c,d,l = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                                     mu,self.sc,self.latpar,9.,3,5.,*extra)
+                np.testing.assert_array_almost_equal(bc[i], c, decimal=12)
+                np.testing.assert_array_almost_equal(bd[i], d, decimal=12)
+                np.testing.assert_array_almost_equal(bl[i], l, decimal=12)
+
+    def test_rotate_equals_sum(self):
+        # rotating by pi around z flips x and y components
+        c,d,l = nplfc.Fields('r', self.p,self.fc,self.k,self.phi,self.mus,
+                             self.sc,self.latpar,9.,3,5.,2,np.array([0,0,1.]))
+        fc = self.fc*np.array([-1.,-1.,1.])
+        rc,rd,rl = nplfc.Fields('s', self.p,fc,self.k,self.phi,self.mus,
+                                self.sc,self.latpar,9.,3,5.)
+        np.testing.assert_array_almost_equal(c[:,1,:], rc)
+        np.testing.assert_array_almost_equal(d[:,1,:], rd)
+        np.testing.assert_array_almost_equal(l[:,1,:], rl)
+
+    def test_chunked_sums(self):
+        # tiny blocks force the lattice to be split in many chunks, the
+        # sums are accumulated in the same order and results are equal
+        axis = np.array([0.,0.,1.])
+        sc = [13,13,13]
+        for ctype, extra in (('s',()),('i',(7,)),('r',(5,axis))):
+            ref = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                               self.mus,sc,self.latpar,19.,3,5.,*extra)
+            for block_size in (7, 1000, 2**14):
+                res = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                                   self.mus,sc,self.latpar,19.,3,5.,*extra,
+                                   block_size=block_size)
+                for a, b in zip(ref, res):
+                    np.testing.assert_array_equal(a, b)
+
+        ref = nplfc.DipolarTensor(self.p, self.mus, sc, self.latpar, 19.)
+        ptref = nplfc.PhaseTensors(self.p, self.k, self.mus, sc, self.latpar,
+                                   19., 3, 5.)
+        for block_size in (5, 1000):
+            res = nplfc.DipolarTensor(self.p, self.mus, sc, self.latpar, 19.,
+                                      block_size=block_size)
+            np.testing.assert_array_equal(ref, res)
+            res = nplfc.PhaseTensors(self.p, self.k, self.mus, sc,
+                                     self.latpar, 19., 3, 5.,
+                                     block_size=block_size)
+            for a, b in zip(ptref, res):
+                np.testing.assert_array_equal(a, b)
+
+    def test_fields_from_tensors(self):
+        axis = np.array([0.,0.6,0.8])
+        for block_size in (nplfc.BLOCK_SIZE, 7):
+            tensors = nplfc.PhaseTensors(self.p,self.k,self.mus,self.sc,
+                                         self.latpar,9.,3,5.,
+                                         block_size=block_size)
+            for ctype, extra in (('s',()),('i',(7,)),('r',(5,axis))):
+                ref = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                                   self.mus,self.sc,self.latpar,9.,3,5.,*extra)
+                res = nplfc.FieldsFromTensors(ctype, tensors,self.fc,self.k,
+                                              self.phi,self.mus,self.sc,9.,
+                                              *extra)
+                for a, b in zip(ref, res):
+                    np.testing.assert_array_almost_equal(a, b, decimal=10)
+
+    def test_field_gradients(self):
+        res = nplfc.FieldGradients(self.p,self.fc,self.k,self.phi,self.mus,
+                                   self.sc,self.latpar,9.,3,5.)
+        ref = nplfc.Fields('s', self.p,self.fc,self.k,self.phi,self.mus,
+                           self.sc,self.latpar,9.,3,5.)
+        for a, b in zip(ref, res[:3]):
+            np.testing.assert_array_equal(a, b)
+
+        # central finite differences along the Cartesian axes
+        GC, GD = res[3:]
+        h = 1e-5
+        for j in range(3):
+            dx = np.dot(h * np.eye(3)[j], np.linalg.inv(self.latpar))
+            a = nplfc.Fields('s', self.p,self.fc,self.k,self.phi,self.mus+dx,
+                             self.sc,self.latpar,9.,3,5.)
+            b = nplfc.Fields('s', self.p,self.fc,self.k,self.phi,self.mus-dx,
+                             self.sc,self.latpar,9.,3,5.)
+            np.testing.assert_allclose(GC[:,:,j], (a[0]-b[0])/(2*h), atol=1e-7)
+            np.testing.assert_allclose(GD[:,:,j], (a[1]-b[1])/(2*h), atol=1e-7)
+
+        # same derivatives from the lattice sums of each atom
+        tensors = nplfc.PhaseTensors(self.p,self.k,self.mus,self.sc,
+                                     self.latpar,9.,3,5.,gradient=True)
+        JC, JD = nplfc.GradientsFromTensors(tensors[3:], self.fc, self.phi)
+        np.testing.assert_allclose(JC, GC, atol=1e-12)
+        np.testing.assert_allclose(JD, GD, atol=1e-12)
+
+        # the dipolar field is curl and divergence free
+        for g in GD:
+            np.testing.assert_array_almost_equal(g, g.T)
+            self.assertAlmostEqual(np.trace(g), 0.)
+
+    def test_kscan_fields(self):
+        axis = np.array([0.,0.,1.])
+        K = np.array([[0.,0.,0.],[0.1,0.2,0.3],[0.5,0.,0.25]])
+        for ctype in ('s', 'r', 'i'):
+            res = nplfc.KScanFields(ctype, self.p,self.fc,K,self.phi,
+                                    self.mus,self.sc,self.latpar,9.,3,5.,
+                                    4,axis)
+            small = nplfc.KScanFields(ctype, self.p,self.fc,K,self.phi,
+                                      self.mus,self.sc,self.latpar,9.,3,5.,
+                                      4,axis,block_size=100)
+            for a, b in zip(res, small):
+                np.testing.assert_array_equal(a, b)
+            for q, k in enumerate(K):
+                ref = nplfc.Fields(ctype, self.p,self.fc,k,self.phi,self.mus,
+                                   self.sc,self.latpar,9.,3,5.,4,axis)
+                for a, b in zip(ref, res):
+                    np.testing.assert_allclose(b[q], a, atol=1e-12)
+
+    def test_displaced_fields(self):
+        axis = np.array([0.,0.,1.])
+        # without displacements the fields are those of the sites
+        disp = np.zeros([len(self.mus), 2, 3])
+        for ctype in ('s', 'r', 'i'):
+            ref = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,self.mus,
+                               self.sc,self.latpar,9.,3,5.,4,axis)
+            for rnear in (9., 4.):
+                res = nplfc.DisplacedFields(ctype, self.p,self.fc,self.k,
+                                            self.phi,self.mus,self.sc,
+                                            self.latpar,9.,3,5.,disp,rnear,
+                                            4,axis,block_size=500)
+                for a, b in zip(ref, res):
+                    np.testing.assert_allclose(b[:,1], a, atol=1e-12)
+
+        # the error of the expansion of the far field is quadratic in
+        # the displacement
+        rng = np.random.RandomState(1)
+        disp = rng.normal(scale=0.1, size=(len(self.mus), 5, 3))
+        errors = []
+        for scale in (1., 0.5):
+            a = nplfc.DisplacedFields('s', self.p,self.fc,self.k,self.phi,
+                                      self.mus,self.sc,self.latpar,9.,3,5.,
+                                      scale*disp,9.)
+            b = nplfc.DisplacedFields('s', self.p,self.fc,self.k,self.phi,
+                                      self.mus,self.sc,self.latpar,9.,3,5.,
+                                      scale*disp,3.)
+            np.testing.assert_array_equal(a[0], b[0])
+            np.testing.assert_allclose(a[2], b[2], atol=1e-14)
+            errors.append(np.max(np.abs(a[1] - b[1])))
+        self.assertAlmostEqual(errors[0] / errors[1], 4., delta=0.5)
+
+    def test_no_magnetic_atoms(self):
+        p  = np.zeros([0,3])
+        fc = np.zeros([0,3],dtype=np.complex128)
+        for ctype, extra in (('s',()),('i',(7,)),('r',(5,np.array([0,0,1.])))):
+            c,d,l = nplfc.Fields(ctype, p,fc,self.k,np.zeros(0),self.mus,
+                                 self.sc,self.latpar,9.,3,5.,*extra)
+            for B in (c,d,l):
+                self.assertEqual(B.shape[0], 3)
+                np.testing.assert_array_equal(B, 0.)
+
+        t = nplfc.DipolarTensor(p, self.mus, self.sc, self.latpar, 9.)
+        self.assertEqual(t.shape, (3,3,3))
+        np.testing.assert_array_equal(t, 0.)
+
+    def test_dipolar_tensor_is_traceless(self):
+        t = nplfc.DipolarTensor(self.p, self.mus, self.sc, self.latpar, 9.)
+        for e in t:
+            self.assertAlmostEqual(np.trace(e), 0.)
+            np.testing.assert_array_almost_equal(e, e.T)
+
+    @unittest.skipUnless(have_lfclib, "lfclib not available")
+    def test_compare_with_lfclib(self):
+        axis = np.array([1.,2.,3.])/np.sqrt(14.)
+        for ctype, extra in (('s',()),('i',(7,)),('r',(5,axis))):
+            bc,bd,bl = nplfc.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                                    self.mus,self.sc,self.latpar,9.,3,5.,
+                                    *extra)
+            for i, mu in enumerate(self.mus):
+                c,d,l = lfcext.Fields(ctype, self.p,self.fc,self.k,self.phi,
+                                      mu,self.sc,self.latpar,9.,3,5.,*extra)
+                np.testing.assert_allclose(bc[i], c, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(bd[i], d, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(bl[i], l, rtol=1e-5, atol=1e-9)
+
+        t = nplfc.DipolarTensor(self.p, self.mus, self.sc, self.latpar, 9.)
+        for i, mu in enumerate(self.mus):
+            np.testing.assert_allclose(t[i],
+                lfcext.DipolarTensor(self.p, mu, self.sc, self.latpar, 9.),
+                rtol=1e-5, atol=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
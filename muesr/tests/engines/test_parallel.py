@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import warnings
+import numpy as np
+
+from muesr.engines import parallel
+from muesr.engines.parallel import map_sites, parse_workers, have_shm
+
+
+def _norm_site(a, i, scale):
+    return scale * np.linalg.norm(a['x'][i] - a['y'])
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_parse_workers(self):
+        self.assertEqual(parse_workers(None), 1)
+        self.assertEqual(parse_workers('3'), 3)
+        with self.assertRaises(TypeError):
+            parse_workers('a')
+        with self.assertRaises(ValueError):
+            parse_workers(0)
+
+    @unittest.skipUnless(have_shm, "shared memory not available")
+    def test_map_sites(self):
+        arrays = {'x': np.random.rand(11, 3), 'y': np.random.rand(3)}
+        ref = map_sites(_norm_site, arrays, 11, (2.,))
+        res = map_sites(_norm_site, arrays, 11, (2.,), workers=3)
+        self.assertEqual(len(res), 11)
+        np.testing.assert_array_equal(ref, res)
+        np.testing.assert_array_almost_equal(
+            res, 2. * np.linalg.norm(arrays['x'] - arrays['y'], axis=1))
+
+    def test_serial_fallback(self):
+        arrays = {'x': np.random.rand(5, 3), 'y': np.random.rand(3)}
+        ref = map_sites(_norm_site, arrays, 5, (2.,))
+        parallel.have_shm = False
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                res = map_sites(_norm_site, arrays, 5, (2.,), workers=4)
+                self.assertEqual(len(w), 1)
+                self.assertTrue(issubclass(w[0].category, RuntimeWarning))
+                # no warning if a single process is requested
+                map_sites(_norm_site, arrays, 5, (2.,), workers=1)
+                self.assertEqual(len(w), 1)
+        finally:
+            parallel.have_shm = have_shm
+        np.testing.assert_array_equal(ref, res)
+
+
+if __name__ == '__main__':
+    unittest.main()
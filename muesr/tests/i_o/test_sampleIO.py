@@ -339,6 +339,22 @@ class TestSampleIO(unittest.TestCase):
         myfile.seek(0)
         t = load_sample("",myfile)
         
+    @unittest.skipIf(have_yaml == False, 'PyYaml not available')
+    def test_store_and_load_muons(self):
+        s = load_sample("",StringIO(yaml_lattice_and_muon))
+        s.add_muon([0.1,0.2,0.3], label='a', weight=0.5)
+        myfile = StringIO()
+        save_sample(s,"",myfile)
+        myfile.seek(0)
+        t = load_sample("",myfile)
+        
+        a, b = s.snapshot(), t.snapshot()
+        np.testing.assert_array_equal(a.muons, b.muons)
+        np.testing.assert_array_equal(a.muon_labels, b.muon_labels)
+        np.testing.assert_array_equal(a.muon_orbits, b.muon_orbits)
+        np.testing.assert_array_equal(a.muon_weights, b.muon_weights)
+        self.assertEqual(b.muon_labels[2], 'a')
+        
     @unittest.skipIf(have_yaml == False, 'PyYaml not available')
     def test_load_cartesian_positions(self):
         s = load_sample("",StringIO(yaml_lattice_cartesian_positions))
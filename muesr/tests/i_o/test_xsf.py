@@ -4,13 +4,17 @@ try:
 except ImportError:
     from io import StringIO
     
+import os
+import tempfile
 import unittest
 import numpy as np
 import sys
 
 from muesr.core.sample import Sample
 from muesr.core.sampleErrors import *
+from muesr.core.atoms import Atoms
 from muesr.i_o import load_xsf, save_xsf
+from muesr.i_o.xsf.xsfio import write_xsf
 
 
 class TestXsfIO(unittest.TestCase):
@@ -39,6 +43,33 @@ class TestXsfIO(unittest.TestCase):
             save_xsf(s,u'ciao')
         
 
+    def test_write_datagrid(self):
+        s = Sample()
+        s.cell = Atoms(symbols=['Co'], scaled_positions=[[0,0,0]],
+                       cell=[[3.,0,0],[0,3.,0],[0,0,4.]])
+        data = np.arange(24.).reshape(2,3,4)
+        
+        fd, fname = tempfile.mkstemp(suffix='.xsf')
+        os.close(fd)
+        try:
+            write_xsf(fname, s.cell, data)
+            with open(fname) as f:
+                lines = f.read().split('BEGIN_DATAGRID_3Dgrid#1')[1]
+        finally:
+            os.remove(fname)
+        
+        lines = lines.split('END_DATAGRID_3D')[0].split()
+        # periodic points are added along each direction
+        self.assertEqual([int(x) for x in lines[:3]], [3,4,5])
+        np.testing.assert_array_almost_equal(
+            np.array(lines[3:15], dtype=float).reshape(4,3),
+            [[0,0,0],[3,0,0],[0,3,0],[0,0,4]])
+        values = np.array(lines[15:], dtype=float)
+        # first index runs fastest
+        np.testing.assert_array_almost_equal(
+            values.reshape(5,4,3).transpose(2,1,0),
+            np.pad(data, [(0,1)]*3, mode='wrap'))
+
         
 if __name__ == '__main__':
     unittest.main()
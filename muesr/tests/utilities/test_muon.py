@@ -345,8 +345,16 @@ class TestMuon(unittest.TestCase):
         self._sample._reset(muon=True)
         
         muon_set_frac(self._sample, "0.2 0.3 0.4")
+        self._sample.add_muon([0.1,0.1,0.1], label='b')
         muon_find_equiv(self._sample)
         
+        # the sites generated from the second muon
+        snap = self._sample.snapshot()
+        second = snap.muon_orbits == 1
+        self.assertEqual(set(snap.muon_labels[second]), set(['b']))
+        self._sample.remove_muons(second)
+        np.testing.assert_array_equal(self._sample.snapshot().muon_orbits, 0)
+        
         muon_positions = self._sample.muons
         #positions calculated with VESTA
         eqpositions = np.array([[ 0.200000  , 0.300000  , 0.400000],
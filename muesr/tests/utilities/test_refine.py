@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+from muesr.core.atoms import Atoms
+from muesr.core.sample import Sample
+from muesr.core.sampleErrors import *
+from muesr.core.magmodel import have_sympy
+if have_sympy:
+    from muesr.core.magmodel import SMM
+from muesr.engines.clfc import locfield
+from muesr.utilities.refine import refine_sites, MUON_GAMMA
+
+
+class TestRefine(unittest.TestCase):
+
+    def setUp(self):
+        self.sample = Sample()
+        self.sample.cell = Atoms(symbols=['Fe','Fe'],
+                                 scaled_positions=[[0,0,0],[0.5,0.5,0.5]],
+                                 cell=np.diag([3.,3.5,4.]))
+        self.sites = np.array([[0.23,0.11,0.31],[0.4,0.3,0.1]])
+
+    def _measure(self, models, acont):
+        for mu in self.sites:
+            self.sample.add_muon(mu)
+        measured = []
+        for m in models:
+            self.sample.current_mm_idx = m
+            res = locfield(self.sample, 's', [8,8,8], 10.)
+            for r in res:
+                r.ACont = acont
+            measured.append([np.linalg.norm(r.T) for r in res])
+        self.sample._reset(muon=True)
+        return np.array(measured)
+
+    def test_refine_sites(self):
+        for fc, k in (([[0,0,1],[0,0,1]], [0,0,0]),
+                      ([[1,0,0],[-1,0,0]], [0,0,0]),
+                      ([[0,1,0],[0,1,0]], [0,0,0.5]),
+                      ([[1,1,0],[0,0,1]], [0,0,0])):
+            self.sample.new_mm()
+            self.sample.mm.fc = np.array(fc, dtype=np.complex128)
+            self.sample.mm.k = np.array(k, dtype=np.float64)
+        measured = self._measure([0,1,2,3], 0.4)
+
+        with self.assertRaises(MuonError):
+            refine_sites(self.sample, measured, [8,8,8], 10.)
+
+        # start from displaced sites
+        for mu in self.sites + [[0.02,-0.03,0.02],[-0.02,0.01,0.03]]:
+            self.sample.add_muon(mu)
+
+        with self.assertRaises(ValueError):
+            refine_sites(self.sample, measured, [8,8,8], 10.)
+        with self.assertRaises(ValueError):
+            refine_sites(self.sample, measured, [8,8,8], 10.,
+                         models=[0,1,2,3], nstarts=0)
+
+        pos, acont, params, cost = refine_sites(self.sample, measured,
+                                                [8,8,8], 10.,
+                                                models=[0,1,2,3], nstarts=3,
+                                                max_shift=0.3, seed=1)
+        np.testing.assert_allclose(pos, self.sites, atol=1e-6)
+        self.assertAlmostEqual(acont, 0.4, places=6)
+        self.assertIsNone(params)
+        self.assertLess(cost, 1e-12)
+        # the sites of the sample are not changed
+        self.assertAlmostEqual(self.sample.muons[0][0], 0.25)
+
+        # a missing value and bounds on ACont
+        measured[1, 0] = np.nan
+        pos, acont, params, cost = refine_sites(self.sample, measured,
+                                                [8,8,8], 10.,
+                                                models=[0,1,2,3],
+                                                acont_bounds=[0., 0.3])
+        self.assertLessEqual(acont, 0.3)
+
+    @unittest.skipUnless(have_sympy, "Sympy not available")
+    def test_refine_params(self):
+        mm = SMM(2, "x,y", self.sample.cell.get_cell())
+        mm.set_symFC("[[0,0,x],[y,0,x]]")
+        self.sample.mm = mm
+        mm.set_params([1.2, 0.5])
+        self.sites = np.array([[0.23,0.11,0.31],[0.4,0.3,0.1],
+                               [0.1,0.4,0.3]])
+        measured = self._measure([0], 0.) * MUON_GAMMA
+        for mu in self.sites:
+            self.sample.add_muon(mu)
+
+        pos, acont, params, cost = refine_sites(self.sample, measured,
+                                                [8,8,8], 10.,
+                                                fit_acont=False,
+                                                params=[1., 0.3],
+                                                param_bounds=[[0., 2.],
+                                                              [0., 2.]],
+                                                frequencies=True,
+                                                max_shift=0.)
+        np.testing.assert_allclose(params, [1.2, 0.5], atol=1e-4)
+        np.testing.assert_allclose(pos, self.sites, atol=1e-12)
+        self.assertEqual(acont, 0.)
+        # the model is left with the refined parameters
+        np.testing.assert_allclose(mm.fc[1], [params[1], 0., params[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,3 +4,4 @@ from .visualize import show_structure
 from .ms import (mago_set_k, mago_add, mago_set_FC)
 from .muon import (muon_set_frac, muon_find_equiv, muon_reset)
 from .printer import print_cell
+from .refine import refine_sites
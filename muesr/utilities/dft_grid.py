@@ -1,5 +1,6 @@
 from muesr.core.parsers import *
 from muesr.core.cells import get_reduced_bases
+from muesr.core.neighbours import neighbour_index
 from muesr.settings import config
 
 import numpy as np
@@ -37,35 +38,6 @@ def build_uniform_grid(sample, size, min_distance_from_atoms=1.0):
     equiv=np.ones_like(x)*(npoints)
     
     
-    alt = True
-    nb_cells = np.array([[-1., -1., -1.],
-                         [-1., -1.,  0.],
-                         [-1., -1.,  1.],
-                         [-1.,  0., -1.],
-                         [-1.,  0.,  0.],
-                         [-1.,  0.,  1.],
-                         [-1.,  1., -1.],
-                         [-1.,  1.,  0.],
-                         [-1.,  1.,  1.],
-                         [ 0., -1., -1.],
-                         [ 0., -1.,  0.],
-                         [ 0., -1.,  1.],
-                         [ 0.,  0., -1.],
-                         [ 0.,  0.,  0.],
-                         [ 0.,  0.,  1.],
-                         [ 0.,  1., -1.],
-                         [ 0.,  1.,  0.],
-                         [ 0.,  1.,  1.],
-                         [ 1., -1., -1.],
-                         [ 1., -1.,  0.],
-                         [ 1., -1.,  1.],
-                         [ 1.,  0., -1.],
-                         [ 1.,  0.,  0.],
-                         [ 1.,  0.,  1.],
-                         [ 1.,  1., -1.],
-                         [ 1.,  1.,  0.],
-                         [ 1.,  1.,  1.]])
-
     
     for i in range(size):
         for j in range(size):
@@ -90,44 +62,16 @@ def build_uniform_grid(sample, size, min_distance_from_atoms=1.0):
 
     
     
-    reduced_bases = sample.cell.get_cell()
-    scaled_pos = sample.cell.get_scaled_positions()
-                        
-    positions = []
-    for i in range(size):
-        for j in range(size):
-            for k in range(size):
-                if equiv[i,j,k] >= npoints:
-                    #saves distances with all atoms
-                    distances = []
-                    dists = np.zeros(27*len(sample._cell))
-                    center = [x[i,j,k],y[i,j,k],z[i,j,k]]
+    candidates = np.array([x[equiv >= npoints],
+                           y[equiv >= npoints],
+                           z[equiv >= npoints]]).T
 
-                    #check distances form atoms (also in neighbouring cells)
-                    
+    # distance from the nearest atom, also in neighbouring cells
+    index = neighbour_index(sample, max(min_distance_from_atoms, 1e-6))
+    dists, _, _ = index.query(candidates, 1)
+
+    positions = candidates[dists[:, 0] > min_distance_from_atoms].tolist()
 
-                    for a in range(len(sample._cell)):
-                        dists[a*27:(a+1)*27] = np.linalg.norm(
-                                                  np.dot(scaled_pos[a] - center + nb_cells,
-                                                         reduced_bases), axis=1 )
-                    #
-                    # old method 20 times slower!
-                    #
-                    #for a in range(len(sample._cell)):
-                    #    for ii in (-1, 0, 1):
-                    #        for jj in (-1, 0, 1):
-                    #            for kk in (-1, 0, 1):
-                    #                distances.append( np.linalg.norm(
-                    #                        np.dot(scaled_pos[a] - center + np.array([ii,jj,kk]),
-                    #                            reduced_bases) ) )
-                    #
-                    #print(np.allclose(dists,distances))
-                    #if min(distances) > min_distance_from_atoms:
-                    
-                    
-                    if dists.min() > min_distance_from_atoms:
-                        positions.append([x[i,j,k],y[i,j,k],z[i,j,k]])
-                        
     return positions
 
 
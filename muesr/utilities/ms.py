@@ -79,7 +79,8 @@ def mago_add(sample, coordinates='b-c', fcs=None, kvalue=None):
     
     """        
     
-    nmm = MM(sample.cell.get_number_of_atoms(),sample.cell.get_cell())
+    snapshot = sample.snapshot()
+    nmm = MM(len(snapshot.positions), snapshot.lattice)
     
     ret = mago_set_k(sample, mm=nmm, kvalue=kvalue)
     if not ret:
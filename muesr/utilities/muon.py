@@ -46,18 +46,21 @@ def muon_set_frac(sample, arg = None):
 def muon_find_equiv(sample, eps=1.e-3):
     """
     Given the unit cell symmetry, finds the equivalent muon sites.
-    Magnetic order is NOT considered
+    Magnetic order is NOT considered.
+    The orbit index of each new site is the index of the site it was
+    generated from, whose label and weight are also copied.
     :params: eps, number of decimal figures for comparison
     """
     sample._check_sym()
     sample._check_muon()
     
-    eqpoints = sample._sym.equivalent_sites(np.array(sample.muons), \
+    snap = sample.snapshot()
+    eqpoints, kinds = sample._sym.equivalent_sites(snap.muons, \
                                                 symprec=eps, \
-                                                onduplicates='warn')[0]
+                                                onduplicates='warn')
     sample._reset(muon=True)
-    for p in eqpoints:
-        sample.add_muon(np.array(p))
+    sample.add_muons(eqpoints, labels=list(snap.muon_labels[kinds]),
+                     orbits=kinds, weights=snap.muon_weights[kinds])
     return True
    
 def muon_reset(sample):
@@ -0,0 +1,375 @@
+"""
+Refinement of muon sites.
+
+The positions of the muon sites, the contact hyperfine coupling and,
+optionally, the parameters of symbolic magnetic models are adjusted to
+reproduce the measured local fields with a bounded Levenberg-Marquardt
+least squares fit.
+
+At each step the lattice sums connecting the magnetic atoms to the
+muon sites, and their derivatives with respect to the muon position,
+are evaluated in a single pass over the supercell for all the sites
+and all the starting points. The fields of all the magnetic models
+with the same propagation vector and their derivatives with respect to
+all the parameters are obtained from these sums with tensor
+contractions.
+"""
+
+import numpy as np
+
+from muesr.core.sample import Sample
+from muesr.core.neighbours import neighbour_index
+from muesr.engines import nplfc
+from muesr.engines.clfc import _parse_locfield_args
+
+# muon gyromagnetic ratio, in MHz/T
+MUON_GAMMA = 135.5388
+
+
+def _parse_measured(measured, nmodels, nsites, frequencies):
+    """
+    Returns the measured fields as an (nmodels, nsites) array in Tesla.
+    Missing values are nan.
+    """
+    try:
+        measured = np.array(measured, dtype=np.float64)
+    except:
+        raise TypeError("Cannot convert measured to NumPy array.")
+    if measured.ndim == 1:
+        measured = measured[None, :]
+    if measured.shape != (nmodels, nsites):
+        raise ValueError("measured must have shape (nsites,) or (nmodels, nsites).")
+    if frequencies:
+        measured = measured / MUON_GAMMA
+    return measured
+
+
+def _parse_bounds(bounds, n, name):
+    """
+    Returns the lower and upper bounds of `n` parameters.
+    """
+    if bounds is None:
+        return np.full(n, -np.inf), np.full(n, np.inf)
+    try:
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1, 2)
+    except:
+        raise TypeError("Cannot convert " + name + " to NumPy array.")
+    if bounds.shape[0] == 1:
+        bounds = np.repeat(bounds, n, axis=0)
+    if bounds.shape[0] != n or np.any(bounds[:, 0] > bounds[:, 1]):
+        raise ValueError("Invalid " + name + ".")
+    return bounds[:, 0], bounds[:, 1]
+
+
+def _model_components(mms, params, fit_params, h=1e-6):
+    """
+    Fourier components (nmodels, natoms, 3) of the magnetic models for
+    the parameters `params`, and their derivatives with respect to the
+    parameters (nparams, nmodels, natoms, 3), obtained with central
+    differences. Only symbolic models depend on the parameters.
+    """
+    fcs = []
+    dfcs = np.zeros((len(params), len(mms)) + mms[0].fc.shape,
+                    dtype=np.complex128)
+    for m, mm in enumerate(mms):
+        if fit_params and mm.isSymbolic:
+            for j in range(len(params)):
+                step = h * max(1., abs(params[j]))
+                p = np.array(params, dtype=np.float64)
+                p[j] += step
+                mm.set_params(p)
+                fc = mm.fc.copy()
+                p[j] -= 2. * step
+                mm.set_params(p)
+                dfcs[j, m] = (fc - mm.fc) / (2. * step)
+            mm.set_params(params)
+        fcs.append(mm.fc.copy())
+    return np.array(fcs), dfcs
+
+
+class _Problem(object):
+    """
+    Residuals and Jacobians of the fit for many starting points.
+
+    The parameters of each starting point are the Cartesian positions
+    of the muon sites, followed by ACont (if fitted) and by the
+    parameters of the symbolic models (if fitted).
+    """
+
+    def __init__(self, sample, mms, measured, sc, r, nnn, rc, fit_acont,
+                 acont, fit_params, block_size):
+        self.latpar = sample._cell.get_cell()
+        self.positions = sample._cell.get_scaled_positions()
+        self.mms = mms
+        self.measured = measured
+        self.sc, self.r, self.nnn, self.rc = sc, r, nnn, rc
+        self.fit_acont = fit_acont
+        self.acont = acont
+        self.fit_params = fit_params
+        self.block_size = block_size
+        self.nsites = measured.shape[1]
+
+        # magnetic atoms of any model, for any value of the parameters
+        fc, dfc = _model_components(mms, fit_params if fit_params is not
+                                    None else [], fit_params is not None)
+        magnetic = np.any(np.abs(fc) > 1e-8, axis=(0, 2)) | \
+                   np.any(np.abs(dfc) > 1e-8, axis=(0, 1, 3))
+        self.atoms = np.nonzero(magnetic)[0]
+
+        self.neighbours = None
+        if nnn > 0 and rc > 0:
+            self.neighbours = neighbour_index(sample, rc).subset(self.atoms)
+
+        # models with the same propagation vector share the lattice sums
+        self.groups = {}
+        for m, mm in enumerate(mms):
+            self.groups.setdefault(tuple(mm.k), []).append(m)
+
+    def split(self, theta):
+        """
+        Cartesian positions (nst, nsites, 3), ACont (nst,) and model
+        parameters (nst, nparams) of the parameter vectors `theta`.
+        """
+        n = 3 * self.nsites
+        x = theta[:, :n].reshape(-1, self.nsites, 3)
+        acont = theta[:, n] if self.fit_acont else \
+                np.full(theta.shape[0], self.acont)
+        params = theta[:, n + int(self.fit_acont):]
+        return x, acont, params
+
+    def __call__(self, theta):
+        """
+        Residuals (nst, nmodels * nsites) and Jacobians
+        (nst, nmodels * nsites, npar) of the parameter vectors `theta`.
+        """
+        nst, npar = theta.shape
+        ns = self.nsites
+        x, acont, params = self.split(theta)
+        nm = len(self.mms)
+
+        res = np.zeros([nst, nm, ns])
+        jac = np.zeros([nst, nm, ns, npar])
+
+        components = [_model_components(self.mms, params[s],
+                                         self.fit_params is not None)
+                      for s in range(nst)]
+
+        mus = np.dot(x.reshape(-1, 3), np.linalg.inv(self.latpar))
+        p = self.positions[self.atoms]
+        for k, models in self.groups.items():
+            k = np.array(k)
+            sc, shift, origin = self.sc, mus, np.zeros(3)
+            if sc is None:
+                radius = max(self.r, self.rc) if self.nnn > 0 else self.r
+                origin, sc = nplfc.sphere_supercell(p, mus, radius,
+                                                    self.latpar)
+                shift = mus - origin - np.floor(sc / 2.)
+            tensors = nplfc.PhaseTensors(p, k, shift, sc, self.latpar,
+                                         self.r, self.nnn, self.rc,
+                                         self.block_size, self.neighbours,
+                                         gradient=True)
+
+            for s in range(nst):
+                sl = slice(s * ns, (s + 1) * ns)
+                T = tuple(t[sl] for t in tensors)
+                fcs, dfcs = components[s]
+                for m in models:
+                    phi = self.mms[m].phi[self.atoms] + np.dot(k, origin)
+                    fc = fcs[m][self.atoms]
+
+                    def total(fc):
+                        BC, BD, BL = nplfc.FieldsFromTensors('s', T[:3], fc, k,
+                                                             phi, shift[sl],
+                                                             sc, self.r)
+                        return BD + BL + acont[s] * BC, BC
+
+                    B, BC = total(fc)
+                    norm = np.linalg.norm(B, axis=1)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        u = np.where(norm[:, None] > 0, B / norm[:, None], 0.)
+
+                    res[s, m] = norm - self.measured[m]
+
+                    JC, JD = nplfc.GradientsFromTensors(T[3:], fc, phi)
+                    J = JD + acont[s] * JC
+                    dx = np.einsum('nk,nkj->nj', u, J)
+                    for n in range(ns):
+                        jac[s, m, n, 3 * n:3 * n + 3] = dx[n]
+                    col = 3 * ns
+                    if self.fit_acont:
+                        jac[s, m, :, col] = np.einsum('nk,nk->n', u, BC)
+                        col += 1
+                    for j in range(params.shape[1]):
+                        dB, _ = total(dfcs[j, m][self.atoms])
+                        jac[s, m, :, col + j] = np.einsum('nk,nk->n', u, dB)
+
+        # missing measurements do not contribute
+        missing = np.isnan(self.measured)
+        res[:, missing] = 0.
+        jac[:, missing] = 0.
+        return res.reshape(nst, -1), jac.reshape(nst, nm * ns, npar)
+
+
+def _least_squares(fun, theta, lo, hi, max_iter, tol):
+    """
+    Bounded Levenberg-Marquardt minimization of the sum of the squared
+    residuals of `fun` for many starting points `theta` (nst, npar)
+    at once. Steps are projected on the bounds `lo`, `hi`.
+    Returns the parameters and the costs of each starting point.
+    """
+    theta = np.clip(theta, lo, hi)
+    nst, npar = theta.shape
+    r, J = fun(theta)
+    cost = 0.5 * np.sum(r * r, axis=1)
+    lam = np.full(nst, 1e-3)
+    active = np.ones(nst, dtype=bool)
+
+    for it in range(max_iter):
+        idx = np.nonzero(active)[0]
+        if idx.size == 0:
+            break
+
+        A = np.einsum('sri,srj->sij', J[idx], J[idx])
+        g = np.einsum('sri,sr->si', J[idx], r[idx])
+        d = np.einsum('sii->si', A)
+        d = d + 1e-12 * d.max(axis=1, keepdims=True) + 1e-300
+        M = A + (lam[idx, None] * d)[:, :, None] * np.eye(npar)
+        step = -np.linalg.solve(M, g[:, :, None])[:, :, 0]
+        trial = np.clip(theta[idx] + step, lo, hi)
+
+        rt, Jt = fun(trial)
+        ct = 0.5 * np.sum(rt * rt, axis=1)
+        better = ct < cost[idx]
+
+        acc = idx[better]
+        decrease = cost[acc] - ct[better]
+        theta[acc], r[acc], J[acc], cost[acc] = trial[better], \
+                                                rt[better], Jt[better], \
+                                                ct[better]
+        lam[acc] = np.maximum(lam[acc] / 3., 1e-12)
+        lam[idx[~better]] *= 4.
+
+        # converged starting points are not evaluated anymore
+        active[acc[decrease <= tol * (cost[acc] + decrease)]] = False
+        active[cost <= 1e-30] = False
+        active[lam > 1e12] = False
+
+    return theta, cost
+
+
+def refine_sites(sample, measured, supercellsize, radius, models = None, ACont = 0., fit_acont = True, acont_bounds = None, params = None, param_bounds = None, max_shift = 0.5, nstarts = 1, frequencies = False, nnn = 2, rcont = 10.0, max_iter = 100, tol = 1e-10, seed = None, block_size = nplfc.BLOCK_SIZE):
+    """
+    Refines the muon sites to reproduce the measured local fields.
+
+    The positions of the muon sites of the sample, the contact hyperfine
+    coupling ACont (see :py:class:`~muesr.engines.clfc.LocalFields`)
+    and, if `params` is given, the parameters of the symbolic magnetic
+    models are fitted to the magnitudes of the local fields of 'sum'
+    simulations with a bounded least squares method.
+
+    All the starting points are refined together: the lattice sums of
+    all the sites and starting points, and their derivatives with
+    respect to the muon positions, are evaluated in a single pass over
+    the supercell for each step. The derivatives with respect to ACont
+    and to the model parameters are obtained from the same sums.
+    The first starting point is given by the muon sites of the sample,
+    the others are drawn at random within `max_shift`.
+
+    :param sample: the sample object
+    :param measured: the measured local fields in Tesla (or frequencies in MHz if `frequencies` is True), as an array of shape (nsites,) or (nmodels, nsites) when many magnetic models are considered. Missing values are nan.
+    :param list supercellsize: the size of the supercell along the lattice coordinates. If None, the smallest supercell containing the spheres around the sites is chosen at each step.
+    :param float radius: the radius of the Lorentz sphere.
+    :param list models: indexes of the magnetic models of the sample corresponding to the rows of `measured`. Default None, i.e. the current magnetic model.
+    :param float ACont: initial value of the contact hyperfine coupling. Default 0.
+    :param bool fit_acont: if True (default) ACont is refined.
+    :param acont_bounds: lower and upper bounds of ACont. Default None, i.e. unbounded.
+    :param list params: initial values of the parameters of the symbolic magnetic models (see :py:meth:`~muesr.core.magmodel.SMM.set_params`), shared by all the symbolic models. Default None, i.e. the models are not changed.
+    :param param_bounds: (nparams, 2) array of the lower and upper bounds of the parameters. Default None, i.e. unbounded.
+    :param float max_shift: largest displacement of each Cartesian coordinate of the muon sites, in Angstrom. Default 0.5 Angstrom.
+    :param int nstarts: number of starting points. Default 1.
+    :param bool frequencies: if True, `measured` contains precession frequencies in MHz. Default False.
+    :param int nnn: number of local moments nearest neighbours of the muon considered for the contact hyperfine field estimation. Default 2.
+    :param float rcont: maximum radius used to search for local moments close to the muon in the contact hyperfine field estimation in Angstrom. Default 10 Angstrom.
+    :param int max_iter: maximum number of iterations. Default 100.
+    :param float tol: the iterations of a starting point stop when the relative decrease of the cost is smaller than `tol`. Default 1e-10.
+    :param int seed: seed of the random starting points. Default None.
+    :param int block_size: maximum number of (muon, atom) pairs evaluated at once. Default :py:data:`muesr.engines.nplfc.BLOCK_SIZE`.
+    :return: the refined muon positions in fractional coordinates (nsites,3), ACont, the model parameters (or None) and the cost, i.e. half of the sum of the squared residuals in Tesla^2, of the best starting point. The symbolic models are left with the refined parameters.
+    :rtype: tuple
+    :raises: TypeError, ValueError
+    """
+
+    # check sample is a Sample object
+    if not isinstance(sample, Sample):
+        raise TypeError("sample must be a Sample instance.")
+
+    _, sc, r, nnn, rc, _, _ = _parse_locfield_args('s', supercellsize,
+                                                   radius, nnn, rcont,
+                                                   None, None)
+
+    sample._check_lattice()
+    sample._check_magdefs()
+    sample._check_muon()
+
+    if models is None:
+        models = [sample.current_mm_idx]
+    mms = [sample._magdefs[int(m)] for m in models]
+
+    mus = sample.snapshot().muons
+    measured = _parse_measured(measured, len(mms), len(mus), frequencies)
+
+    try:
+        acont = float(ACont)
+        max_shift = float(max_shift)
+    except:
+        raise TypeError("Cannot convert ACont or max_shift to float.")
+    try:
+        nstarts = int(nstarts)
+        max_iter = int(max_iter)
+    except:
+        raise TypeError("Cannot convert nstarts or max_iter to int.")
+    if nstarts < 1:
+        raise ValueError("nstarts must be strictly positive.")
+    if max_shift < 0:
+        raise ValueError("max_shift must be positive.")
+
+    if params is not None:
+        if not any(mm.isSymbolic for mm in mms):
+            raise ValueError("params given but no symbolic model selected.")
+        params = np.array(params, dtype=np.float64).reshape(-1)
+
+    # initial parameters and bounds
+    x0 = np.dot(mus, sample._cell.get_cell()).ravel()
+    theta0 = [x0]
+    lo, hi = [x0 - max_shift], [x0 + max_shift]
+    if fit_acont:
+        alo, ahi = _parse_bounds(acont_bounds, 1, 'acont_bounds')
+        theta0.append([acont])
+        lo.append(alo)
+        hi.append(ahi)
+    if params is not None:
+        plo, phi = _parse_bounds(param_bounds, len(params), 'param_bounds')
+        theta0.append(params)
+        lo.append(plo)
+        hi.append(phi)
+    theta0, lo, hi = [np.concatenate(v) for v in (theta0, lo, hi)]
+
+    rng = np.random.RandomState(seed)
+    theta = np.repeat(theta0[None, :], nstarts, axis=0)
+    theta[1:, :len(x0)] += rng.uniform(-max_shift, max_shift,
+                                       size=(nstarts - 1, len(x0)))
+
+    problem = _Problem(sample, mms, measured, sc, r, nnn, rc, fit_acont,
+                       acont, params, block_size)
+    theta, cost = _least_squares(problem, theta, lo, hi, max_iter, tol)
+
+    best = np.argmin(cost)
+    x, acont, p = problem.split(theta[best:best + 1])
+    if params is not None:
+        for mm in mms:
+            if mm.isSymbolic:
+                mm.set_params(p[0])
+
+    positions = np.dot(x[0], np.linalg.inv(sample._cell.get_cell()))
+    return positions, acont[0], (p[0] if params is not None else None), \
+           cost[best]
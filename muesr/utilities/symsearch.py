@@ -5,16 +5,18 @@ from muesr.core.parsers import *
 #from muesr.core.symmetry import Symmetry
 from muesr.core.nprint  import nprint, nprintmsg
 
+from muesr.core.lazyimport import available, LazyModule
+
+# spglib is imported on first use
 have_spg = True
 
-try:
-    import spglib as spg
-except ImportError:
-    try:
-        from pyspglib import spglib as spg
-    except ImportError:
-        nprint("Spg Library not loaded", "warn")
-        have_spg = False
+if available('spglib'):
+    spg = LazyModule('spglib')
+elif available('pyspglib'):
+    spg = LazyModule('pyspglib.spglib')
+else:
+    nprint("Spg Library not loaded", "warn")
+    have_spg = False
 
 
 